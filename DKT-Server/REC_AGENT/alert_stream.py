@@ -0,0 +1,303 @@
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+from REC_AGENT.change_feed import _CHANGE_STREAMS_UNSUPPORTED, _RESUME_TOKEN_EXPIRED
+from REC_AGENT.metrics import counter, gauge
+from REC_AGENT.notifications import ADMIN_EMAIL, NOTIFICATIONS_COLLECTION
+
+# Alerts buffered per connection; a client that falls further behind loses the oldest
+ALERT_QUEUE_SIZE = int(os.getenv("ALERT_QUEUE_SIZE", "100"))
+ALERT_MAX_SUBSCRIBERS = int(os.getenv("ALERT_MAX_SUBSCRIBERS", "10000"))
+# Comment line sent on idle connections so proxies and load balancers keep them open
+ALERT_HEARTBEAT_SECONDS = 15
+# Polling fallback (no change streams): interval, and how far back each poll looks
+# again for alerts inserted late or by a host with a slightly different clock
+ALERT_POLL_SECONDS = float(os.getenv("ALERT_POLL_SECONDS", "1"))
+POLL_OVERLAP_SECONDS = 5
+# Alerts replayed to a client reconnecting with Last-Event-ID: read REPLAY_LIMIT
+# at a time, at most ALERT_REPLAY_MAX in all before an "overflow" event
+REPLAY_LIMIT = 100
+ALERT_REPLAY_MAX = int(os.getenv("ALERT_REPLAY_MAX", "1000"))
+# Shared with the backend that mints subscription tokens; the stream is refused without it
+ALERT_STREAM_SECRET = os.getenv("ALERT_STREAM_SECRET")
+ALERT_TOKEN_TTL = int(os.getenv("ALERT_TOKEN_TTL", str(12 * 3600)))
+
+ALERT_SUBSCRIBERS = gauge("alert_stream_subscribers", "Open alert stream connections in this worker")
+ALERT_EVENTS = counter("alert_stream_events_total", "Alerts queued to or dropped for stream subscribers", ["outcome"])
+
+class TooManySubscribers(Exception):
+    pass
+
+def _token_signature(secret, role, recipient_id, expires_at):
+    message = f"{(role or '').lower()}:{recipient_id or ''}:{expires_at}"
+    return hmac.new(secret.encode("utf-8"), message.encode("utf-8"), hashlib.sha256).hexdigest()
+
+def sign_subscription(role, recipient_id=None, ttl=ALERT_TOKEN_TTL, secret=None):
+    """
+    Token allowing one subscriber (admin, or a donor's or partner's id) to
+    open the alert stream until it expires: "<expiry>.<HMAC-SHA256>".
+    Minted by the backend that knows who is logged in.
+    """
+    secret = secret or ALERT_STREAM_SECRET
+    if not secret:
+        raise ValueError("ALERT_STREAM_SECRET is not set")
+    expires_at = int(time.time()) + ttl
+    return f"{expires_at}.{_token_signature(secret, role, recipient_id, expires_at)}"
+
+def verify_subscription(token, role, recipient_id=None, secret=None):
+    """True if `token` was signed for this role and id and has not expired."""
+    secret = secret or ALERT_STREAM_SECRET
+    if not secret or not token or "." not in token:
+        return False
+    expires_at, signature = token.split(".", 1)
+    if not expires_at.isdigit() or int(expires_at) < time.time():
+        return False
+    return hmac.compare_digest(signature, _token_signature(secret, role, recipient_id, int(expires_at)))
+
+async def resolve_recipient(db, role, recipient_id=None):
+    """
+    The outbox recipient (email address) a subscriber receives alerts for:
+    the admin address, or a donor's or partner's email. None if unknown.
+    """
+    role = (role or "").lower()
+    if role == "admin":
+        return ADMIN_EMAIL
+    collection = {"donor": "donors", "partner": "partners"}.get(role)
+    if collection is None or not recipient_id or not ObjectId.is_valid(recipient_id):
+        return None
+    doc = await db[collection].find_one({"_id": ObjectId(recipient_id)}, {"email": 1})
+    return doc.get("email") if doc else None
+
+def alert_event(doc):
+    created_at = doc.get("createdAt")
+    return {
+        "id": str(doc["_id"]),
+        "kind": doc.get("kind", "alert"),
+        "subject": doc.get("subject"),
+        "body": doc.get("body"),
+        "createdAt": created_at.isoformat() if isinstance(created_at, datetime) else created_at
+    }
+
+def format_sse(event=None, data=None, event_id=None, comment=None):
+    """One Server-Sent Events frame."""
+    if comment is not None:
+        return f": {comment}\n\n"
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False, default=str)}")
+    return "\n".join(lines) + "\n\n"
+
+class Subscription:
+    """
+    One connection's view of the alert stream: a bounded queue the broker
+    never waits on. When the client reads slower than alerts arrive, the
+    oldest queued alert is dropped and counted, so a stuck connection costs
+    at most `queue_size` alerts of memory and never slows the others.
+    """
+
+    def __init__(self, recipient, kinds=None, queue_size=ALERT_QUEUE_SIZE):
+        self.recipient = recipient
+        self.kinds = set(kinds) if kinds else None
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+
+    def offer(self, event):
+        if self.kinds is not None and event["kind"] not in self.kinds:
+            return
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+            ALERT_EVENTS.inc(outcome="dropped")
+        self.queue.put_nowait(event)
+        ALERT_EVENTS.inc(outcome="queued")
+
+class AlertBroker:
+    """
+    Fans alerts out to the alert stream connections of one API worker.
+
+    Every alert the watchers, the shipment sweep and the duplicate check
+    raise is a notification_outbox insert. One task per worker follows the
+    outbox (a change stream, or polling createdAt on a standalone server) and
+    hands each insert to the subscriptions for its recipient, looked up in a
+    dict, so idle subscribers cost nothing per alert.
+    """
+
+    def __init__(self, db, queue_size=ALERT_QUEUE_SIZE, max_subscribers=ALERT_MAX_SUBSCRIBERS,
+                 poll_interval=ALERT_POLL_SECONDS, heartbeat_seconds=ALERT_HEARTBEAT_SECONDS,
+                 replay_limit=REPLAY_LIMIT, replay_max=ALERT_REPLAY_MAX):
+        self.db = db
+        self.outbox = db[NOTIFICATIONS_COLLECTION]
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.poll_interval = poll_interval
+        self.heartbeat_seconds = heartbeat_seconds
+        self.replay_limit = replay_limit
+        self.replay_max = replay_max
+        self.mode = None
+        self._subscriptions = defaultdict(set)
+        self._count = 0
+        self._task = None
+        self._watermark = None
+        self._seen = {}
+        # Last change stream position, so a reopened stream does not skip the inserts in between
+        self._resume_token = None
+
+    async def start(self):
+        await self.outbox.create_index([("createdAt", ASCENDING)])
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def subscribe(self, recipient, kinds=None):
+        if self._count >= self.max_subscribers:
+            raise TooManySubscribers(f"Alert stream is at its limit of {self.max_subscribers} connections")
+        subscription = Subscription(recipient, kinds, self.queue_size)
+        self._subscriptions[recipient].add(subscription)
+        self._count += 1
+        ALERT_SUBSCRIBERS.set(self._count)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscriptions = self._subscriptions.get(subscription.recipient)
+        if subscriptions is None or subscription not in subscriptions:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self._subscriptions[subscription.recipient]
+        self._count -= 1
+        ALERT_SUBSCRIBERS.set(self._count)
+
+    def publish(self, doc):
+        subscriptions = self._subscriptions.get(doc.get("recipient"))
+        if not subscriptions:
+            return
+        event = alert_event(doc)
+        for subscription in subscriptions:
+            subscription.offer(event)
+
+    async def _run(self):
+        while True:
+            try:
+                try:
+                    await self._follow_stream()
+                except OperationFailure as e:
+                    if e.code in _RESUME_TOKEN_EXPIRED:
+                        print(f"[WARNING] Alert stream: resume token expired ({e}), reopening from now")
+                        self._resume_token = None
+                        continue
+                    if e.code not in _CHANGE_STREAMS_UNSUPPORTED and "replica set" not in str(e).lower():
+                        raise
+                    print(f"[INFO] Alert stream: change streams unavailable ({e}), polling the outbox")
+                    while True:
+                        await self.poll_once()
+                        await asyncio.sleep(self.poll_interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[ERROR] Alert stream: {e}")
+                await asyncio.sleep(self.poll_interval)
+
+    async def _follow_stream(self):
+        options = {"resume_after": self._resume_token} if self._resume_token is not None else {}
+        async with await self.outbox.watch([{"$match": {"operationType": "insert"}}], **options) as stream:
+            self.mode = "change_stream"
+            self._resume_token = stream.resume_token or self._resume_token
+            async for change in stream:
+                self.publish(change["fullDocument"])
+                self._resume_token = stream.resume_token
+
+    async def poll_once(self):
+        """Publish the outbox inserts since the previous poll (polling mode)."""
+        self.mode = "poll"
+        if self._watermark is None:
+            self._watermark = datetime.utcnow()
+        overlap = timedelta(seconds=POLL_OVERLAP_SECONDS)
+        docs = await self.outbox.find({"createdAt": {"$gte": self._watermark - overlap}}).sort("createdAt", ASCENDING).to_list(None)
+        for doc in docs:
+            if doc["_id"] in self._seen:
+                continue
+            self._seen[doc["_id"]] = doc["createdAt"]
+            self.publish(doc)
+        if docs:
+            self._watermark = max(self._watermark, docs[-1]["createdAt"])
+        cutoff = self._watermark - overlap
+        self._seen = {key: created_at for key, created_at in self._seen.items() if created_at >= cutoff}
+        return len(docs)
+
+    async def replay(self, subscription, last_event_id):
+        """Up to `replay_limit` alerts for the subscriber after `last_event_id` (an outbox _id), oldest first."""
+        if not last_event_id or not ObjectId.is_valid(last_event_id):
+            return []
+        query = {"recipient": subscription.recipient, "_id": {"$gt": ObjectId(last_event_id)}}
+        if subscription.kinds is not None:
+            query["kind"] = {"$in": sorted(subscription.kinds)}
+        docs = await self.outbox.find(query).sort("_id", ASCENDING).limit(self.replay_limit).to_list(None)
+        return [alert_event(doc) for doc in docs]
+
+    async def events(self, subscription, last_event_id=None):
+        """
+        The SSE frames for one connection, until the client disconnects.
+        Starts with the alerts missed since `last_event_id`, read page by
+        page. An "overflow" event tells the client alerts were dropped
+        ({"dropped": n}) or the replay stopped at `replay_max`
+        ({"replay_truncated": true, "resume_after": id}); it can reconnect
+        with Last-Event-ID to fetch the rest.
+        """
+        try:
+            yield format_sse(comment="connected")
+            replayed = set()
+            after = last_event_id
+            while True:
+                page = await self.replay(subscription, after)
+                for event in page:
+                    replayed.add(event["id"])
+                    yield format_sse("alert", event, event["id"])
+                if len(page) < self.replay_limit:
+                    break
+                after = page[-1]["id"]
+                if len(replayed) >= self.replay_max:
+                    yield format_sse("overflow", {"replay_truncated": True, "resume_after": after})
+                    break
+            reported = 0
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), self.heartbeat_seconds)
+                except asyncio.TimeoutError:
+                    yield format_sse(comment="keep-alive")
+                    continue
+                if subscription.dropped > reported:
+                    yield format_sse("overflow", {"dropped": subscription.dropped - reported})
+                    reported = subscription.dropped
+                if event["id"] not in replayed:
+                    yield format_sse("alert", event, event["id"])
+        finally:
+            self.unsubscribe(subscription)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mint an alert stream subscription token (needs ALERT_STREAM_SECRET)")
+    parser.add_argument("--role", default="admin", choices=["admin", "donor", "partner"])
+    parser.add_argument("--id", default=None, help="donor or partner _id")
+    parser.add_argument("--ttl", type=int, default=ALERT_TOKEN_TTL, help="seconds the token is valid")
+    args = parser.parse_args()
+    if not ALERT_STREAM_SECRET:
+        parser.error("ALERT_STREAM_SECRET is not set")
+    print(sign_subscription(args.role, args.id, args.ttl))
@@ -1,33 +1,96 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from REC_AGENT.duplicate_checker import DuplicateChecker 
-from REC_AGENT.chatbot_logic import donor_to_partner_handoff_check, handle_beneficiary_delivery_check, send_chatbot_message
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from REC_AGENT.alert_stream import ALERT_STREAM_SECRET, AlertBroker, TooManySubscribers, resolve_recipient, verify_subscription
+from REC_AGENT.services import ReconciliationService
+from REC_AGENT.conversations import FLOWS, WAITING, ConversationConflict, public_view
+from REC_AGENT.db import create_async_client, DB_NAME
+from REC_AGENT.fingerprint_index import FINGERPRINT_SYNC_SECONDS
+from REC_AGENT.near_duplicate_checker import NEAR_DUPLICATE_SYNC_SECONDS
+from REC_AGENT.metrics import CONTENT_TYPE, REGISTRY, counter, histogram
 from bson import ObjectId
-from pymongo import MongoClient
-import os
-from dotenv import load_dotenv
-from fastapi import APIRouter
-from REC_AGENT.partner_to_beneficiary_reschedule import (
-    chatbot_check_delivery_status,
-    reschedule_beneficiary_request,
-    db
-)
-
-app = FastAPI()
-checker = DuplicateChecker()  # You can pass custom DB URI if needed
-
-load_dotenv()
-MONGO_URI = os.getenv("MONGO_URI")
-DB_NAME = os.getenv("DB_NAME", "dkt")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled async client per worker, shared by every request
+    client = create_async_client()
+    app.state.mongo_client = client
+    app.state.db = client[DB_NAME]
+    app.state.service = ReconciliationService(app.state.db)
+    await app.state.service.startup()
+    # Live alerts for dashboards, fanned out from one outbox follower per worker
+    app.state.alerts = AlertBroker(app.state.db)
+    await app.state.alerts.start()
+    # Keeps the incremental duplicate check's fingerprint index current
+    fingerprint_sync = None
+    if FINGERPRINT_SYNC_SECONDS:
+        fingerprint_sync = asyncio.create_task(app.state.service.duplicate_checker.fingerprints.run())
+    # Keeps the near-duplicate signatures current, off the request path
+    signature_sync = None
+    if NEAR_DUPLICATE_SYNC_SECONDS:
+        signature_sync = asyncio.create_task(app.state.service.near_duplicate_checker.signatures.run())
+    try:
+        yield
+    finally:
+        if fingerprint_sync is not None:
+            fingerprint_sync.cancel()
+        if signature_sync is not None:
+            signature_sync.cancel()
+        await app.state.alerts.stop()
+        await client.close()
+
+app = FastAPI(lifespan=lifespan)
+
+REQUEST_SECONDS = histogram("http_request_seconds", "API request latency by route", ["method", "route", "status"])
+REQUEST_ERRORS = counter("http_request_errors_total", "API requests that failed with a 5xx or an exception", ["method", "route"])
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # The route template, not the raw path, keeps the label set small
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        REQUEST_SECONDS.observe(time.perf_counter() - started, method=request.method, route=route, status=status)
+        if status >= 500:
+            REQUEST_ERRORS.inc(method=request.method, route=route)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+def get_db(request: Request):
+    return request.app.state.db
+
+def get_service(request: Request):
+    return request.app.state.service
 
 class AssetRequest(BaseModel):
     asset_id: str
     auto_remove: bool = False
+    mode: str = "aggregate"  # "aggregate" (server-side), "fingerprint" (incremental) or "client"
+
+class BulkAssetRequest(BaseModel):
+    asset_ids: List[str]
+
+class NearDuplicateRequest(BaseModel):
+    upload_ids: Optional[List[str]] = None
+    donor_ids: Optional[List[str]] = None
+    threshold: float = 0.7
+    cross_donor_only: bool = False
 
 class ChatbotRequest(BaseModel):
     asset_id: str
     doner_id: str
-    
+
 class HandoffCheckRequest(BaseModel):
     donor_name: str
     partner_name: str
@@ -39,88 +102,221 @@ class BeneficiaryDeliveryCheckRequest(BaseModel):
 
 class RescheduleRequest(BaseModel):
     shipment_id: int
-    
+
+class BulkRescheduleRequest(BaseModel):
+    shipment_ids: Optional[List[int]] = None
+    filter: Optional[dict] = None  # query over assetsdeleveries, e.g. {"partnerId": ...}
+    require_failed: bool = True  # only reschedule shipments Shiprocket reports as failed
+    limit: int = Field(1000, ge=1, le=10000)  # deliveries per call; more than this many shipment_ids is rejected
+    after: Optional[str] = None  # next_after of the previous page
+
+class ConversationStartRequest(BaseModel):
+    flow: str
+    context: dict = {}
+    recipient_role: Optional[str] = None
+    recipient_id: Optional[str] = None
+    subject: Optional[str] = None
+
+class ConversationReplyRequest(BaseModel):
+    text: str
+
 @app.post("/api/reconciliation/check-duplicates")
-def check_duplicates(req: AssetRequest):
+async def check_duplicates(req: AssetRequest, service: ReconciliationService = Depends(get_service)):
     try:
-        result = checker.check_and_handle_duplicates(req.asset_id, req.auto_remove)
+        result = await service.check_duplicates(req.asset_id, req.auto_remove, req.mode)
         if result["status"] == "not_found":
             raise HTTPException(status_code=404, detail=result["message"])
         return result
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/reconciliation/check-duplicates/bulk")
+async def check_duplicates_bulk(req: BulkAssetRequest, service: ReconciliationService = Depends(get_service)):
+    try:
+        # One aggregation round trip for every upload ID in the request
+        results = await service.check_duplicates_bulk(req.asset_ids)
+        return {"results": results}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    
-    
+
+@app.post("/api/reconciliation/near-duplicates")
+async def near_duplicates(req: NearDuplicateRequest, service: ReconciliationService = Depends(get_service)):
+    try:
+        return await service.find_near_duplicates(
+            upload_ids=req.upload_ids,
+            donor_ids=req.donor_ids,
+            threshold=req.threshold,
+            cross_donor_only=req.cross_donor_only
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/api/chatbot/check-duplicates")
-def chatbot_check_duplicates(req: ChatbotRequest):
+async def chatbot_check_duplicates(req: ChatbotRequest, service: ReconciliationService = Depends(get_service)):
     try:
-        # Import here to avoid circular imports
-        from REC_AGENT.chatbot_logic import handle_duplicate_check
-        
-        # Call the chatbot logic
-        handle_duplicate_check(req.asset_id, req.doner_id)
-        
-        return {"message": "Duplicate check initiated", "status": "success"}
+        result = await service.check_duplicates(req.asset_id, auto_remove=False)
+        if result["status"] != "flagged":
+            return {"message": result["message"], "status": result["status"]}
+
+        # The donor answers through /api/conversations/{id}/reply
+        conversation = await service.conversations.start(
+            "duplicate_check",
+            {"asset_id": req.asset_id, "duplicates": result["duplicates"], "message": result["message"]},
+            recipient={"role": "Donor", "id": req.doner_id}
+        )
+        return {"message": "Duplicate check initiated", "status": "pending", "conversation": public_view(conversation)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/agent/donor-to-partner-handoff-check")
-def donor_to_partner_handoff_api(req: HandoffCheckRequest):
+async def donor_to_partner_handoff_api(req: HandoffCheckRequest, service: ReconciliationService = Depends(get_service)):
     try:
-        # Run the handoff check logic (this will prompt for input in console for now)
-        result = donor_to_partner_handoff_check(
-            req.donor_name,
-            req.partner_name,
-            req.tracking_id,
-            req.committed_quantity
+        conversation = await service.conversations.start(
+            "handoff_quantity",
+            {
+                "from_role": "Donor",
+                "to_role": "Partner",
+                "from_name": req.donor_name,
+                "to_name": req.partner_name,
+                "tracking_id": req.tracking_id,
+                "committed_quantity": req.committed_quantity
+            },
+            recipient={"role": "Partner", "name": req.partner_name},
+            subject=f"handoff_quantity:{req.tracking_id}"
         )
-        return {"status": "success", "received_quantity": result}
+        return {"status": "pending", "conversation": public_view(conversation)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/agent/beneficiary-delivery-check")
-def beneficiary_delivery_check_api(req: BeneficiaryDeliveryCheckRequest):
+async def beneficiary_delivery_check_api(req: BeneficiaryDeliveryCheckRequest, db=Depends(get_db),
+                                         service: ReconciliationService = Depends(get_service)):
     try:
-        client = MongoClient(MONGO_URI)
-        db = client[DB_NAME]
-        request_doc = db["beneficiaryrequests"].find_one({"_id": ObjectId(req.request_id)})
+        if not ObjectId.is_valid(req.request_id):
+            raise HTTPException(status_code=404, detail="BeneficiaryRequest not found")
+        request_doc = await db["beneficiaryrequests"].find_one({"_id": ObjectId(req.request_id)})
         if not request_doc:
             raise HTTPException(status_code=404, detail="BeneficiaryRequest not found")
         if request_doc.get("status") != "Approved" or request_doc.get("assignedDetails", {}).get("status") != "Assigned":
             raise HTTPException(status_code=400, detail="Request not in correct state for delivery check (must be Approved and assignedDetails.status == 'Assigned')")
         committed = len(request_doc.get("assignedDetails", {}).get("assetIds", []))
         beneficiary_name = request_doc.get("fullName", "Beneficiary")
-        received = handle_beneficiary_delivery_check(beneficiary_name, req.request_id, committed)
-        if received != committed:
-            send_chatbot_message(
-                f"🚨 ALERT: Mismatch detected for BeneficiaryRequest {req.request_id}!\n"
-                f"Committed: {committed}, Received: {received}.\n"
-                f"Notifying Partner and Admin."
-            )
-            return {"status": "mismatch", "committed": committed, "received": received}
-        else:
-            send_chatbot_message(
-                f"✅ Thank you! The received quantity matches the committed quantity."
-            )
-            return {"status": "verified", "committed": committed, "received": received}
+        # The mismatch alert / thank-you is sent when the beneficiary replies
+        conversation = await service.conversations.start(
+            "beneficiary_delivery",
+            {
+                "beneficiary_name": beneficiary_name,
+                "request_id": req.request_id,
+                "committed_quantity": committed,
+                "announce_result": True
+            },
+            recipient={"role": "Beneficiary", "id": str(request_doc.get("beneficiaryId") or req.request_id)},
+            subject=f"beneficiary_delivery:{req.request_id}"
+        )
+        return {"status": "pending", "committed": committed, "conversation": public_view(conversation)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/conversations")
+async def start_conversation(req: ConversationStartRequest, service: ReconciliationService = Depends(get_service)):
+    if req.flow not in FLOWS:
+        raise HTTPException(status_code=400, detail=f"Unknown flow '{req.flow}'")
+    missing = FLOWS[req.flow].missing_context(req.context)
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Missing context for flow '{req.flow}': {', '.join(missing)}")
+    recipient = {"role": req.recipient_role, "id": req.recipient_id} if req.recipient_role or req.recipient_id else None
+    try:
+        conversation = await service.conversations.start(req.flow, req.context, recipient=recipient, subject=req.subject)
+        return public_view(conversation)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/conversations")
+async def list_conversations(recipient_id: Optional[str] = None, status: str = WAITING, limit: int = 100,
+                             service: ReconciliationService = Depends(get_service)):
+    conversations = await service.conversations.list(recipient_id=recipient_id, status=status, limit=min(limit, 500))
+    return {"conversations": [public_view(c) for c in conversations]}
 
+@app.get("/api/conversations/{conversation_id}")
+async def get_conversation(conversation_id: str, service: ReconciliationService = Depends(get_service)):
+    conversation = await service.conversations.get(conversation_id)
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return public_view(conversation)
+
+@app.post("/api/conversations/{conversation_id}/reply")
+async def reply_to_conversation(conversation_id: str, req: ConversationReplyRequest,
+                                service: ReconciliationService = Depends(get_service)):
+    try:
+        conversation, sent = await service.conversations.reply(conversation_id, req.text)
+    except ConversationConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    if not sent and conversation["status"] != WAITING:
+        raise HTTPException(status_code=400, detail=f"Conversation is already {conversation['status']}")
+    return {"messages": sent, "conversation": public_view(conversation)}
+
+def authorize_alert_stream(request: Request, role: str = "admin", id: Optional[str] = None, token: Optional[str] = None):
+    """
+    The subscription token (see alert_stream.sign_subscription) must be
+    signed for this role and id. EventSource cannot set headers, so it may
+    come as ?token= as well as Authorization: Bearer.
+    """
+    if not ALERT_STREAM_SECRET:
+        raise HTTPException(status_code=503, detail="Alert stream is not configured (ALERT_STREAM_SECRET)")
+    authorization = request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        token = authorization[7:].strip()
+    if not verify_subscription(token, role, id):
+        raise HTTPException(status_code=401, detail="Missing, invalid or expired alert stream token")
+
+@app.get("/api/alerts/stream", dependencies=[Depends(authorize_alert_stream)])
+async def alert_stream(request: Request, role: str = "admin", id: Optional[str] = None, kinds: Optional[str] = None,
+                       db=Depends(get_db)):
+    """
+    Server-Sent Events stream of the alerts for an admin, donor or partner
+    (`role` and `id`, authorized by a token signed for them), optionally only
+    some `kinds` (comma-separated, e.g. delivery_mismatch,delivery_failed,duplicate).
+    Reconnecting clients send Last-Event-ID and get what they missed.
+    """
+    recipient = await resolve_recipient(db, role, id)
+    if recipient is None:
+        raise HTTPException(status_code=404, detail=f"No {role} with an email address found for this id")
+    broker = request.app.state.alerts
+    try:
+        subscription = broker.subscribe(recipient, [k for k in kinds.split(",") if k] if kinds else None)
+    except TooManySubscribers as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return StreamingResponse(
+        broker.events(subscription, request.headers.get("last-event-id")),
+        media_type="text/event-stream",
+        # No caching, and no buffering in nginx-style proxies
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.post("/api/agent/partner-to-beneficiary-reschedule")
-def partner_to_beneficiary_reschedule(req: RescheduleRequest):
+async def partner_to_beneficiary_reschedule(req: RescheduleRequest, service: ReconciliationService = Depends(get_service)):
     # 1. Find the delivery by shipment_id
-    delivery = db.assetsdeleveries.find_one({"shippingDetails.shipment_id": req.shipment_id})
+    delivery = await service.find_delivery_by_shipment(req.shipment_id)
     if not delivery:
         raise HTTPException(status_code=404, detail="Could not find delivery with the given shipment_id.")
 
-    # 2. Check delivery status
-    status_message = chatbot_check_delivery_status(req.shipment_id)
+    # 2. Check delivery status (Shiprocket call is blocking HTTP)
+    status_message = await service.check_delivery_status(req.shipment_id)
     if "failed" in status_message.lower():
         beneficiary_request_id = delivery.get("beneficeryRequestId")
         partner_id = delivery.get("partnerId")
-        new_request_id = reschedule_beneficiary_request(beneficiary_request_id, partner_id)
+        new_request_id = await service.reschedule_beneficiary_request(beneficiary_request_id, partner_id,
+                                                                    shipment_id=req.shipment_id)
         if new_request_id:
             return {
                 "status": "rescheduled",
@@ -136,7 +332,23 @@ def partner_to_beneficiary_reschedule(req: RescheduleRequest):
             "current_status": status_message
         }
 
+@app.post("/api/agent/partner-to-beneficiary-reschedule/bulk")
+async def partner_to_beneficiary_reschedule_bulk(req: BulkRescheduleRequest, service: ReconciliationService = Depends(get_service)):
+    if not req.shipment_ids and not req.filter:
+        raise HTTPException(status_code=400, detail="Provide shipment_ids or filter.")
+    try:
+        return await service.reschedule_beneficiary_requests_bulk(
+            shipment_ids=req.shipment_ids,
+            delivery_filter=req.filter,
+            require_failed=req.require_failed,
+            limit=req.limit,
+            after=req.after
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("api:app", host="0.0.0.0", port=8000, reload=True)
-    
\ No newline at end of file
@@ -0,0 +1,424 @@
+import argparse
+import asyncio
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from bson import ObjectId
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_results")
+# A median this many times slower than the baseline is reported as a regression
+REGRESSION_THRESHOLD = 1.2
+
+BENCHMARKS = []
+
+def benchmark(name, max_repeat=None):
+    """
+    Register a benchmark. The decorated coroutine does the untimed setup for
+    a BenchContext and returns `async run(i)`, one timed iteration.
+    """
+    def register(setup):
+        BENCHMARKS.append((name, setup, max_repeat))
+        return setup
+    return register
+
+class BenchContext:
+    def __init__(self, db, sync_db, manifest, shiprocket_url, sweep_rate):
+        self.db = db
+        self.sync_db = sync_db
+        self.manifest = manifest
+        self.samples = manifest["samples"]
+        self.shiprocket_url = shiprocket_url
+        self.sweep_rate = sweep_rate
+        self.http = None
+        self.tracking = None
+        # Iterations (warmup included) of the benchmark being set up
+        self.repeat_budget = 0
+
+    def sample(self, name, i, count=1):
+        """`count` items of a sample, rotating with the iteration so each run hits other documents."""
+        items = self.samples[name]
+        if not items:
+            raise RuntimeError(f"The dataset has no {name}; use a larger --scale")
+        return [items[(i * count + k) % len(items)] for k in range(count)]
+
+    def shiprocket_client(self):
+        from REC_AGENT.shiprocket_client import ShiprocketClient
+        return ShiprocketClient(base_url=self.shiprocket_url, email="bench@example.com", password="bench")
+
+    async def post(self, path, body):
+        return _check(await self.http.post(path, json=body))
+
+    async def get(self, path, params=None):
+        return _check(await self.http.get(path, params=params))
+
+def _check(response):
+    if response.status_code >= 400:
+        raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+    return response.json()
+
+# DuplicateChecker
+
+@benchmark("duplicate_checker.aggregate")
+async def bench_duplicate_aggregate(ctx):
+    from REC_AGENT.duplicate_checker import DuplicateChecker
+    checker = DuplicateChecker(db=ctx.db)
+
+    async def run(i):
+        await checker.check_and_handle_duplicates(ctx.sample("upload_ids", i)[0])
+    return run
+
+@benchmark("duplicate_checker.client")
+async def bench_duplicate_client(ctx):
+    from REC_AGENT.duplicate_checker import DuplicateChecker
+    checker = DuplicateChecker(db=ctx.db)
+
+    async def run(i):
+        await checker.check_and_handle_duplicates(ctx.sample("upload_ids", i)[0], mode="client")
+    return run
+
+@benchmark("duplicate_checker.check_many_100")
+async def bench_duplicate_many(ctx):
+    from REC_AGENT.duplicate_checker import DuplicateChecker
+    checker = DuplicateChecker(db=ctx.db)
+
+    async def run(i):
+        await checker.check_many(ctx.sample("upload_ids", i, 100))
+    return run
+
+# Watchers
+
+@benchmark("watcher.enrich_500_cold")
+async def bench_enrich(ctx):
+    from REC_AGENT import delivery_watcher
+    deliveries = list(ctx.sync_db.assetsdeleveries.find(
+        {"status": "Delivered", "deliveryVerification": {"$exists": False}}
+    ).limit(500))
+
+    async def run(i):
+        # Cold name cache: every batch pays for its lookups
+        delivery_watcher._name_cache.clear()
+        await asyncio.to_thread(delivery_watcher.enrich_deliveries, ctx.sync_db, deliveries)
+        await asyncio.to_thread(delivery_watcher.get_committed_quantities_from_requested_products, ctx.sync_db, deliveries)
+    return run
+
+@benchmark("watcher.shipment_sweep_cold", max_repeat=3)
+async def bench_sweep(ctx):
+    from REC_AGENT.shipment_sweep import sweep_failed_deliveries
+    from REC_AGENT.tracking_cache import TRACKING_CACHE_COLLECTION, TrackingCache
+    client = ctx.shiprocket_client()
+
+    async def run(i):
+        # Empty tracking cache: every In-progress shipment is fetched from the fake
+        await asyncio.to_thread(ctx.sync_db[TRACKING_CACHE_COLLECTION].delete_many, {})
+        await sweep_failed_deliveries(ctx.sync_db, client=client, concurrency=32, rate=ctx.sweep_rate,
+                                      notify=False, cache=TrackingCache(ctx.sync_db, client=client))
+    return run
+
+# Reschedule path
+
+@benchmark("reschedule.bulk_100")
+async def bench_reschedule_bulk(ctx):
+    from REC_AGENT.partner_to_beneficiary_reschedule import reschedule_beneficiary_requests_bulk_async
+
+    async def run(i):
+        await reschedule_beneficiary_requests_bulk_async(
+            ctx.db, shipment_ids=ctx.sample("in_progress_shipment_ids", i, 100), require_failed=False
+        )
+    return run
+
+@benchmark("reschedule.bulk_100_failed_only")
+async def bench_reschedule_bulk_failed(ctx):
+    from REC_AGENT.partner_to_beneficiary_reschedule import reschedule_beneficiary_requests_bulk_async
+
+    async def run(i):
+        await reschedule_beneficiary_requests_bulk_async(
+            ctx.db, shipment_ids=ctx.sample("in_progress_shipment_ids", i, 100), require_failed=True,
+            cache=ctx.tracking
+        )
+    return run
+
+# API endpoints, in-process through the ASGI app
+
+@benchmark("api.check_duplicates")
+async def bench_api_check(ctx):
+    async def run(i):
+        await ctx.post("/api/reconciliation/check-duplicates", {"asset_id": ctx.sample("upload_ids", i)[0]})
+    return run
+
+@benchmark("api.check_duplicates_bulk_100")
+async def bench_api_check_bulk(ctx):
+    async def run(i):
+        await ctx.post("/api/reconciliation/check-duplicates/bulk", {"asset_ids": ctx.sample("upload_ids", i, 100)})
+    return run
+
+@benchmark("api.near_duplicates_donor", max_repeat=5)
+async def bench_api_near(ctx):
+    async def run(i):
+        await ctx.post("/api/reconciliation/near-duplicates", {"donor_ids": ctx.sample("donor_ids", i)})
+    return run
+
+@benchmark("api.chatbot_check_duplicates")
+async def bench_api_chatbot(ctx):
+    async def run(i):
+        await ctx.post("/api/chatbot/check-duplicates", {
+            "asset_id": ctx.sample("duplicate_upload_ids", i)[0], "doner_id": ctx.sample("donor_ids", i)[0]
+        })
+    return run
+
+@benchmark("api.handoff_check")
+async def bench_api_handoff(ctx):
+    run_id = ObjectId()
+
+    async def run(i):
+        await ctx.post("/api/agent/donor-to-partner-handoff-check", {
+            "donor_name": "Donor Company", "partner_name": "Partner NGO",
+            "tracking_id": f"BENCH-{run_id}-{i}", "committed_quantity": 3
+        })
+    return run
+
+@benchmark("api.beneficiary_delivery_check")
+async def bench_api_beneficiary(ctx):
+    async def run(i):
+        await ctx.post("/api/agent/beneficiary-delivery-check", {"request_id": ctx.sample("assigned_request_ids", i)[0]})
+    return run
+
+@benchmark("api.conversations_start")
+async def bench_api_conversation_start(ctx):
+    async def run(i):
+        await ctx.post("/api/conversations", {"flow": "handoff_quantity", "context": _handoff_context()})
+    return run
+
+@benchmark("api.conversations_list")
+async def bench_api_conversation_list(ctx):
+    async def run(i):
+        await ctx.get("/api/conversations", {"limit": 100})
+    return run
+
+@benchmark("api.conversations_get")
+async def bench_api_conversation_get(ctx):
+    conversation = await ctx.post("/api/conversations", {"flow": "handoff_quantity", "context": _handoff_context()})
+
+    async def run(i):
+        await ctx.get(f"/api/conversations/{conversation['conversation_id']}")
+    return run
+
+@benchmark("api.conversations_reply")
+async def bench_api_conversation_reply(ctx):
+    # One waiting conversation per iteration; replying completes it
+    conversations = [
+        await ctx.post("/api/conversations", {"flow": "handoff_quantity", "context": _handoff_context()})
+        for i in range(ctx.repeat_budget)
+    ]
+
+    async def run(i):
+        await ctx.post(f"/api/conversations/{conversations[i]['conversation_id']}/reply", {"text": "3"})
+    return run
+
+@benchmark("api.reschedule")
+async def bench_api_reschedule(ctx):
+    async def run(i):
+        await ctx.post("/api/agent/partner-to-beneficiary-reschedule",
+                       {"shipment_id": ctx.sample("in_progress_shipment_ids", i)[0]})
+    return run
+
+@benchmark("api.reschedule_bulk_100")
+async def bench_api_reschedule_bulk(ctx):
+    async def run(i):
+        await ctx.post("/api/agent/partner-to-beneficiary-reschedule/bulk",
+                       {"shipment_ids": ctx.sample("in_progress_shipment_ids", i, 100)})
+    return run
+
+def _handoff_context():
+    return {"from_role": "Donor", "to_role": "Partner", "from_name": "Donor Company",
+            "to_name": "Partner NGO", "tracking_id": f"BENCH-{ObjectId()}", "committed_quantity": 3}
+
+def summarize(timings):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(round(0.95 * (len(timings) - 1))))]
+    return {
+        "runs": len(timings),
+        "min_ms": round(timings[0] * 1000, 3),
+        "median_ms": round(statistics.median(timings) * 1000, 3),
+        "p95_ms": round(p95 * 1000, 3),
+        "mean_ms": round(statistics.fmean(timings) * 1000, 3),
+        "stdev_ms": round(statistics.stdev(timings) * 1000, 3) if len(timings) > 1 else 0.0
+    }
+
+async def run_benchmarks(ctx, only=None, repeat=10, warmup=1, verbose=False):
+    """Run the registered benchmarks (names starting with any of `only`). Returns {name: stats or error}."""
+    results = {}
+    for name, setup, max_repeat in BENCHMARKS:
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        runs = min(repeat, max_repeat or repeat)
+        ctx.repeat_budget = warmup + runs
+        # The code under test prints progress; keep the report readable
+        output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+        try:
+            with output:
+                run = await setup(ctx)
+                timings = []
+                for i in range(warmup + runs):
+                    started = time.perf_counter()
+                    await run(i)
+                    if i >= warmup:
+                        timings.append(time.perf_counter() - started)
+            results[name] = summarize(timings)
+            stats = results[name]
+            print(f"{name:<40} median {stats['median_ms']:>10.2f} ms   p95 {stats['p95_ms']:>10.2f} ms   ({runs} runs)")
+        except Exception as e:
+            results[name] = {"error": f"{type(e).__name__}: {e}"}
+            print(f"{name:<40} ERROR {results[name]['error']}")
+    return results
+
+def git_revision():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+
+def save_results(report, results_dir=RESULTS_DIR):
+    os.makedirs(results_dir, exist_ok=True)
+    stamp = report["timestamp"].replace(":", "").replace("-", "")[:15]
+    commit = (report["commit"] or "nogit")[:10]
+    path = os.path.join(results_dir, f"{stamp}_{commit}_{report['backend']}_{report['scale']}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    return path
+
+def latest_results(backend, scale, exclude=None, results_dir=RESULTS_DIR):
+    """Most recent saved report for the same backend and scale."""
+    paths = sorted(glob.glob(os.path.join(results_dir, f"*_{backend}_{scale}.json")))
+    paths = [p for p in paths if p != exclude]
+    return paths[-1] if paths else None
+
+def compare(report, baseline, threshold=REGRESSION_THRESHOLD):
+    """Print median changes against `baseline`; returns the names that regressed."""
+    print(f"\nCompared with {(baseline.get('commit') or 'unknown')[:10]} ({baseline['timestamp']}):")
+    regressions = []
+    for name, stats in report["benchmarks"].items():
+        before = baseline["benchmarks"].get(name)
+        if "error" in stats or not before or "error" in before:
+            continue
+        ratio = stats["median_ms"] / before["median_ms"] if before["median_ms"] else float("inf")
+        flag = ""
+        if ratio > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 / threshold:
+            flag = "  faster"
+        print(f"{name:<40} {before['median_ms']:>10.2f} -> {stats['median_ms']:>10.2f} ms  x{ratio:.2f}{flag}")
+    return regressions
+
+async def main(args):
+    from REC_AGENT import indexes
+    from REC_AGENT.fake_shiprocket import start_fake_shiprocket
+    from REC_AGENT.synthetic_data import generate_dataset, load_manifest
+    from REC_AGENT.tracking_cache import AsyncTrackingCache, TrackingCache, set_tracking_cache
+
+    client = None
+    if args.backend == "memory":
+        from REC_AGENT.memory_mongo import create_memory_db
+        db = create_memory_db(args.db)
+        sync_db = db.sync
+        # mongomock cannot explain queries
+        indexes.INDEX_CHECK = "off"
+    else:
+        import pymongo
+        from REC_AGENT.db import MONGO_URI, create_async_client
+        uri = args.uri or MONGO_URI
+        client = create_async_client(uri)
+        db = client[args.db]
+        sync_db = pymongo.MongoClient(uri)[args.db]
+
+    manifest = None if args.regenerate or args.backend == "memory" else load_manifest(sync_db)
+    if manifest is None or manifest["scale"] != args.scale or manifest["seed"] != args.seed:
+        print(f"[INFO] Generating ~{args.scale} documents in {args.db} ({args.backend})...")
+        started = time.perf_counter()
+        manifest = await asyncio.to_thread(generate_dataset, sync_db, args.scale, args.seed)
+        print(f"[INFO] Generated {sum(manifest['counts'].values())} documents in {time.perf_counter() - started:.1f}s")
+    else:
+        print(f"[INFO] Reusing the dataset in {args.db} ({sum(manifest['counts'].values())} documents)")
+
+    # Shiprocket is the local fake: failed shipments come back as Undelivered, the rest In Transit
+    server, shiprocket_url = start_fake_shiprocket({
+        "default_sequence": ["In Transit"],
+        "shipments": {str(s): ["Undelivered"] for s in manifest["failed_shipments"]}
+    })
+    ctx = BenchContext(db, sync_db, manifest, shiprocket_url, args.sweep_rate)
+    set_tracking_cache(TrackingCache(sync_db, client=ctx.shiprocket_client()))
+    ctx.tracking = AsyncTrackingCache(db, client=ctx.shiprocket_client())
+
+    import httpx
+    from REC_AGENT.api import app
+    from REC_AGENT.services import ReconciliationService
+    # The ASGI transport does not run the lifespan; wire the app to the benchmark database instead
+    app.state.db = db
+    app.state.service = ReconciliationService(db)
+    app.state.service.tracking = ctx.tracking
+    await app.state.service.startup()
+    # What the lifespan's background sync would have done by now
+    await app.state.service.near_duplicate_checker.signatures.sync()
+    ctx.http = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench")
+    try:
+        results = await run_benchmarks(ctx, only=args.only, repeat=args.repeat, warmup=args.warmup, verbose=args.verbose)
+    finally:
+        await ctx.http.aclose()
+        server.shutdown()
+        if client is not None:
+            await client.close()
+
+    commit, dirty = git_revision()
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": datetime.utcnow().isoformat(timespec="seconds"),
+        "backend": args.backend,
+        "scale": args.scale,
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "python": platform.python_version(),
+        "machine": platform.platform(),
+        "counts": manifest["counts"],
+        "benchmarks": results
+    }
+    path = save_results(report)
+    print(f"\n[INFO] Results saved to {path}")
+
+    baseline_path = args.compare or latest_results(args.backend, args.scale, exclude=path)
+    if baseline_path:
+        with open(baseline_path) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions and args.fail_on_regression:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time REC_AGENT operations against a synthetic dataset")
+    parser.add_argument("--backend", choices=["mongod", "memory"], default="mongod",
+                        help="a local mongod (MONGO_URI / --uri) or the in-memory stand-in (needs mongomock, see requirements-dev.txt)")
+    parser.add_argument("--uri", help="Mongo URI (default: MONGO_URI)")
+    parser.add_argument("--db", default="reconciliation_bench", help="database for the dataset; it is overwritten")
+    parser.add_argument("--scale", type=int, default=10000, help="approximate number of documents (10k to 10M)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--regenerate", action="store_true", help="regenerate even if a matching dataset exists")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--only", nargs="*", help="benchmark name prefixes, e.g. api. duplicate_checker.")
+    parser.add_argument("--sweep-rate", type=float, default=2000, help="Shiprocket calls per second in the sweep")
+    parser.add_argument("--compare", help="report to compare with (default: latest for this backend and scale)")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--fail-on-regression", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="show output of the code under test")
+    sys.exit(asyncio.run(main(parser.parse_args())))
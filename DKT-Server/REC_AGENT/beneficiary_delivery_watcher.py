@@ -1,31 +1,23 @@
 import time
-import pymongo
 from dotenv import load_dotenv
-import os
-from REC_AGENT.chatbot_logic import handle_beneficiary_delivery_check, send_chatbot_message
+from bson import ObjectId
+from REC_AGENT.change_feed import ChangeFeed
+from REC_AGENT.checkpoint_store import open_checkpoint_store
+from REC_AGENT.chatbot_logic import send_chatbot_message
+from REC_AGENT.db import get_sync_db
+from REC_AGENT.conversations import open_conversation, claim_completed_conversations, mark_outcome_handled
+from REC_AGENT.indexes import ensure_indexes, verify_query_plans
+from REC_AGENT.leases import LeaseManager, stable_worker_name
+from REC_AGENT.notifications import ADMIN_EMAIL, NotificationDispatcher, enqueue_many
+from REC_AGENT.metrics import (WATCHER_BATCH_SECONDS, WATCHER_DOCUMENTS, WATCHER_ERRORS, install_mongo_listener,
+                              observe_backlog, start_metrics_server)
 
 # Load environment variables from .env file
 load_dotenv()
-MONGO_URI = os.getenv("MONGO_URI")
-DB_NAME = os.getenv("DB_NAME", "dkt")
 
+# Legacy processed-ID file, imported into the checkpoint store on first run
 PROCESSED_IDS_FILE = "REC_AGENT/processed_beneficiary_deliveries.txt"
-
-def load_processed_ids():
-    if not os.path.exists(PROCESSED_IDS_FILE):
-        os.makedirs(os.path.dirname(PROCESSED_IDS_FILE), exist_ok=True)
-        with open(PROCESSED_IDS_FILE, "w") as f:
-            pass
-    try:
-        with open(PROCESSED_IDS_FILE, "r") as f:
-            return set(line.strip() for line in f)
-    except FileNotFoundError:
-        return set()
-
-def save_processed_id(request_id):
-    os.makedirs(os.path.dirname(PROCESSED_IDS_FILE), exist_ok=True)
-    with open(PROCESSED_IDS_FILE, "a") as f:
-        f.write(f"{request_id}\n")
+FLOW_NAME = "beneficiary_delivery"
 
 def get_committed_quantity(request):
     asset_ids = request.get("assignedDetails", {}).get("assetIds", [])
@@ -38,52 +30,119 @@ def get_partner_id(request):
     return request.get("partnerId", "Unknown Partner")
 
 def get_admin_contact(db):
-    return {"name": "Admin", "email": "admin@dkt.com"}
+    return {"name": "Admin", "email": ADMIN_EMAIL}
+
+def get_partner_emails(db, partner_ids):
+    """Email by partner _id with one $in query; IDs that are not ObjectIds are skipped."""
+    partner_ids = list({p for p in partner_ids if isinstance(p, ObjectId)})
+    if not partner_ids:
+        return {}
+    return {p["_id"]: p.get("email") for p in db["partners"].find({"_id": {"$in": partner_ids}}, {"email": 1})}
 
-def send_alert_to_partner_and_admin(request, committed, received, db):
+def send_alert_to_partner_and_admin(request, committed, received, db, partner_email=None, admin=None):
     partner_id = get_partner_id(request)
-    admin = get_admin_contact(db)
+    admin = admin or get_admin_contact(db)
     send_chatbot_message(
         f"⚠️ It looks like there is a mismatch between what was committed and what you received.\n"
         f"We'll notify the partner ({partner_id}) and admin ({admin['email']}) to resolve this.",
         system=False
     )
-    send_chatbot_message(
-        f"[ALERT] Mismatch for BeneficiaryRequest {request['_id']}: Committed {committed}, Received {received}\nNotify Partner: {partner_id}, Admin: {admin['email']}",
-        system=True
+    alert = f"Mismatch for BeneficiaryRequest {request['_id']}: Committed {committed}, Received {received}"
+    queued = enqueue_many(
+        db, [admin["email"], partner_email],
+        f"Beneficiary delivery mismatch for request {request['_id']}", alert,
+        dedupe_key=f"beneficiary_mismatch:{request['_id']}", kind="beneficiary_mismatch"
     )
+    send_chatbot_message(f"[ALERT] {alert}\n{len(queued)} notification(s) queued for Partner {partner_id} and Admin", system=True)
+
+def open_delivery_conversation(db, request):
+    """Persist the delivery question for the beneficiary; the reply arrives through the API."""
+    req_id = str(request["_id"])
+    conversation, created = open_conversation(
+        db,
+        FLOW_NAME,
+        {
+            "beneficiary_name": get_beneficiary_name(request),
+            "request_id": req_id,
+            "committed_quantity": get_committed_quantity(request)
+        },
+        recipient={"role": "Beneficiary", "id": str(request.get("beneficiaryId") or req_id)},
+        subject=f"{FLOW_NAME}:{req_id}"
+    )
+    if created:
+        send_chatbot_message(conversation["prompt"])
+    return conversation
+
+def process_completed_deliveries(db, worker_id):
+    """
+    Alert or thank for every answered beneficiary delivery conversation this
+    worker claims. Requests and partner emails are loaded once per batch.
+    """
+    conversations = claim_completed_conversations(db, FLOW_NAME, worker_id)
+    if not conversations:
+        return
+    request_ids = [ObjectId(c["context"]["request_id"]) for c in conversations]
+    requests = {r["_id"]: r for r in db["beneficiaryrequests"].find({"_id": {"$in": request_ids}})}
+    partner_emails = get_partner_emails(db, (get_partner_id(r) for r in requests.values()))
+    admin = get_admin_contact(db)
+    for conversation, request_id in zip(conversations, request_ids):
+        result = conversation["result"]
+        request = requests.get(request_id)
+        if request:
+            if result["received"] != result["committed"]:
+                send_alert_to_partner_and_admin(request, result["committed"], result["received"], db,
+                                                partner_email=partner_emails.get(get_partner_id(request)), admin=admin)
+            else:
+                send_chatbot_message("Thank you for confirming! We're glad you received the correct number of assets.")
+        mark_outcome_handled(db, conversation["_id"])
 
 def main():
-    client = pymongo.MongoClient(MONGO_URI)
-    db = client[DB_NAME]
-    processed_ids = load_processed_ids()
-    send_chatbot_message("[Watcher] Starting beneficiary delivery watcher...", system=True)
+    install_mongo_listener()
+    start_metrics_server()
+    db = get_sync_db()
+    # Processed IDs live in an indexed checkpoint store; the old text file is imported once
+    processed = open_checkpoint_store("beneficiary_delivery_watcher", db=db, legacy_file=PROCESSED_IDS_FILE)
+    leases = LeaseManager(db, "beneficiary_delivery_watcher")
+    leases.ensure_indexes()
+    ensure_indexes(db)
+    verify_query_plans(db)
+    NotificationDispatcher(db).start()
+    send_chatbot_message(f"[Watcher] Starting beneficiary delivery watcher {leases.worker_id}...", system=True)
 
-    while True:
+    query = {
+        "status": "Approved",
+        "assignedDetails.status": "Assigned"
+    }
+    feed = ChangeFeed(db, "beneficiaryrequests", query, name=f"beneficiary_delivery_watcher:{stable_worker_name()}")
+    for requests in feed.batches():
+        started = time.perf_counter()
         try:
-            requests = db["beneficiaryrequests"].find({
-                "status": "Approved",
-                "assignedDetails.status": "Assigned"
-            })
+            new_ids = set(processed.filter_new(r["_id"] for r in requests))
+            claimed = set(leases.claim_many(k for k in new_ids))
+            requests = [r for r in requests if str(r["_id"]) in claimed]
+            expired = leases.claim_expired()
+            if expired:
+                requests.extend(db["beneficiaryrequests"].find(dict(query, _id={"$in": [ObjectId(k) for k in expired]})))
+                claimed.update(expired)
             for request in requests:
                 req_id = str(request["_id"])
-                if req_id in processed_ids:
-                    continue
-                committed = get_committed_quantity(request)
-                beneficiary_name = get_beneficiary_name(request)
-                assigned_status = request.get("assignedDetails", {}).get("status")
-                received = handle_beneficiary_delivery_check(beneficiary_name, req_id, committed, assigned_status=assigned_status)
-                if received is None:
-                    continue
-                if received != committed:
-                    send_alert_to_partner_and_admin(request, committed, received, db)
-                else:
-                    send_chatbot_message("Thank you for confirming! We're glad you received the correct number of assets.")
-                save_processed_id(req_id)
-                processed_ids.add(req_id)
+                try:
+                    open_delivery_conversation(db, request)
+                except Exception:
+                    leases.release(req_id)
+                    raise
+                processed.add(req_id)
+            for req_id in claimed:
+                leases.complete(req_id)
+            processed.flush()
+            processed.compact_if_due()
+            process_completed_deliveries(db, leases.worker_id)
+            WATCHER_DOCUMENTS.inc(len(requests), watcher="beneficiary_delivery_watcher")
+            observe_backlog(db, "beneficiary_delivery_watcher", "beneficiaryrequests", query)
         except Exception as e:
+            WATCHER_ERRORS.inc(watcher="beneficiary_delivery_watcher")
             send_chatbot_message(f"[ERROR] Error in beneficiary delivery watcher: {e}", system=True)
-        time.sleep(30)
+        WATCHER_BATCH_SECONDS.observe(time.perf_counter() - started, watcher="beneficiary_delivery_watcher")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,166 @@
+import time
+from datetime import datetime
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure, PyMongoError
+
+# Resume tokens and updatedAt watermarks, one document per watcher
+WATCHER_STATE_COLLECTION = "watcher_state"
+
+# Server errors meaning change streams cannot be used on this deployment
+# (standalone server, or a build/tier without $changeStream)
+_CHANGE_STREAMS_UNSUPPORTED = {40573, 40324, 115}
+# The resume token fell off the oplog; resume from a catch-up scan instead
+_RESUME_TOKEN_EXPIRED = {280, 286}
+# Seconds between attempts to reopen the stream after a connection error, doubling up to the max
+RECONNECT_SECONDS = 1
+RECONNECT_MAX_SECONDS = 60
+
+class ChangeFeed:
+    """
+    Yields batches of documents from `collection` that currently match
+    `query`, as they change.
+
+    With change streams available, one stream is opened with the query
+    applied to fullDocument, and its resume token is stored in watcher_state
+    after each batch is handled, so a restart continues exactly where the
+    last run stopped. Otherwise (standalone server) the collection is polled
+    for documents with updatedAt past the stored watermark, which only reads
+    what changed since the previous poll.
+
+    Batches are at-least-once: the position is only saved when the consumer
+    asks for the next batch, so handlers must be idempotent. An empty batch
+    is yielded when nothing changed for `idle_seconds`, so the consumer can
+    run periodic work; a busy stream yields at least every
+    `max_batch_seconds`. Connection errors (Mongo down, failover) are
+    retried with backoff, reopening the stream from the saved resume token.
+    """
+
+    def __init__(self, db, collection_name, query, name=None, idle_seconds=5, poll_interval=30, batch_size=500,
+                 max_batch_seconds=1):
+        self.db = db
+        self.collection = db[collection_name]
+        self.query = query
+        self.name = name or collection_name
+        self.idle_seconds = idle_seconds
+        self.max_batch_seconds = max_batch_seconds
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.state = db[WATCHER_STATE_COLLECTION]
+        self.mode = None
+
+    def _load_state(self):
+        return self.state.find_one({"_id": self.name}) or {}
+
+    def _save_state(self, **fields):
+        fields["updatedAt"] = datetime.utcnow()
+        self.state.update_one({"_id": self.name}, {"$set": fields}, upsert=True)
+
+    def _stream_pipeline(self):
+        match = {"operationType": {"$in": ["insert", "update", "replace"]}}
+        for field, condition in self.query.items():
+            match[f"fullDocument.{field}"] = condition
+        return [{"$match": match}]
+
+    def batches(self):
+        backoff = RECONNECT_SECONDS
+        while True:
+            try:
+                for batch in self._stream_batches():
+                    backoff = RECONNECT_SECONDS
+                    yield batch
+                return
+            except OperationFailure as e:
+                if e.code in _RESUME_TOKEN_EXPIRED:
+                    print(f"[WARNING] {self.name}: resume token expired, catching up with a full scan")
+                    self._save_state(resumeToken=None)
+                    continue
+                if e.code in _CHANGE_STREAMS_UNSUPPORTED or "replica set" in str(e).lower():
+                    print(f"[INFO] {self.name}: change streams unavailable ({e}), polling updatedAt instead")
+                    yield from self._poll_batches()
+                    return
+                error = e
+            except PyMongoError as e:
+                error = e
+            # Outage or failover: reopen from the last saved resume token, which
+            # catches up on everything that changed in between
+            print(f"[ERROR] {self.name}: change stream failed ({error}), reopening in {backoff}s")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, RECONNECT_MAX_SECONDS)
+
+    def _stream_batches(self):
+        token = self._load_state().get("resumeToken")
+        with self.collection.watch(
+            self._stream_pipeline(),
+            full_document="updateLookup",
+            resume_after=token,
+            max_await_time_ms=int(self.idle_seconds * 1000),
+            batch_size=self.batch_size
+        ) as stream:
+            self.mode = "change_stream"
+            if token is None:
+                # First run (or lost position): the stream is open, so nothing
+                # changed from here on is missed while the backlog is scanned
+                yield from self._scan_all()
+                self._save_state(resumeToken=stream.resume_token)
+            while stream.alive:
+                batch = []
+                change = stream.try_next()
+                # try_next returns buffered changes at once and waits at most
+                # idle_seconds for new ones; stop at the size or time limit
+                deadline = time.monotonic() + self.max_batch_seconds
+                while change is not None:
+                    if change.get("fullDocument") is not None:
+                        batch.append(change["fullDocument"])
+                    if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                        break
+                    change = stream.try_next()
+                yield batch
+                self._save_state(resumeToken=stream.resume_token)
+
+    def _scan_all(self):
+        batch = []
+        for document in self.collection.find(self.query).batch_size(self.batch_size):
+            batch.append(document)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _poll_batches(self):
+        self.mode = "poll"
+        self.collection.create_index([("updatedAt", ASCENDING), ("_id", ASCENDING)])
+        state = self._load_state()
+        watermark, last_id = state.get("watermark"), state.get("watermarkId")
+        while True:
+            query = dict(self.query)
+            if watermark is not None:
+                query["$or"] = [
+                    {"updatedAt": {"$gt": watermark}},
+                    {"updatedAt": watermark, "_id": {"$gt": last_id}}
+                ]
+            elif last_id is not None:
+                # Still among the documents without updatedAt (they sort first)
+                query["$or"] = [
+                    {"updatedAt": None, "_id": {"$gt": last_id}},
+                    {"updatedAt": {"$ne": None}}
+                ]
+            try:
+                batch = list(
+                    self.collection.find(query)
+                    .sort([("updatedAt", ASCENDING), ("_id", ASCENDING)])
+                    .limit(self.batch_size)
+                )
+            except PyMongoError as e:
+                print(f"[ERROR] {self.name}: poll failed: {e}")
+                batch = []
+            yield batch
+            moved = False
+            if batch:
+                last = batch[-1]
+                position = (last.get("updatedAt"), last["_id"])
+                moved = position != (watermark, last_id)
+                watermark, last_id = position
+                self._save_state(watermark=watermark, watermarkId=last_id)
+            if len(batch) < self.batch_size or not moved:
+                time.sleep(self.poll_interval)
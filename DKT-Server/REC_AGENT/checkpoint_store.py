@@ -0,0 +1,238 @@
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, UpdateOne
+
+CHECKPOINT_BACKEND = os.getenv("CHECKPOINT_BACKEND", "sqlite")  # "sqlite" or "mongo"
+CHECKPOINT_DB_PATH = os.getenv("CHECKPOINT_DB_PATH", "REC_AGENT/checkpoints.sqlite3")
+CHECKPOINTS_COLLECTION = "watcher_checkpoints"
+# Entries older than this are dropped by compact(), which the watchers run every CHECKPOINT_COMPACT_SECONDS
+CHECKPOINT_RETENTION_DAYS = int(os.getenv("CHECKPOINT_RETENTION_DAYS", "90"))
+CHECKPOINT_COMPACT_SECONDS = float(os.getenv("CHECKPOINT_COMPACT_SECONDS", str(24 * 3600)))
+
+class CheckpointStore:
+    """
+    Set of processed IDs per watcher (`namespace`), kept in an indexed store
+    instead of a text file loaded into memory. Membership is an index lookup,
+    so startup does not depend on how much has been processed.
+
+    add() buffers; buffered IDs are written in one transaction / bulk write
+    by flush(), or automatically once `batch_size` are pending. Buffered IDs
+    count as processed for contains()/filter_new().
+    """
+
+    def __init__(self, namespace, batch_size=500):
+        self.namespace = namespace
+        self.batch_size = batch_size
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._next_compact = 0.0
+
+    def contains(self, key):
+        return not self.filter_new([key])
+
+    def filter_new(self, keys):
+        """The keys (in order) that have not been processed yet."""
+        keys = [str(k) for k in keys]
+        with self._lock:
+            candidates = [k for k in keys if k not in self._pending]
+        if not candidates:
+            return []
+        seen = self._lookup(set(candidates))
+        return [k for k in candidates if k not in seen]
+
+    def add(self, key):
+        self.add_many([key])
+
+    def add_many(self, keys):
+        with self._lock:
+            self._pending.update(str(k) for k in keys)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, set()
+        if pending:
+            try:
+                self._write(pending)
+            except Exception:
+                with self._lock:
+                    self._pending.update(pending)
+                raise
+
+    def compact(self, older_than_days=CHECKPOINT_RETENTION_DAYS):
+        """
+        Drop entries processed more than `older_than_days` ago. Safe for the
+        watchers: old deliveries no longer match their queries, and reopening a
+        conversation for the same subject is a no-op.
+        """
+        self.flush()
+        return self._delete_before(datetime.utcnow() - timedelta(days=older_than_days))
+
+    def compact_if_due(self, interval=CHECKPOINT_COMPACT_SECONDS):
+        """compact() on the first call and then at most once per `interval` seconds."""
+        now = time.monotonic()
+        if now < self._next_compact:
+            return 0
+        self._next_compact = now + interval
+        deleted = self.compact()
+        if deleted:
+            print(f"[INFO] Compacted {deleted} checkpoint(s) of {self.namespace}")
+        return deleted
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Backend hooks
+    def _lookup(self, keys):
+        raise NotImplementedError
+
+    def _write(self, keys):
+        raise NotImplementedError
+
+    def _delete_before(self, cutoff):
+        raise NotImplementedError
+
+class SQLiteCheckpointStore(CheckpointStore):
+    """
+    Embedded backend: one B-tree table keyed by (namespace, key). WAL mode
+    with synchronous=FULL, so a committed batch survives a crash or power loss.
+    """
+
+    def __init__(self, namespace, path=CHECKPOINT_DB_PATH, batch_size=500):
+        super().__init__(namespace, batch_size)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        with self._db_lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=FULL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS processed ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, processed_at TEXT NOT NULL,"
+                " PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS processed_at ON processed (namespace, processed_at)")
+
+    def _lookup(self, keys):
+        seen = set()
+        keys = list(keys)
+        # Stay under SQLite's bound-parameter limit
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            with self._db_lock:
+                rows = self.conn.execute(
+                    f"SELECT key FROM processed WHERE namespace = ? AND key IN ({','.join('?' * len(chunk))})",
+                    [self.namespace] + chunk
+                ).fetchall()
+            seen.update(row[0] for row in rows)
+        return seen
+
+    def _write(self, keys):
+        now = datetime.utcnow().isoformat()
+        with self._db_lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO processed (namespace, key, processed_at) VALUES (?, ?, ?)",
+                [(self.namespace, k, now) for k in keys]
+            )
+
+    def _delete_before(self, cutoff):
+        with self._db_lock:
+            with self.conn:
+                deleted = self.conn.execute(
+                    "DELETE FROM processed WHERE namespace = ? AND processed_at < ?",
+                    (self.namespace, cutoff.isoformat())
+                ).rowcount
+            self.conn.execute("VACUUM")
+        return deleted
+
+    def close(self):
+        super().close()
+        with self._db_lock:
+            self.conn.close()
+
+class MongoCheckpointStore(CheckpointStore):
+    """Shared backend for watchers on several hosts: one document per processed ID."""
+
+    def __init__(self, namespace, db, batch_size=500):
+        super().__init__(namespace, batch_size)
+        self.collection = db[CHECKPOINTS_COLLECTION]
+        self.collection.create_index([("namespace", ASCENDING), ("key", ASCENDING)], unique=True)
+        self.collection.create_index([("namespace", ASCENDING), ("processedAt", ASCENDING)])
+
+    def _lookup(self, keys):
+        return {
+            row["key"] for row in self.collection.find(
+                {"namespace": self.namespace, "key": {"$in": list(keys)}}, {"key": 1, "_id": 0}
+            )
+        }
+
+    def _write(self, keys):
+        now = datetime.utcnow()
+        self.collection.bulk_write([
+            UpdateOne(
+                {"namespace": self.namespace, "key": k},
+                {"$setOnInsert": {"processedAt": now}},
+                upsert=True
+            )
+            for k in keys
+        ], ordered=False)
+
+    def _delete_before(self, cutoff):
+        return self.collection.delete_many({"namespace": self.namespace, "processedAt": {"$lt": cutoff}}).deleted_count
+
+def import_legacy_file(store, path):
+    """
+    One-time import of a processed_*.txt file. The file is renamed to
+    <path>.migrated afterwards so it is not read again.
+    """
+    if not os.path.exists(path):
+        return 0
+    count = 0
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                store.add(line.strip())
+                count += 1
+    store.flush()
+    os.replace(path, path + ".migrated")
+    print(f"[INFO] Imported {count} processed IDs from {path}")
+    return count
+
+def open_checkpoint_store(namespace, db=None, backend=None, legacy_file=None):
+    """Checkpoint store for a watcher, using CHECKPOINT_BACKEND unless `backend` is given."""
+    backend = backend or CHECKPOINT_BACKEND
+    if backend == "mongo":
+        if db is None:
+            from REC_AGENT.db import get_sync_db
+            db = get_sync_db()
+        store = MongoCheckpointStore(namespace, db)
+    elif backend == "sqlite":
+        store = SQLiteCheckpointStore(namespace)
+    else:
+        raise ValueError(f"Unknown checkpoint backend '{backend}'")
+    if legacy_file:
+        import_legacy_file(store, legacy_file)
+    return store
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drop old entries from the watcher checkpoint stores")
+    parser.add_argument("namespaces", nargs="+", help="watcher namespaces, e.g. delivery_watcher")
+    parser.add_argument("--older-than-days", type=int, default=CHECKPOINT_RETENTION_DAYS)
+    parser.add_argument("--backend", choices=["sqlite", "mongo"], default=None)
+    args = parser.parse_args()
+    for namespace in args.namespaces:
+        with open_checkpoint_store(namespace, backend=args.backend) as store:
+            print(f"[INFO] {namespace}: {store.compact(args.older_than_days)} checkpoint(s) removed")
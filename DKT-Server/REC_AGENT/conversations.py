@@ -0,0 +1,501 @@
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, ReturnDocument
+
+CONVERSATIONS_COLLECTION = "chatbot_conversations"
+# Invalid replies allowed per prompt before the conversation is given up
+MAX_ATTEMPTS = 3
+# A reply being applied holds the conversation this long; after that (the API
+# worker died mid-reply) the conversation takes replies again
+PROCESSING_TIMEOUT_SECONDS = 300
+
+WAITING = "waiting"
+COMPLETED = "completed"
+FAILED = "failed"
+# A reply is being applied; other replies get a conflict
+PROCESSING = "processing"
+
+class InvalidReply(Exception):
+    """Raised by a flow when a reply can't be used; the message is sent back to the user."""
+
+class ConversationConflict(Exception):
+    """The conversation changed while a reply was being applied (concurrent reply)."""
+
+def say(text, system=False):
+    return {"text": text, "system": system}
+
+def parse_quantity(reply, error_message="Invalid input. Please enter a number."):
+    try:
+        return int(str(reply).strip())
+    except ValueError:
+        raise InvalidReply(error_message)
+
+class Step:
+    """
+    Outcome of feeding one reply to a flow: messages to send, and either the
+    next state/prompt to wait on or the final result.
+    """
+
+    def __init__(self, messages=None, state=None, prompt=None, result=None, done=False, context=None):
+        self.messages = messages or []
+        self.state = state
+        self.prompt = prompt
+        self.result = result
+        self.done = done
+        self.context = context or {}
+
+class Flow:
+    """
+    A conversation as a state machine. start() is pure and returns the first
+    (state, prompt). handle() receives the reply for the current state and
+    returns a Step; it may await I/O through `effects` (see
+    ReconciliationService) and raises InvalidReply for unusable input.
+    `required_context` lists the context keys start() and handle() read.
+    """
+    name = None
+    required_context = ()
+
+    def missing_context(self, context):
+        return [key for key in self.required_context if key not in context]
+
+    def start(self, context):
+        raise NotImplementedError
+
+    async def handle(self, state, context, reply, effects):
+        raise NotImplementedError
+
+class CommitmentVsDeliveryFlow(Flow):
+    """Partner confirms how many units arrived for a Delivered asset delivery."""
+    name = "commitment_vs_delivery"
+    required_context = ("partner_name", "tracking_id", "committed_quantity")
+
+    def start(self, context):
+        return "awaiting_quantity", (
+            f"Hello {context['partner_name']}, your delivery with tracking ID {context['tracking_id']} has been marked as Delivered.\n"
+            f"We need to verify the delivery. How many units did you actually receive? (Committed: {context['committed_quantity']})"
+        )
+
+    async def handle(self, state, context, reply, effects):
+        received_quantity = parse_quantity(reply, "❌ Invalid input. Please enter a valid number.")
+        partner_name = context["partner_name"]
+        tracking_id = context["tracking_id"]
+        committed_quantity = context["committed_quantity"]
+
+        if received_quantity != committed_quantity:
+            messages = [
+                say(
+                    f"🚨 **COMMITMENT vs DELIVERY MISMATCH ALERT** 🚨\n\n"
+                    f"**Delivery Details:**\n"
+                    f"• Tracking ID: {tracking_id}\n"
+                    f"• Partner: {partner_name}\n"
+                    f"• Committed Quantity: {committed_quantity}\n"
+                    f"• Received Quantity: {received_quantity}\n"
+                    f"• Mismatch: {abs(committed_quantity - received_quantity)} units\n\n"
+                    f"**Action Required:**\n"
+                    f"An alert has been sent to the Admin and Donor for investigation."
+                ),
+                say(
+                    f"[ALERT] Admin/Donor: Mismatch for delivery {tracking_id}\n"
+                    f"Committed: {committed_quantity}, Received: {received_quantity}\n"
+                    f"Partner: {partner_name}",
+                    system=True
+                )
+            ]
+            return Step(messages, done=True, result={
+                "status": "mismatch",
+                "committed_quantity": committed_quantity,
+                "received_quantity": received_quantity,
+                "mismatch": abs(committed_quantity - received_quantity)
+            })
+
+        messages = [
+            say(
+                f"✅ **Delivery Verification Successful** ✅\n\n"
+                f"Thank you {partner_name}! The received quantity ({received_quantity}) "
+                f"matches the committed quantity ({committed_quantity}).\n\n"
+                f"Delivery {tracking_id} has been verified successfully."
+            ),
+            say(
+                f"[INFO] Admin/Donor: Delivery {tracking_id} successfully verified\n"
+                f"Quantity: {committed_quantity}, Partner: {partner_name}",
+                system=True
+            )
+        ]
+        return Step(messages, done=True, result={
+            "status": "verified",
+            "committed_quantity": committed_quantity,
+            "received_quantity": received_quantity,
+            "mismatch": 0
+        })
+
+class HandoffQuantityFlow(Flow):
+    """Generic handoff quantity check between any two roles (e.g. Donor -> Partner)."""
+    name = "handoff_quantity"
+    required_context = ("to_name", "from_role", "from_name", "tracking_id", "committed_quantity")
+
+    def start(self, context):
+        return "awaiting_quantity", (
+            f"Hello {context['to_name']}, your delivery from {context['from_role']} '{context['from_name']}' "
+            f"with tracking ID {context['tracking_id']} has been marked as Delivered.\n"
+            f"How many units did you actually receive? (Committed: {context['committed_quantity']})"
+        )
+
+    async def handle(self, state, context, reply, effects):
+        received_quantity = parse_quantity(reply)
+        from_role = context["from_role"]
+        tracking_id = context["tracking_id"]
+        committed_quantity = context["committed_quantity"]
+
+        if received_quantity != committed_quantity:
+            messages = [
+                say(
+                    f"🚨 ALERT: Mismatch detected! Committed: {committed_quantity}, Received: {received_quantity}.\n"
+                    f"Notifying {from_role} and Admin."
+                ),
+                say(f"[ALERT] {from_role}/Admin: Mismatch for delivery {tracking_id} (Committed: {committed_quantity}, Received: {received_quantity})", system=True)
+            ]
+            status = "mismatch"
+        else:
+            messages = [
+                say("✅ Thank you! The received quantity matches the committed quantity."),
+                say(f"[INFO] {from_role}/Admin: Delivery {tracking_id} successfully verified (Quantity: {committed_quantity})", system=True)
+            ]
+            status = "verified"
+        return Step(messages, done=True, result={
+            "status": status,
+            "committed_quantity": committed_quantity,
+            "received_quantity": received_quantity
+        })
+
+class BeneficiaryDeliveryFlow(Flow):
+    """Beneficiary confirms how many assets arrived for an Assigned request."""
+    name = "beneficiary_delivery"
+    required_context = ("beneficiary_name", "request_id", "committed_quantity")
+
+    def start(self, context):
+        return "awaiting_quantity", (
+            f"Hi {context['beneficiary_name']}! We've marked your request {context['request_id']} as assigned.\n"
+            f"How many assets did you actually receive? (We expected to deliver {context['committed_quantity']}.)"
+        )
+
+    async def handle(self, state, context, reply, effects):
+        received = parse_quantity(reply)
+        committed = context["committed_quantity"]
+        status = "mismatch" if received != committed else "verified"
+        messages = []
+        if context.get("announce_result"):
+            if status == "mismatch":
+                messages.append(say(
+                    f"🚨 ALERT: Mismatch detected for BeneficiaryRequest {context['request_id']}!\n"
+                    f"Committed: {committed}, Received: {received}.\n"
+                    f"Notifying Partner and Admin."
+                ))
+            else:
+                messages.append(say("✅ Thank you! The received quantity matches the committed quantity."))
+        return Step(messages, done=True, result={"status": status, "committed": committed, "received": received})
+
+class DuplicateResolutionFlow(Flow):
+    """Donor chooses between auto-removing flagged duplicates and re-uploading."""
+    name = "duplicate_check"
+    required_context = ("asset_id", "duplicates", "message")
+
+    def start(self, context):
+        return "awaiting_choice", (
+            f"🚨 **Duplicate Detection Alert** 🚨\n\n"
+            f"We found duplicate product IDs in your uploaded products:\n"
+            f"• Duplicate indices: {context['duplicates']}\n"
+            f"• Message: {context['message']}\n\n"
+            f"**What would you like to do?**\n"
+            f"1. Remove duplicates automatically\n"
+            f"2. Upload a corrected product list"
+        )
+
+    async def handle(self, state, context, reply, effects):
+        if reply.strip().lower() in ["1", "auto", "remove", "yes", "automatically"]:
+            await effects.check_duplicates(context["asset_id"], auto_remove=True)
+            return Step(
+                [say("✅ Duplicates have been automatically removed. Your product list is now clean!")],
+                done=True, result={"action": "auto_removed"}
+            )
+        return Step(
+            [say("📁 Please upload a corrected product list without duplicates.")],
+            done=True, result={"action": "reupload"}
+        )
+
+class PartnerToBeneficiaryRescheduleFlow(Flow):
+    """
+    Admin checks a Shiprocket shipment and, if the delivery failed,
+    reschedules the beneficiary request to the same partner.
+    """
+    name = "partner_to_beneficiary_reschedule"
+
+    def start(self, context):
+        return "awaiting_shipment_id", "Please provide the Shiprocket shipment ID to check delivery status:"
+
+    async def handle(self, state, context, reply, effects):
+        if state == "awaiting_shipment_id":
+            try:
+                shipment_id = int(reply.strip())
+            except ValueError:
+                raise InvalidReply("Invalid shipment ID. Please enter the numeric Shiprocket shipment ID.")
+            status_message = await effects.check_delivery_status(shipment_id)
+            if "failed" not in status_message.lower():
+                return Step([say(status_message)], done=True, result={"status": "ok", "current_status": status_message})
+            delivery = await effects.find_delivery_by_shipment(shipment_id)
+            if not delivery:
+                return Step(
+                    [say(status_message), say("❌ Could not find a delivery with that shipment ID.")],
+                    done=True, result={"status": "not_found"}
+                )
+            beneficiary_request_id = str(delivery.get("beneficeryRequestId"))
+            partner_id = str(delivery.get("partnerId"))
+            prompt = (
+                f"Found Beneficiary Request ID: {beneficiary_request_id}\n"
+                f"Found Partner ID: {partner_id}\n"
+                "Would you like to reschedule this delivery request to the same partner? (yes/no)"
+            )
+            return Step(
+                [say(status_message)], state="awaiting_confirmation", prompt=prompt,
+                context={"shipment_id": shipment_id, "beneficiary_request_id": beneficiary_request_id, "partner_id": partner_id}
+            )
+
+        if reply.strip().lower() in ["yes", "y"]:
+            new_request_id = await effects.reschedule_beneficiary_request(
+                context["beneficiary_request_id"], context["partner_id"], shipment_id=context.get("shipment_id"))
+            if new_request_id:
+                return Step(
+                    [say(f"✅ Rescheduled! New Beneficiary Request ID: {new_request_id}")],
+                    done=True, result={"status": "rescheduled", "new_request_id": str(new_request_id)}
+                )
+            return Step([say("❌ Failed to reschedule. Please check the provided IDs.")], done=True, result={"status": "error"})
+        return Step([say("Reschedule cancelled.")], done=True, result={"status": "cancelled"})
+
+FLOWS = {flow.name: flow for flow in [
+    CommitmentVsDeliveryFlow(),
+    HandoffQuantityFlow(),
+    BeneficiaryDeliveryFlow(),
+    DuplicateResolutionFlow(),
+    PartnerToBeneficiaryRescheduleFlow(),
+]}
+
+def _message(sender, text, system=False):
+    return {"from": sender, "text": text, "system": system, "at": datetime.utcnow()}
+
+def new_conversation(flow_name, context, recipient=None, subject=None):
+    """
+    Build a conversation document with its first prompt. `subject` (e.g.
+    "commitment_vs_delivery:<deliveryId>") makes opening idempotent.
+    """
+    state, prompt = FLOWS[flow_name].start(context)
+    now = datetime.utcnow()
+    return {
+        "_id": ObjectId(),
+        "flow": flow_name,
+        "subject": subject,
+        "recipient": recipient or {},
+        "state": state,
+        "prompt": prompt,
+        "context": context,
+        "messages": [_message("bot", prompt)],
+        "attempts": 0,
+        "status": WAITING,
+        "result": None,
+        "version": 0,
+        "createdAt": now,
+        "updatedAt": now
+    }
+
+async def apply_reply(conversation, text, effects=None):
+    """
+    Feed one reply to a waiting conversation and return the updated document
+    (not persisted). Returns the messages sent in response as well.
+    """
+    flow = FLOWS[conversation["flow"]]
+    conversation = dict(conversation)
+    conversation["messages"] = list(conversation["messages"]) + [_message("user", text)]
+    try:
+        step = await flow.handle(conversation["state"], conversation["context"], text, effects)
+    except InvalidReply as e:
+        conversation["attempts"] += 1
+        if conversation["attempts"] >= MAX_ATTEMPTS:
+            sent = [say("Too many invalid replies. An admin will follow up with you.")]
+            conversation["status"] = FAILED
+        else:
+            sent = [say(str(e)), say(conversation["prompt"])]
+    else:
+        sent = step.messages
+        conversation["context"] = dict(conversation["context"], **step.context)
+        conversation["attempts"] = 0
+        if step.done:
+            conversation["status"] = COMPLETED
+            conversation["result"] = step.result
+        else:
+            conversation["state"] = step.state
+            conversation["prompt"] = step.prompt
+            sent = sent + [say(step.prompt)]
+    conversation["messages"] += [_message("bot", m["text"], m["system"]) for m in sent]
+    conversation["updatedAt"] = datetime.utcnow()
+    return conversation, sent
+
+def public_view(conversation):
+    """JSON-friendly view of a conversation for the API."""
+    return {
+        "conversation_id": str(conversation["_id"]),
+        "flow": conversation["flow"],
+        "subject": conversation.get("subject"),
+        "recipient": conversation.get("recipient", {}),
+        "status": conversation["status"],
+        "prompt": conversation["prompt"] if conversation["status"] == WAITING else None,
+        "result": conversation.get("result"),
+        "messages": [
+            {"from": m["from"], "text": m["text"], "at": m["at"].isoformat()}
+            for m in conversation["messages"] if not m.get("system")
+        ],
+        "updated_at": conversation["updatedAt"].isoformat()
+    }
+
+class ConversationEngine:
+    """
+    Persisted, resumable conversations. Each conversation is one document;
+    no thread or coroutine waits on a reply, so any number can be open at
+    once. A reply first claims the conversation (WAITING -> PROCESSING,
+    checked on `version`), so its side effects run for one reply only.
+    """
+
+    def __init__(self, db, effects=None):
+        self.collection = db[CONVERSATIONS_COLLECTION]
+        self.effects = effects
+
+    async def ensure_indexes(self):
+        await self.collection.create_index(
+            [("subject", ASCENDING)], unique=True,
+            partialFilterExpression={"subject": {"$type": "string"}}
+        )
+        await self.collection.create_index([("recipient.id", ASCENDING), ("status", ASCENDING)])
+        await self.collection.create_index([("flow", ASCENDING), ("status", ASCENDING), ("outcomeHandled", ASCENDING)])
+
+    async def start(self, flow_name, context, recipient=None, subject=None):
+        conversation = new_conversation(flow_name, context, recipient, subject)
+        if subject is None:
+            await self.collection.insert_one(conversation)
+            return conversation
+        # Re-opening the same subject returns the existing conversation
+        return await self.collection.find_one_and_update(
+            {"subject": subject},
+            {"$setOnInsert": conversation},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def get(self, conversation_id):
+        if not ObjectId.is_valid(conversation_id):
+            return None
+        return await self.collection.find_one({"_id": ObjectId(conversation_id)})
+
+    async def list(self, recipient_id=None, status=WAITING, limit=100):
+        query = {"status": status}
+        if recipient_id:
+            query["recipient.id"] = recipient_id
+        cursor = self.collection.find(query).sort("updatedAt", ASCENDING).limit(limit)
+        return await cursor.to_list(length=limit)
+
+    async def reply(self, conversation_id, text):
+        conversation = await self.get(conversation_id)
+        if conversation is None:
+            return None, []
+        stale = datetime.utcnow() - timedelta(seconds=PROCESSING_TIMEOUT_SECONDS)
+        if conversation["status"] == PROCESSING and conversation.get("processingSince", stale) >= stale:
+            raise ConversationConflict(f"Conversation {conversation_id} is handling another reply")
+        if conversation["status"] not in (WAITING, PROCESSING):
+            return conversation, []
+
+        # Claim before running the flow: its effects (rescheduling, auto-remove) must not run twice
+        claimed = await self.collection.find_one_and_update(
+            {
+                "_id": conversation["_id"],
+                "version": conversation["version"],
+                "$or": [{"status": WAITING}, {"status": PROCESSING, "processingSince": {"$lt": stale}}]
+            },
+            {"$inc": {"version": 1}, "$set": {"status": PROCESSING, "processingSince": datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER
+        )
+        if claimed is None:
+            raise ConversationConflict(f"Conversation {conversation_id} was updated concurrently")
+
+        conversation["status"] = WAITING
+        try:
+            updated, sent = await apply_reply(conversation, text, self.effects)
+        except Exception:
+            # Nothing was applied; take replies again
+            await self.collection.update_one(
+                {"_id": claimed["_id"], "version": claimed["version"]},
+                {"$set": {"status": WAITING}, "$unset": {"processingSince": ""}, "$inc": {"version": 1}}
+            )
+            raise
+        updated["version"] = claimed["version"] + 1
+        updated.pop("processingSince", None)
+        result = await self.collection.replace_one({"_id": claimed["_id"], "version": claimed["version"]}, updated)
+        if result.matched_count == 0:
+            raise ConversationConflict(f"Conversation {conversation_id} was updated concurrently")
+        return updated, sent
+
+def open_conversation(db, flow_name, context, recipient=None, subject=None):
+    """
+    Sync counterpart of ConversationEngine.start for the watcher scripts.
+    Returns (conversation, created).
+    """
+    conversation = new_conversation(flow_name, context, recipient, subject)
+    if subject is None:
+        db[CONVERSATIONS_COLLECTION].insert_one(conversation)
+        return conversation, True
+    result = db[CONVERSATIONS_COLLECTION].update_one(
+        {"subject": subject}, {"$setOnInsert": conversation}, upsert=True
+    )
+    if result.upserted_id is None:
+        return db[CONVERSATIONS_COLLECTION].find_one({"subject": subject}), False
+    return conversation, True
+
+def claim_completed_conversations(db, flow_name, owner, lease_seconds=120, limit=500):
+    """
+    Completed conversations whose outcome the watcher has not acted on yet,
+    claimed with a lease first, so with several watchers running each
+    outcome is acted on by one of them. A claim that is not followed by mark_outcome_handled
+    (the worker died) expires and the conversation is handed out again.
+
+    Up to `limit` conversations are claimed in three round trips whatever
+    the backlog: candidate IDs, one update_many stamping a claim token, and
+    a find for the conversations that carry this token. Returns a list.
+    """
+    now = datetime.utcnow()
+    claimable = {
+        "flow": flow_name,
+        "status": COMPLETED,
+        "outcomeHandled": {"$ne": True},
+        "$or": [{"outcomeLeaseUntil": {"$exists": False}}, {"outcomeLeaseUntil": {"$lt": now}}]
+    }
+    collection = db[CONVERSATIONS_COLLECTION]
+    candidates = [doc["_id"] for doc in collection.find(claimable, {"_id": 1}).limit(limit)]
+    if not candidates:
+        return []
+    # Re-checking the filter in the update means a conversation another worker
+    # claimed in between is skipped, not stolen
+    token = ObjectId()
+    collection.update_many(
+        dict(claimable, _id={"$in": candidates}),
+        {"$set": {"outcomeOwner": owner, "outcomeClaim": token,
+                  "outcomeLeaseUntil": now + timedelta(seconds=lease_seconds)}}
+    )
+    return list(collection.find({"_id": {"$in": candidates}, "outcomeClaim": token}))
+
+def mark_outcome_handled(db, conversation_id):
+    db[CONVERSATIONS_COLLECTION].update_one(
+        {"_id": conversation_id}, {"$set": {"outcomeHandled": True, "outcomeHandledAt": datetime.utcnow()}}
+    )
+
+def mark_outcomes_handled(db, conversation_ids):
+    """mark_outcome_handled for many conversations in one update."""
+    if conversation_ids:
+        db[CONVERSATIONS_COLLECTION].update_many(
+            {"_id": {"$in": list(conversation_ids)}},
+            {"$set": {"outcomeHandled": True, "outcomeHandledAt": datetime.utcnow()}}
+        )
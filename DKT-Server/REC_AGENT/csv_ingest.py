@@ -0,0 +1,194 @@
+import argparse
+import hashlib
+import time
+from datetime import datetime
+import pandas as pd
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from REC_AGENT.db import get_sync_db
+from REC_AGENT.fingerprint_index import FINGERPRINTS_COLLECTION, STATE_COLLECTION
+
+DEFAULT_CHUNK_SIZE = 5000
+# Per-row details (duplicates, rejects) kept in the report; counts are always complete
+MAX_REPORTED_ROWS = 1000
+
+# Values accepted by the Node product model; anything else becomes the default
+CONDITIONS = ["Recycle", "Repair", "Unclassified", "Allocation-Ready"]
+DEFAULT_CONDITION = "Unclassified"
+SPECIFICATION_COLUMNS = ["processor", "RAM", "storage"]
+
+def _normalized(series):
+    """Vectorized normalize_text: lowercase and turn punctuation runs into spaces."""
+    return series.fillna("").astype(str).str.lower().str.replace(r"[^0-9a-z]+", " ", regex=True)
+
+def normalize_chunk(chunk):
+    """
+    Validate and normalize one CSV chunk column-wise. Returns (valid, rejected)
+    where rejected carries a `reason` column.
+    """
+    chunk = chunk.rename(columns=lambda c: str(c).strip())
+    for column in ["name", "model", "manufacturer", "description", "category", "condition"]:
+        if column not in chunk:
+            chunk[column] = ""
+    for column in ["name", "model", "manufacturer", "description", "category"]:
+        chunk[column] = chunk[column].fillna("").astype(str).str.strip()
+
+    if "quantity" in chunk:
+        chunk["quantity"] = pd.to_numeric(chunk["quantity"], errors="coerce").fillna(1)
+    else:
+        chunk["quantity"] = 1
+    condition = chunk["condition"].fillna("").astype(str).str.strip().str.lower()
+    chunk["condition"] = condition.map({c.lower(): c for c in CONDITIONS}).fillna(DEFAULT_CONDITION)
+
+    reason = pd.Series("", index=chunk.index)
+    reason = reason.mask(chunk["quantity"] < 1, "quantity must be at least 1")
+    reason = reason.mask(chunk["name"] == "", "name is required")
+    rejected = chunk[reason != ""].assign(reason=reason[reason != ""])
+    valid = chunk[reason == ""].copy()
+    valid["quantity"] = valid["quantity"].astype(int)
+    return valid, rejected
+
+def fingerprint_chunk(chunk):
+    """
+    Same value as fingerprint_index.product_fingerprint, computed per column:
+    normalized manufacturer, model, name and specification joined by spaces.
+    """
+    parts = [_normalized(chunk[c]) if c in chunk else "" for c in ["manufacturer", "model", "name"] + SPECIFICATION_COLUMNS]
+    signature = parts[0]
+    for part in parts[1:]:
+        signature = signature + " " + part
+    signature = signature.str.split().str.join(" ")
+    return pd.Series(
+        [hashlib.sha1(s.encode("utf-8")).hexdigest() if s else None for s in signature],
+        index=chunk.index
+    )
+
+def _to_product_documents(chunk):
+    records = chunk.drop(columns=["fingerprint"] + [c for c in SPECIFICATION_COLUMNS if c in chunk]).to_dict(orient="records")
+    if any(c in chunk for c in SPECIFICATION_COLUMNS):
+        specs = chunk.reindex(columns=SPECIFICATION_COLUMNS).fillna("").astype(str).to_dict(orient="records")
+        for record, spec in zip(records, specs):
+            record["specification"] = spec
+    now = datetime.utcnow()
+    for record in records:
+        record["createdAt"] = now
+        record["updatedAt"] = now
+    return records
+
+def ingest_csv(path, db=None, doner_id=None, chunk_size=DEFAULT_CHUNK_SIZE, skip_duplicates=False):
+    """
+    Stream a donor CSV into products/product_uploads in bounded memory.
+
+    The file is read chunk_size rows at a time; each chunk is validated and
+    normalized column-wise, fingerprinted, checked against the donor's
+    existing fingerprints and earlier rows of the same file, and written with
+    one insert_many. The fingerprint index is updated as we go, so later
+    incremental duplicate checks only see new items. Returns the upload ID
+    and throughput statistics.
+    """
+    if db is None:
+        db = get_sync_db()
+    donor_oid = ObjectId(doner_id) if doner_id else None
+    upload_id = db["product_uploads"].insert_one({
+        "donerId": donor_oid,
+        "products": [],
+        "adminApproval": "Pending",
+        "createdAt": datetime.utcnow()
+    }).inserted_id
+
+    stats = {"rows_read": 0, "rows_inserted": 0, "rows_rejected": 0, "duplicates": 0, "chunks": 0}
+    duplicate_rows = []
+    rejected_rows = []
+    # Repeats across chunks are spotted by the first 64 bits of each fingerprint, kept
+    # as an int (tens of bytes per distinct row, never the row itself)
+    seen = set()
+    position = 0
+    started = time.perf_counter()
+
+    for chunk in pd.read_csv(path, chunksize=chunk_size, dtype=str, skipinitialspace=True):
+        chunk_started = time.perf_counter()
+        stats["rows_read"] += len(chunk)
+        stats["chunks"] += 1
+
+        valid, rejected = normalize_chunk(chunk)
+        stats["rows_rejected"] += len(rejected)
+        # read_csv keeps a running index across chunks, so it is the file row number
+        rejected_rows.extend(
+            {"row": int(i), "reason": r} for i, r in zip(rejected.index, rejected["reason"])
+        )
+        del rejected_rows[MAX_REPORTED_ROWS:]
+        if valid.empty:
+            continue
+
+        valid["fingerprint"] = fingerprint_chunk(valid)
+        fingerprints = [fp for fp in valid["fingerprint"].dropna().unique()]
+        existing = set()
+        if donor_oid is not None and fingerprints:
+            existing = set(db[FINGERPRINTS_COLLECTION].distinct(
+                "fingerprint", {"donorId": donor_oid, "fingerprint": {"$in": fingerprints}}
+            ))
+
+        is_duplicate = []
+        for fp in valid["fingerprint"]:
+            key = int(fp[:16], 16) if fp else None
+            is_duplicate.append(bool(fp) and (fp in existing or key in seen))
+            if key is not None:
+                seen.add(key)
+        valid["_duplicate"] = is_duplicate
+        stats["duplicates"] += int(valid["_duplicate"].sum())
+        if skip_duplicates:
+            valid = valid[~valid["_duplicate"]]
+
+        to_insert = valid.drop(columns=["_duplicate"])
+        if to_insert.empty:
+            continue
+        inserted_ids = db["products"].insert_many(_to_product_documents(to_insert), ordered=True).inserted_ids
+        for offset, flagged in enumerate(valid["_duplicate"]):
+            if flagged and len(duplicate_rows) < MAX_REPORTED_ROWS:
+                duplicate_rows.append({"position": position + offset, "product_id": str(inserted_ids[offset])})
+
+        now = datetime.utcnow()
+        fingerprint_writes = [
+            UpdateOne(
+                {"_id": product_id},
+                {"$set": {"fingerprint": fp, "uploadId": upload_id, "donorId": donor_oid, "updatedAt": now}},
+                upsert=True
+            )
+            for product_id, fp in zip(inserted_ids, to_insert["fingerprint"]) if fp
+        ]
+        if fingerprint_writes:
+            db[FINGERPRINTS_COLLECTION].bulk_write(fingerprint_writes, ordered=False)
+        db["product_uploads"].update_one({"_id": upload_id}, {"$push": {"products": {"$each": inserted_ids}}})
+        position += len(inserted_ids)
+        db[STATE_COLLECTION].update_one(
+            {"_id": upload_id},
+            {"$set": {"indexedCount": position, "lastProductId": inserted_ids[-1], "donorId": donor_oid, "updatedAt": now}},
+            upsert=True
+        )
+        stats["rows_inserted"] += len(inserted_ids)
+
+        chunk_seconds = time.perf_counter() - chunk_started
+        print(f"[INFO] Chunk {stats['chunks']}: {len(inserted_ids)} rows in {chunk_seconds:.2f}s "
+              f"({len(chunk) / max(chunk_seconds, 1e-9):.0f} rows/s)")
+
+    elapsed = time.perf_counter() - started
+    stats["seconds"] = round(elapsed, 3)
+    stats["rows_per_second"] = round(stats["rows_read"] / elapsed, 1) if elapsed else None
+    print(f"[INFO] Ingested {stats['rows_inserted']}/{stats['rows_read']} rows into upload {upload_id} "
+          f"in {elapsed:.2f}s ({stats['rows_per_second']} rows/s), "
+          f"{stats['duplicates']} duplicates, {stats['rows_rejected']} rejected")
+    return {
+        "upload_id": str(upload_id),
+        "stats": stats,
+        "duplicates": duplicate_rows,
+        "rejected": rejected_rows
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream a donor product CSV into MongoDB")
+    parser.add_argument("path")
+    parser.add_argument("--doner-id")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--skip-duplicates", action="store_true")
+    args = parser.parse_args()
+    ingest_csv(args.path, doner_id=args.doner_id, chunk_size=args.chunk_size, skip_duplicates=args.skip_duplicates)
@@ -0,0 +1,47 @@
+import os
+from dotenv import load_dotenv
+from pymongo import AsyncMongoClient, MongoClient
+from REC_AGENT.metrics import install_mongo_listener
+
+# Load environment variables from .env file
+load_dotenv()
+
+MONGO_URI = os.getenv("MONGO_URI")
+DB_NAME = os.getenv("DB_NAME", "dkt")
+
+# Connection pool settings, shared by the async (API) and sync (watcher) clients
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+
+_sync_client = None
+
+# Command timings for every client created from here on (see metrics.py)
+install_mongo_listener()
+
+def create_async_client(uri=None, **kwargs):
+    """
+    Create the connection-pooled async client used by the API.
+    Create it once per process (in the FastAPI lifespan) and share it; every
+    request borrows a pooled connection instead of opening its own.
+    """
+    kwargs.setdefault("maxPoolSize", MONGO_MAX_POOL_SIZE)
+    kwargs.setdefault("minPoolSize", MONGO_MIN_POOL_SIZE)
+    return AsyncMongoClient(uri or MONGO_URI, **kwargs)
+
+def get_sync_client():
+    """
+    Lazily created sync client for the watcher and CLI scripts.
+    Nothing connects at import time, so importing a module from the API does
+    not open a second pool.
+    """
+    global _sync_client
+    if _sync_client is None:
+        _sync_client = MongoClient(
+            MONGO_URI,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+        )
+    return _sync_client
+
+def get_sync_db(db_name=None):
+    return get_sync_client()[db_name or DB_NAME]
@@ -1,30 +1,39 @@
+import signal
+import sys
 import time
-import pymongo
+from datetime import datetime
 from bson import ObjectId
 from dotenv import load_dotenv
 import os
-from REC_AGENT.chatbot_logic import handle_commitment_vs_delivery_check
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from REC_AGENT.change_feed import ChangeFeed
+from REC_AGENT.checkpoint_store import open_checkpoint_store
+from REC_AGENT.chatbot_logic import send_chatbot_message
+from REC_AGENT.db import get_sync_db
+from REC_AGENT.conversations import open_conversation, claim_completed_conversations, mark_outcomes_handled
+from REC_AGENT.indexes import ensure_indexes, verify_query_plans
+from REC_AGENT.leases import LeaseManager, stable_worker_name
+from REC_AGENT.notifications import ADMIN_EMAIL, NotificationDispatcher, enqueue_many
+from REC_AGENT.metrics import (WATCHER_BATCH_SECONDS, WATCHER_DOCUMENTS, WATCHER_ERRORS, install_mongo_listener,
+                              observe_backlog, start_metrics_server)
+from REC_AGENT.ttl_cache import TTLCache
+
+FLOW_NAME = "commitment_vs_delivery"
 
 # Load environment variables from .env file
 load_dotenv()
 
-# MongoDB connection settings (from .env)
-MONGO_URI = os.getenv("MONGO_URI")
-DB_NAME = os.getenv("DB_NAME", "dkt")  # Default to 'dkt' if not set
-
-# Track processed delivery IDs locally
+# Legacy processed-ID file, imported into the checkpoint store on first run
 PROCESSED_IDS_FILE = "REC_AGENT/processed_deliveries.txt"
 
-def load_processed_ids():
-    try:
-        with open(PROCESSED_IDS_FILE, "r") as f:
-            return set(line.strip() for line in f)
-    except FileNotFoundError:
-        return set()
+# Partner/donor names change rarely; cache them for NAME_CACHE_TTL seconds
+NAME_CACHE_TTL = int(os.getenv("NAME_CACHE_TTL", "600"))
+_name_cache = TTLCache(maxsize=10000, ttl=NAME_CACHE_TTL)
 
-def save_processed_id(delivery_id):
-    with open(PROCESSED_IDS_FILE, "a") as f:
-        f.write(f"{delivery_id}\n")
+# Verification outcomes are written in bulk once this many are buffered, or this many seconds after the first
+VERIFICATION_BATCH_SIZE = int(os.getenv("VERIFICATION_BATCH_SIZE", "500"))
+VERIFICATION_FLUSH_SECONDS = float(os.getenv("VERIFICATION_FLUSH_SECONDS", "2"))
 
 def get_committed_quantity_from_asset_delivery(delivery):
     """
@@ -43,51 +52,130 @@ def get_committed_quantity_from_requested_products(db, delivery):
     if not delivery or 'assetId' not in delivery or 'partnerId' not in delivery:
         return 0
     
-    # Find all requestedProductModel entries for this delivery
-    requested_products = db["requestedproducts"].find({
+    # Count the number of products (not using quantity field)
+    return db["requestedproducts"].count_documents({
         "partnerId": delivery["partnerId"],
         "productId": {"$in": delivery["assetId"]},
         "status": {"$in": ["Assigned", "Delivered"]}
     })
-    
-    # Count the number of products (not using quantity field)
-    return requested_products.count()
+
+def get_committed_quantities_from_requested_products(db, deliveries):
+    """
+    Batch form of get_committed_quantity_from_requested_products: one query
+    for the whole batch. Returns {delivery _id: count}.
+    """
+    deliveries = [d for d in deliveries if d.get("assetId") and d.get("partnerId")]
+    counts = {d["_id"]: 0 for d in deliveries}
+    if not deliveries:
+        return counts
+    assigned = set()
+    for row in db["requestedproducts"].find({
+        "partnerId": {"$in": list({d["partnerId"] for d in deliveries})},
+        "productId": {"$in": list({a for d in deliveries for a in d["assetId"]})},
+        "status": {"$in": ["Assigned", "Delivered"]}
+    }, {"partnerId": 1, "productId": 1}):
+        assigned.add((row["partnerId"], row["productId"]))
+    for delivery in deliveries:
+        counts[delivery["_id"]] = sum((delivery["partnerId"], a) in assigned for a in delivery["assetId"])
+    return counts
+
+def _lookup_fields(db, collection, defaults, ids):
+    """
+    {_id: {field: value}} for `ids` and the fields in `defaults` (field ->
+    value when missing), from the cache or one $in query for the misses.
+    """
+    ids = {i for i in ids if i is not None}
+    fields = tuple(defaults)
+    found, missing = _name_cache.get_many((collection, fields, i) for i in ids)
+    docs = {key[2]: doc for key, doc in found.items()}
+    if missing:
+        missing_ids = [key[2] for key in missing]
+        for doc in db[collection].find({"_id": {"$in": missing_ids}}, dict.fromkeys(fields, 1)):
+            docs[doc["_id"]] = {field: doc.get(field, default) for field, default in defaults.items()}
+        for i in missing_ids:
+            # Unknown IDs are cached too, so they are not looked up every batch
+            docs.setdefault(i, dict(defaults))
+            _name_cache.set((collection, fields, i), docs[i])
+    return docs
+
+def _lookup_names(db, collection, field, default, ids):
+    """Names by _id for `ids`, from the cache or one $in query for the misses."""
+    return {i: doc[field] for i, doc in _lookup_fields(db, collection, {field: default}, ids).items()}
+
+def get_partner_names(db, partner_ids):
+    return _lookup_names(db, "partners", "partnerName", "Partner", partner_ids)
+
+def get_donor_ids(db, product_ids):
+    """
+    Donor of each product: products.donorId when set, otherwise the donerId of
+    the product_uploads document listing it. Two queries for any number of products.
+    """
+    product_ids = list({p for p in product_ids if p is not None})
+    donors = {}
+    if not product_ids:
+        return donors
+    for product in db["products"].find({"_id": {"$in": product_ids}, "donorId": {"$exists": True}}, {"donorId": 1}):
+        donors[product["_id"]] = product["donorId"]
+    unresolved = [p for p in product_ids if p not in donors]
+    if unresolved:
+        for upload in db["product_uploads"].aggregate([
+            {"$match": {"products": {"$in": unresolved}}},
+            {"$project": {"donerId": 1, "products": {
+                "$filter": {"input": "$products", "as": "p", "cond": {"$in": ["$$p", unresolved]}}
+            }}}
+        ]):
+            for product_id in upload["products"]:
+                donors.setdefault(product_id, upload.get("donerId"))
+    return donors
+
+def enrich_deliveries(db, deliveries):
+    """
+    Partner and donor names and the donor's email for a batch of deliveries
+    with grouped $in queries (partners, products, product_uploads, donors)
+    instead of three round trips per delivery. Served from a TTL cache when
+    possible. Returns {delivery _id: {"partner_name", "donor_name", "donor_email"}}.
+    """
+    partner_names = get_partner_names(db, (d.get("partnerId") for d in deliveries))
+    first_products = {d["_id"]: d["assetId"][0] for d in deliveries if d.get("assetId")}
+    product_donors = get_donor_ids(db, first_products.values())
+    donors = _lookup_fields(db, "donors", {"companyName": "Donor", "email": None}, product_donors.values())
+    enriched = {}
+    for delivery in deliveries:
+        donor = donors.get(product_donors.get(first_products.get(delivery["_id"])), {})
+        enriched[delivery["_id"]] = {
+            "partner_name": partner_names.get(delivery.get("partnerId"), "Partner"),
+            "donor_name": donor.get("companyName", "Donor"),
+            "donor_email": donor.get("email")
+        }
+    return enriched
 
 def get_partner_name(db, partner_id):
-    partner = db["partners"].find_one({"_id": partner_id})
-    return partner.get("partnerName", "Partner") if partner else "Partner"
+    return get_partner_names(db, [partner_id]).get(partner_id, "Partner")
 
 def get_donor_name(db, delivery):
     """
     Get donor name from the products in the delivery.
     Since assetId contains product ObjectIds, we need to find the donor through the products.
     """
-    if not delivery or 'assetId' not in delivery:
+    if not delivery or not delivery.get('assetId'):
         return "Donor"
-    
-    # Get the first product to find the donor
-    if delivery['assetId']:
-        product = db["products"].find_one({"_id": delivery['assetId'][0]})
-        if product and 'donorId' in product:
-            donor = db["donors"].find_one({"_id": product['donorId']})
-            return donor.get("companyName", "Donor") if donor else "Donor"
-    
-    return "Donor"
+    return enrich_deliveries(db, [delivery])[delivery["_id"]]["donor_name"]
 
 def get_admin_contact(db):
     """
     Get admin contact information for alerts.
     """
-    # You might want to store admin contact in a separate collection or config
-    # For now, returning a default admin contact
+    # Configured with ADMIN_EMAIL (see notifications.py)
     return {
         "name": "Admin",
-        "email": "admin@dkt.com"  # This should be configurable
+        "email": ADMIN_EMAIL
     }
 
-def send_alert_to_admin_and_donor(db, delivery, committed_quantity, received_quantity, partner_name, donor_name):
+def send_alert_to_admin_and_donor(db, delivery, committed_quantity, received_quantity, partner_name, donor_name,
+                                  donor_email=None, admin=None):
     """
     Send alert to admin and donor about quantity mismatch.
+    `donor_email` comes from enrich_deliveries, resolved once per batch.
     """
     tracking_id = delivery.get("shippingDetails", {}).get("order_id", str(delivery["_id"]))
     
@@ -104,32 +192,36 @@ def send_alert_to_admin_and_donor(db, delivery, committed_quantity, received_qua
         f"Please investigate this discrepancy and take appropriate action."
     )
     
-    print(f"[ALERT] {alert_message}")
-    
-    # TODO: Integrate with your notification system (email, SMS, etc.)
-    # For now, just logging the alert
+    # Queued, not sent: the dispatcher delivers it (digested per recipient) off the watcher loop
+    queued = enqueue_many(
+        db, [(admin or get_admin_contact(db))["email"], donor_email],
+        f"Commitment vs delivery mismatch for {tracking_id}", alert_message,
+        dedupe_key=f"delivery_mismatch:{delivery['_id']}", kind="delivery_mismatch"
+    )
+    print(f"[ALERT] Mismatch for delivery {delivery['_id']}, {len(queued)} notification(s) queued")
     return alert_message
 
+def mismatch_verification(committed_quantity, received_quantity):
+    return {
+        "verified": False,
+        "committedQuantity": committed_quantity,
+        "receivedQuantity": received_quantity,
+        "mismatch": abs(committed_quantity - received_quantity),
+        "verifiedAt": datetime.now(),
+        "status": "Mismatch Detected"
+    }
+
+def verified_verification():
+    return {"verified": True, "verifiedAt": datetime.now(), "status": "Verified"}
+
 def update_delivery_with_mismatch(db, delivery_id, committed_quantity, received_quantity):
     """
     Update delivery record with mismatch information.
     """
     try:
-        from datetime import datetime
         db["assetsdeleveries"].update_one(
             {"_id": delivery_id},
-            {
-                "$set": {
-                    "deliveryVerification": {
-                        "verified": False,
-                        "committedQuantity": committed_quantity,
-                        "receivedQuantity": received_quantity,
-                        "mismatch": abs(committed_quantity - received_quantity),
-                        "verifiedAt": datetime.now(),
-                        "status": "Mismatch Detected"
-                    }
-                }
-            }
+            {"$set": {"deliveryVerification": mismatch_verification(committed_quantity, received_quantity)}}
         )
         print(f"[INFO] Updated delivery {delivery_id} with mismatch information")
     except Exception as e:
@@ -140,77 +232,219 @@ def update_delivery_as_verified(db, delivery_id):
     Update delivery record as verified.
     """
     try:
-        from datetime import datetime
         db["assetsdeleveries"].update_one(
             {"_id": delivery_id},
-            {
-                "$set": {
-                    "deliveryVerification": {
-                        "verified": True,
-                        "verifiedAt": datetime.now(),
-                        "status": "Verified"
-                    }
-                }
-            }
+            {"$set": {"deliveryVerification": verified_verification()}}
         )
         print(f"[INFO] Updated delivery {delivery_id} as verified")
     except Exception as e:
         print(f"[ERROR] Failed to update delivery {delivery_id}: {e}")
 
-def main():
-    client = pymongo.MongoClient(MONGO_URI)
-    db = client[DB_NAME]
-    processed_ids = load_processed_ids()
-    print("[Watcher] Starting delivery watcher with commitment vs delivery check...")
-    
-    while True:
+class VerificationWriter:
+    """
+    Buffers verification outcomes and writes them with one unordered
+    bulk_write, once `max_batch` are pending or the oldest has waited
+    `max_delay` seconds (flush_if_due), so a catch-up run after an outage
+    takes a few round trips instead of one per delivery.
+
+    Nothing is lost if the process dies with outcomes buffered: the
+    partner's answer is stored on the conversation, which is only marked
+    handled after its delivery update is written. Its claim then expires and
+    the outcome is applied again; the $set is idempotent.
+    """
+
+    def __init__(self, db, max_batch=VERIFICATION_BATCH_SIZE, max_delay=VERIFICATION_FLUSH_SECONDS):
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        # (delivery_id, deliveryVerification, conversation_id)
+        self._pending = []
+        self._oldest = None
+
+    def add(self, delivery_id, verification, conversation_id=None):
+        if not self._pending:
+            self._oldest = time.monotonic()
+        self._pending.append((delivery_id, verification, conversation_id))
+        if len(self._pending) >= self.max_batch:
+            return self.flush()
+        return {}
+
+    def flush_if_due(self):
+        if self._pending and time.monotonic() - self._oldest >= self.max_delay:
+            return self.flush()
+        return {}
+
+    def flush(self):
+        """
+        Write everything buffered. Returns {delivery_id: error message} for the
+        updates the server rejected; their conversations stay unhandled and are
+        retried once the claim expires. Connection errors keep the buffer and
+        are raised.
+        """
+        if not self._pending:
+            return {}
+        pending = self._pending
+        operations = [UpdateOne({"_id": delivery_id}, {"$set": {"deliveryVerification": verification}})
+                      for delivery_id, verification, _ in pending]
+        errors = {}
         try:
-            # Find all delivered asset deliveries not yet processed
-            deliveries = db["assetsdeleveries"].find({
-                "status": "Delivered",
-                "deliveryVerification": {"$exists": False}  # Only process unverified deliveries
-            })
-            
-            for delivery in deliveries:
-                delivery_id = str(delivery["_id"])
-                if delivery_id in processed_ids:
-                    continue
-                
-                print(f"[INFO] Processing delivery {delivery_id}")
-                
-                # Get partner and donor names
-                partner_name = get_partner_name(db, delivery["partnerId"])
-                donor_name = get_donor_name(db, delivery)
-                
-                # Handle the commitment vs delivery check
-                tracking_id = delivery.get("shippingDetails", {}).get("order_id", str(delivery["_id"]))
-                committed_quantity = get_committed_quantity_from_asset_delivery(delivery)
-                
-                if committed_quantity > 0:
-                    result = handle_commitment_vs_delivery_check(partner_name, tracking_id, committed_quantity)
-                    
-                    # Handle the result
-                    if result and result.get("status") == "mismatch":
-                        # Send alert to admin and donor
-                        send_alert_to_admin_and_donor(
-                            db, delivery, committed_quantity, result["received_quantity"], partner_name, donor_name
-                        )
-                        # Update delivery status or create a mismatch record
-                        update_delivery_with_mismatch(db, delivery["_id"], committed_quantity, result["received_quantity"])
-                    elif result and result.get("status") == "verified":
-                        # Update delivery status to verified
-                        update_delivery_as_verified(db, delivery["_id"])
-                else:
-                    print(f"[WARNING] No committed quantity found for delivery {tracking_id}")
+            self.db["assetsdeleveries"].bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                errors[pending[error["index"]][0]] = error.get("errmsg", str(error))
+        self._pending = []
+        self._oldest = None
+
+        for delivery_id, message in errors.items():
+            print(f"[ERROR] Failed to update delivery {delivery_id}: {message}")
+        mark_outcomes_handled(self.db, [conversation_id for delivery_id, _, conversation_id in pending
+                                        if conversation_id is not None and delivery_id not in errors])
+        print(f"[INFO] Wrote {len(pending) - len(errors)} verification outcome(s), {len(errors)} failed")
+        return errors
+
+def open_verification_conversation(db, delivery, names=None):
+    """
+    Ask the partner how many units arrived. The question is persisted as a
+    conversation and answered through the API; nothing here waits for it.
+    `names` is this delivery's entry from enrich_deliveries.
+    """
+    if names is None:
+        names = enrich_deliveries(db, [delivery])[delivery["_id"]]
+    tracking_id = delivery.get("shippingDetails", {}).get("order_id", str(delivery["_id"]))
+    committed_quantity = get_committed_quantity_from_asset_delivery(delivery)
+    if committed_quantity <= 0:
+        print(f"[WARNING] No committed quantity found for delivery {tracking_id}")
+        return None
+
+    conversation, created = open_conversation(
+        db,
+        FLOW_NAME,
+        {
+            "delivery_id": str(delivery["_id"]),
+            "partner_name": names["partner_name"],
+            "donor_name": names["donor_name"],
+            "tracking_id": tracking_id,
+            "committed_quantity": committed_quantity
+        },
+        recipient={"role": "Partner", "id": str(delivery["partnerId"])},
+        subject=f"{FLOW_NAME}:{delivery['_id']}"
+    )
+    if created:
+        send_chatbot_message(conversation["prompt"])
+    return conversation
+
+def process_completed_verifications(db, worker_id, writer=None):
+    """
+    Apply the outcome of every answered verification conversation this worker
+    claims. Delivery updates go through `writer` (a VerificationWriter); without
+    one they are written before returning.
+    """
+    conversations = claim_completed_conversations(db, FLOW_NAME, worker_id)
+    own_writer = writer is None
+    writer = writer or VerificationWriter(db)
+    if conversations:
+        delivery_ids = [ObjectId(c["context"]["delivery_id"]) for c in conversations]
+        deliveries = {d["_id"]: d for d in db["assetsdeleveries"].find({"_id": {"$in": delivery_ids}})}
+        # Donor names and emails for every alert in the batch in a few grouped queries
+        alerted = [deliveries[delivery_id] for conversation, delivery_id in zip(conversations, delivery_ids)
+                   if delivery_id in deliveries and conversation["result"]["status"] == "mismatch"]
+        names = enrich_deliveries(db, alerted) if alerted else {}
+        admin = get_admin_contact(db)
+        unmatched = []
+        for conversation, delivery_id in zip(conversations, delivery_ids):
+            result = conversation["result"]
+            delivery = deliveries.get(delivery_id)
+            if delivery and result["status"] == "mismatch":
+                # Send alert to admin and donor
+                send_alert_to_admin_and_donor(
+                    db, delivery, result["committed_quantity"], result["received_quantity"],
+                    conversation["context"]["partner_name"],
+                    conversation["context"].get("donor_name") or names[delivery_id]["donor_name"],
+                    donor_email=names[delivery_id]["donor_email"], admin=admin
+                )
+                writer.add(delivery_id, mismatch_verification(result["committed_quantity"], result["received_quantity"]),
+                           conversation["_id"])
+            elif delivery and result["status"] == "verified":
+                writer.add(delivery_id, verified_verification(), conversation["_id"])
+            else:
+                unmatched.append(conversation["_id"])
+        mark_outcomes_handled(db, unmatched)
+    if own_writer:
+        writer.flush()
+    else:
+        writer.flush_if_due()
+
+def main():
+    install_mongo_listener()
+    start_metrics_server()
+    # Shared pooled client, configured from MONGO_URI / DB_NAME (see db.py)
+    db = get_sync_db()
+    # Processed IDs live in an indexed checkpoint store; the old text file is imported once
+    processed = open_checkpoint_store("delivery_watcher", db=db, legacy_file=PROCESSED_IDS_FILE)
+    # Any number of watchers can run; each delivery is handled by whoever claims it
+    leases = LeaseManager(db, "delivery_watcher")
+    leases.ensure_indexes()
+    ensure_indexes(db)
+    verify_query_plans(db)
+    # Alerts are sent from background threads; NOTIFY_WORKERS=0 leaves it to a separate dispatcher
+    NotificationDispatcher(db).start()
+    print(f"[Watcher] Starting delivery watcher {leases.worker_id} with commitment vs delivery check...")
+
+    query = {
+        "status": "Delivered",
+        "deliveryVerification": {"$exists": False}  # Only process unverified deliveries
+    }
+    feed = ChangeFeed(db, "assetsdeleveries", query, name=f"delivery_watcher:{stable_worker_name()}")
+    writer = VerificationWriter(db)
+    # SIGTERM (docker stop, systemd) unwinds like Ctrl+C, so buffered outcomes are written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        # Each batch holds the deliveries that became Delivered since the last one
+        for deliveries in feed.batches():
+            started = time.perf_counter()
+            try:
+                new_ids = set(processed.filter_new(d["_id"] for d in deliveries))
+                claimed = set(leases.claim_many(k for k in new_ids))
+                deliveries = [d for d in deliveries if str(d["_id"]) in claimed]
+                # Deliveries left behind by a worker that died mid-batch
+                expired = leases.claim_expired()
+                if expired:
+                    deliveries.extend(db["assetsdeleveries"].find(dict(query, _id={"$in": [ObjectId(k) for k in expired]})))
+                    claimed.update(expired)
+
+                # Names for the whole batch in a few grouped queries
+                names = enrich_deliveries(db, deliveries) if deliveries else {}
+                for delivery in deliveries:
+                    delivery_id = str(delivery["_id"])
+                    print(f"[INFO] Processing delivery {delivery_id}")
+                    try:
+                        open_verification_conversation(db, delivery, names[delivery["_id"]])
+                    except Exception:
+                        leases.release(delivery_id)
+                        raise
                 
-                # Mark as processed
-                save_processed_id(delivery_id)
-                processed_ids.add(delivery_id)
+                    # Mark as processed, the open conversation carries it from here
+                    processed.add(delivery_id)
+                # Includes expired claims that no longer match the query, they need no work
+                for delivery_id in claimed:
+                    leases.complete(delivery_id)
+                # One commit per batch, before the feed records its position
+                processed.flush()
+                processed.compact_if_due()
+
+                process_completed_verifications(db, leases.worker_id, writer)
+                WATCHER_DOCUMENTS.inc(len(deliveries), watcher="delivery_watcher")
+                observe_backlog(db, "delivery_watcher", "assetsdeleveries", query)
                 
+            except Exception as e:
+                WATCHER_ERRORS.inc(watcher="delivery_watcher")
+                print(f"[ERROR] Error in delivery watcher: {e}")
+            WATCHER_BATCH_SECONDS.observe(time.perf_counter() - started, watcher="delivery_watcher")
+    finally:
+        try:
+            writer.flush()
         except Exception as e:
-            print(f"[ERROR] Error in delivery watcher: {e}")
-        
-        time.sleep(30)  # Poll every 30 seconds
+            print(f"[ERROR] Could not write buffered verification outcomes on exit: {e}")
 
 if __name__ == "__main__":
     main() 
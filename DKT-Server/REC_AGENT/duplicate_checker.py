@@ -1,31 +1,254 @@
 import pandas as pd
-from pymongo import MongoClient
 from bson.objectid import ObjectId
 from dotenv import load_dotenv
 import os
+from pymongo import ReturnDocument
+from REC_AGENT.db import create_async_client
+from REC_AGENT.fingerprint_index import FingerprintIndex
 
 # Load environment variables from .env file
 load_dotenv()
 
+def build_duplicate_positions_pipeline(upload_ids):
+    """
+    Aggregation pipeline that finds repeated product IDs inside each upload's
+    `products` array on the server. One document per (upload, product) comes
+    back for the duplicate groups, plus the group of each upload's first
+    product (or of an empty array) so every upload found is reported with
+    its `total`, however many uploads and groups there are.
+    """
+    return [
+        {"$match": {"_id": {"$in": upload_ids}, "products": {"$type": "array"}}},
+        {"$project": {"products": 1, "total": {"$size": "$products"}}},
+        {"$unwind": {"path": "$products", "includeArrayIndex": "position", "preserveNullAndEmptyArrays": True}},
+        {"$group": {
+            "_id": {"upload": "$_id", "product": "$products"},
+            "total": {"$first": "$total"},
+            "first": {"$min": "$position"},
+            "positions": {"$push": "$position"},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"$or": [{"count": {"$gt": 1}}, {"first": 0}, {"first": None}]}},
+        {"$project": {
+            "_id": 0,
+            "upload": "$_id.upload",
+            "product": "$_id.product",
+            "total": 1,
+            "positions": 1,
+            "count": 1
+        }}
+    ]
+
+def _elem(array, index):
+    return {"$arrayElemAt": [array, index]}
+
+def build_dedupe_update_pipeline():
+    """
+    Pipeline-style update that drops repeated product IDs from `products`,
+    keeping the first occurrence, entirely inside MongoDB. The removed
+    positions are recorded in `duplicateCheck` so the caller can read them
+    back from the same findOneAndUpdate.
+
+    Entries are sorted by (product, position) so each duplicate sits right
+    after its first occurrence, which keeps the work O(n log n) instead of an
+    $in lookup per element. Needs MongoDB 5.2+ for $sortArray.
+    """
+    size = {"$size": "$products"}
+    indexed = {"$map": {
+        "input": {"$range": [0, size]},
+        "as": "i",
+        "in": {"i": "$$i", "v": _elem("$products", "$$i")}
+    }}
+    sorted_entry = _elem("$_dedupeSorted", "$$k")
+    previous_entry = _elem("$_dedupeSorted", {"$subtract": ["$$k", 1]})
+    return [
+        # 1. Pair every product with its position, sorted by (product, position)
+        {"$set": {"_dedupeSorted": {"$sortArray": {"input": indexed, "sortBy": {"v": 1, "i": 1}}}}},
+        # 2. An entry is a duplicate when it equals its predecessor in that order
+        {"$set": {"_dedupeMarked": {"$map": {
+            "input": {"$range": [0, size]},
+            "as": "k",
+            "in": {
+                "i": {"$getField": {"field": "i", "input": sorted_entry}},
+                "v": {"$getField": {"field": "v", "input": sorted_entry}},
+                "dup": {"$cond": [
+                    {"$eq": ["$$k", 0]},
+                    False,
+                    {"$eq": [
+                        {"$getField": {"field": "v", "input": sorted_entry}},
+                        {"$getField": {"field": "v", "input": previous_entry}}
+                    ]}
+                ]}
+            }
+        }}}},
+        # 3. Back to upload order
+        {"$set": {"_dedupeMarked": {"$sortArray": {"input": "$_dedupeMarked", "sortBy": {"i": 1}}}}},
+        # 4. Keep first occurrences and record which positions were removed
+        {"$set": {
+            "products": {"$map": {
+                "input": {"$filter": {"input": "$_dedupeMarked", "as": "e", "cond": {"$not": ["$$e.dup"]}}},
+                "as": "e",
+                "in": "$$e.v"
+            }},
+            "duplicateCheck": {
+                "removed": {"$map": {
+                    "input": {"$filter": {"input": "$_dedupeMarked", "as": "e", "cond": "$$e.dup"}},
+                    "as": "e",
+                    "in": "$$e.i"
+                }},
+                "checkedAt": "$$NOW"
+            }
+        }},
+        {"$unset": ["_dedupeSorted", "_dedupeMarked"]}
+    ]
+
+def has_duplicates_filter():
+    """Matches uploads whose products array repeats an ID, so clean uploads are never rewritten."""
+    return {"$expr": {"$lt": [{"$size": {"$setUnion": ["$products", []]}}, {"$size": "$products"}]}}
+
+def not_found_result():
+    return {
+        "message": "Products array not found for the given asset ID.",
+        "duplicates": [],
+        "status": "not_found"
+    }
+
 class DuplicateChecker:
-    def __init__(self, db_uri=None, db_name=None):
-        if db_uri is None:
-            db_uri = os.getenv("MONGO_URI")
-        if db_name is None:
-            db_name = os.getenv("DB_NAME", "reconciliation")
-        self.client = MongoClient(db_uri)
-        self.db = self.client[db_name]
+    def __init__(self, db_uri=None, db_name=None, db=None):
+        """
+        Pass `db` (an async database handle) to share the API's pooled client.
+        Without it, a dedicated async client is created from db_uri/db_name.
+        """
+        if db is None:
+            if db_uri is None:
+                db_uri = os.getenv("MONGO_URI")
+            if db_name is None:
+                db_name = os.getenv("DB_NAME", "reconciliation")
+            self.client = create_async_client(db_uri)
+            db = self.client[db_name]
+        else:
+            self.client = db.client
+        self.db = db
         self.csv_collection = self.db["product_uploads"]
+        self.fingerprints = FingerprintIndex(self.db)
 
-    def check_and_handle_duplicates(self, asset_id, auto_remove=False):
-        record = self.csv_collection.find_one({"_id": ObjectId(asset_id)})
+    async def check_and_handle_duplicates(self, asset_id, auto_remove=False, mode="aggregate"):
+        """
+        mode="aggregate" finds duplicates inside MongoDB (see check_many);
+        mode="fingerprint" compares the upload's product fingerprints with the
+        donor's other uploads (see FingerprintIndex.check_upload);
+        mode="client" fetches the whole products array and scans it in Python.
+        """
+        if mode == "fingerprint" and not auto_remove:
+            result = await self.fingerprints.check_upload(asset_id)
+            return result if result is not None else not_found_result()
+        if mode == "client":
+            return await self._check_client_side(asset_id, auto_remove)
+        if auto_remove:
+            return await self.remove_duplicates(asset_id)
+        results = await self.check_many([asset_id])
+        return results[asset_id]
 
-        if not record or "products" not in record:
+    async def check_many(self, asset_ids):
+        """
+        Check several uploads for duplicate product IDs in one aggregation
+        round trip. Returns {asset_id: result}, each result shaped like
+        check_and_handle_duplicates plus per-product counts and positions.
+        """
+        results = dict.fromkeys(asset_ids)
+        object_ids = {}
+        for asset_id in results:
+            if ObjectId.is_valid(asset_id):
+                object_ids[asset_id] = ObjectId(asset_id)
+            else:
+                results[asset_id] = not_found_result()
+        if not object_ids:
+            return results
+
+        cursor = await self.csv_collection.aggregate(
+            build_duplicate_positions_pipeline(list(object_ids.values())),
+            allowDiskUse=True
+        )
+        found = {}
+        groups_by_upload = {}
+        async for group in cursor:
+            found[group["upload"]] = group["total"]
+            if group["count"] > 1:
+                groups_by_upload.setdefault(group["upload"], []).append(group)
+
+        for asset_id, oid in object_ids.items():
+            if oid not in found:
+                results[asset_id] = not_found_result()
+                continue
+            duplicates = []
+            duplicate_groups = []
+            for group in groups_by_upload.get(oid, []):
+                positions = sorted(group["positions"])
+                # The first occurrence is kept, every later position is a duplicate
+                duplicates.extend(positions[1:])
+                duplicate_groups.append({
+                    "product_id": str(group["product"]),
+                    "count": group["count"],
+                    "positions": positions
+                })
+            duplicate_groups.sort(key=lambda g: g["positions"][0])
+            if duplicates:
+                results[asset_id] = {
+                    "message": "Duplicate product IDs found in products array.",
+                    "duplicates": sorted(duplicates),
+                    "duplicate_groups": duplicate_groups,
+                    "total_products": found[oid],
+                    "status": "flagged"
+                }
+            else:
+                results[asset_id] = {
+                    "message": "No duplicates found in products array.",
+                    "duplicates": [],
+                    "duplicate_groups": [],
+                    "total_products": found[oid],
+                    "status": "clean"
+                }
+        return results
+
+    async def remove_duplicates(self, asset_id):
+        """
+        Atomically dedupe an upload's products array in one round trip.
+        The update runs server-side, so concurrent appends to the same upload
+        are never overwritten by a stale client copy. Uploads without
+        duplicates are not matched, so they are not written at all.
+        """
+        if not ObjectId.is_valid(asset_id):
+            return not_found_result()
+        query = {"_id": ObjectId(asset_id), "products": {"$type": "array"}}
+        record = await self.csv_collection.find_one_and_update(
+            {**query, **has_duplicates_filter()},
+            build_dedupe_update_pipeline(),
+            projection={"duplicateCheck.removed": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if not record and not await self.csv_collection.find_one(query, {"_id": 1}):
+            return not_found_result()
+
+        removed = record.get("duplicateCheck", {}).get("removed", []) if record else []
+        if removed:
+            # Positions shifted; the fingerprint index re-reads this upload
+            await self.fingerprints.reset_upload(asset_id)
             return {
-                "message": "Products array not found for the given asset ID.",
-                "duplicates": [],
-                "status": "not_found"
+                "message": "Duplicates auto-removed from products array.",
+                "duplicates": removed,
+                "status": "cleaned"
             }
+        return {
+            "message": "No duplicates found in products array.",
+            "duplicates": [],
+            "status": "clean"
+        }
+
+    async def _check_client_side(self, asset_id, auto_remove=False):
+        record = await self.csv_collection.find_one({"_id": ObjectId(asset_id)})
+
+        if not record or "products" not in record:
+            return not_found_result()
 
         products = record["products"]
         # Find duplicates in the products array
@@ -46,10 +269,11 @@ class DuplicateChecker:
                     if prod not in seen:
                         new_products.append(prod)
                         seen.add(prod)
-                self.csv_collection.update_one(
+                await self.csv_collection.update_one(
                     {"_id": ObjectId(asset_id)},
                     {"$set": {"products": new_products}}
                 )
+                await self.fingerprints.reset_upload(asset_id)
                 return {
                     "message": "Duplicates auto-removed from products array.",
                     "duplicates": duplicates,
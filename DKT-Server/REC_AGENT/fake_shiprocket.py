@@ -0,0 +1,179 @@
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+DEFAULT_CONFIG = {
+    "default_sequence": ["Pickup Scheduled", "In Transit", "Delivered"],
+    "shipments": {},
+    "latency_ms": [0, 0],
+    "error_rate": 0.0,
+    "rate_limit_per_second": 0,
+    "token_ttl": 10 * 24 * 3600
+}
+
+def _fake_jwt(ttl):
+    """Unsigned JWT-shaped token with an exp claim, enough for ShiprocketClient."""
+    def encode(obj):
+        return base64.urlsafe_b64encode(json.dumps(obj).encode()).rstrip(b"=").decode()
+    return f"{encode({'alg': 'none'})}.{encode({'exp': int(time.time() + ttl), 'jti': uuid.uuid4().hex})}.fake"
+
+class FakeShiprocketState:
+    """
+    Local stand-in for the Shiprocket auth and tracking endpoints.
+
+        python -m REC_AGENT.fake_shiprocket --port 8081 --config fake_shiprocket.json
+        SHIPROCKET_BACKEND=fake python -m REC_AGENT.shipment_sweep
+
+    Config (all keys optional):
+        {
+            "default_sequence": ["Pickup Scheduled", "In Transit", "Delivered"],
+            "shipments": {"123": ["In Transit", "Undelivered", "RTO"]},
+            "latency_ms": [20, 120],        # uniform per request
+            "error_rate": 0.0,              # share of tracking calls answered with 500
+            "rate_limit_per_second": 0,     # 0 = unlimited; beyond it 429 + Retry-After
+            "token_ttl": 864000
+        }
+
+    Every tracking call for a shipment advances its sequence by one step and
+    then stays on the last status. Shipments not listed use default_sequence.
+    GET /__fake/stats returns request counters and POST /__fake/reset rewinds
+    every sequence.
+    """
+
+    def __init__(self, config=None):
+        self.config = dict(DEFAULT_CONFIG, **(config or {}))
+        self.lock = threading.Lock()
+        self.tokens = set()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.steps = {}
+            self.stats = {"logins": 0, "track": 0, "unauthorized": 0, "errors": 0, "rate_limited": 0}
+            self.allowance = float(self.config["rate_limit_per_second"])
+            self.last_refill = time.monotonic()
+
+    def login(self):
+        token = _fake_jwt(self.config["token_ttl"])
+        with self.lock:
+            self.tokens.add(token)
+            self.stats["logins"] += 1
+        return token
+
+    def take_rate_token(self):
+        limit = self.config["rate_limit_per_second"]
+        if not limit:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(limit, self.allowance + (now - self.last_refill) * limit)
+            self.last_refill = now
+            if self.allowance < 1:
+                self.stats["rate_limited"] += 1
+                return False
+            self.allowance -= 1
+            return True
+
+    def next_status(self, shipment_id):
+        sequence = self.config["shipments"].get(str(shipment_id)) or self.config["default_sequence"]
+        with self.lock:
+            self.stats["track"] += 1
+            step = self.steps.get(shipment_id, 0)
+            self.steps[shipment_id] = step + 1
+        return sequence[min(step, len(sequence) - 1)]
+
+def make_handler(state):
+    class FakeShiprocketHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, code, body, headers=None):
+            payload = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _delay(self):
+            low, high = state.config["latency_ms"]
+            if high:
+                time.sleep(random.uniform(low, high) / 1000)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            self.rfile.read(length)
+            path = urlparse(self.path).path
+            if path.endswith("/auth/login"):
+                self._delay()
+                return self._send(200, {"token": state.login()})
+            if path == "/__fake/reset":
+                state.reset()
+                return self._send(200, {"status": "reset"})
+            self._send(404, {"message": "Not found"})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/__fake/stats":
+                with state.lock:
+                    return self._send(200, dict(state.stats))
+            if not url.path.endswith("/courier/track"):
+                return self._send(404, {"message": "Not found"})
+
+            token = (self.headers.get("Authorization") or "").removeprefix("Bearer ")
+            if token not in state.tokens:
+                with state.lock:
+                    state.stats["unauthorized"] += 1
+                return self._send(401, {"message": "Token has expired"})
+            if not state.take_rate_token():
+                return self._send(429, {"message": "Too many requests"}, {"Retry-After": "1"})
+            self._delay()
+            if random.random() < state.config["error_rate"]:
+                with state.lock:
+                    state.stats["errors"] += 1
+                return self._send(500, {"message": "Injected error"})
+
+            shipment_id = parse_qs(url.query).get("shipment_id", [""])[0]
+            status = state.next_status(shipment_id)
+            self._send(200, {"tracking_data": {"track_status": 1, "shipment_status": status,
+                                               "shipment_track": [{"shipment_id": shipment_id, "current_status": status}]}})
+
+    return FakeShiprocketHandler
+
+def start_fake_shiprocket(config=None, host="127.0.0.1", port=0):
+    """
+    Serve the fake in a background thread. Returns (server, base_url); the
+    base URL goes into ShiprocketClient(base_url=...) or SHIPROCKET_API_URL.
+    Call server.shutdown() when done.
+    """
+    state = FakeShiprocketState(config)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local fake of the Shiprocket auth and tracking API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--config", help="JSON file with sequences, latency, error and rate-limit settings")
+    args = parser.parse_args()
+    config = None
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+    state = FakeShiprocketState(config)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    print(f"[INFO] Fake Shiprocket listening on http://{args.host}:{args.port}")
+    server.serve_forever()
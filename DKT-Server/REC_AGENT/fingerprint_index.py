@@ -0,0 +1,321 @@
+import argparse
+import asyncio
+import hashlib
+import os
+from datetime import datetime
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, UpdateOne, DeleteOne
+from REC_AGENT.near_duplicate_checker import product_signature, PRODUCT_PROJECTION
+
+FINGERPRINTS_COLLECTION = "product_fingerprints"
+# Per-upload progress ({_id: uploadId, indexedCount}) and the products watermark
+STATE_COLLECTION = "product_fingerprint_state"
+PRODUCTS_WATERMARK_ID = "products_watermark"
+# $slice count meaning "to the end of the array"
+_MAX_SLICE = 2 ** 31 - 1
+# The API advances the index in the background this often (0 disables; run this module instead)
+FINGERPRINT_SYNC_SECONDS = int(os.getenv("FINGERPRINT_SYNC_SECONDS", "300"))
+
+def product_fingerprint(product):
+    """One stable hash per product, over its normalized signature."""
+    signature = product_signature(product)
+    if not signature:
+        return None
+    return hashlib.sha1(signature.encode("utf-8")).hexdigest()
+
+class FingerprintIndex:
+    """
+    Persistent fingerprint index over products, kept current incrementally.
+
+    product_fingerprints holds {_id: productId, fingerprint, uploadId, donorId}.
+    For each upload we remember how many entries of its products array have
+    been indexed (and the last indexed product, to notice the array being
+    rewritten), so indexing only reads and hashes the items added since.
+
+    Checking an upload compares all of its products against the donor's
+    other uploads with an indexed lookup on (donorId, fingerprint), reusing
+    stored fingerprints and hashing only products not indexed yet. It is
+    read-only, so the answer does not depend on how far the index has been
+    advanced by index_upload / sync (csv_ingest, the API's background sync,
+    or this module's CLI).
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.fingerprints = db[FINGERPRINTS_COLLECTION]
+        self.state = db[STATE_COLLECTION]
+
+    async def ensure_indexes(self):
+        await self.fingerprints.create_index([("donorId", ASCENDING), ("fingerprint", ASCENDING)])
+        await self.fingerprints.create_index([("uploadId", ASCENDING)])
+
+    async def index_upload(self, upload_id):
+        """
+        Fingerprint the products appended to an upload since it was last
+        indexed. Returns (upload, new_entries) where new_entries are
+        (position, product_id, fingerprint) tuples, or (None, []) if the upload
+        does not exist.
+        """
+        upload, entries = await self._load_new_items(upload_id)
+        if upload is None:
+            return None, []
+        if entries is None:
+            # Positions no longer line up: rebuild this upload
+            await self.reset_upload(upload_id)
+            upload, entries = await self._load_new_items(upload_id)
+        await self._store(upload, entries)
+        return upload, entries
+
+    async def reset_upload(self, upload_id):
+        """Forget what was indexed for an upload; its products are re-indexed from the start."""
+        upload_oid = ObjectId(upload_id)
+        await self.fingerprints.delete_many({"uploadId": upload_oid})
+        await self.state.delete_one({"_id": upload_oid})
+
+    async def _load_new_items(self, upload_id):
+        """
+        Read only the tail of the products array beyond the indexed count and
+        fingerprint it. Returns (upload, None) if the array was rewritten
+        (e.g. shrunk by auto-remove, then appended to again) and the upload
+        has to be re-indexed from the start.
+        """
+        upload_oid = ObjectId(upload_id)
+        state = await self.state.find_one({"_id": upload_oid}) or {}
+        start = state.get("indexedCount", 0)
+
+        projection = {
+            "donerId": 1,
+            "total": {"$size": "$products"},
+            "tail": {"$slice": ["$products", start, _MAX_SLICE]}
+        }
+        if start:
+            projection["anchor"] = {"$arrayElemAt": ["$products", start - 1]}
+        cursor = await self.db["product_uploads"].aggregate([
+            {"$match": {"_id": upload_oid, "products": {"$type": "array"}}},
+            {"$project": projection}
+        ])
+        uploads = await cursor.to_list(length=1)
+        if not uploads:
+            return None, []
+        upload = uploads[0]
+
+        moved = state.get("lastProductId") is not None and upload.get("anchor") != state["lastProductId"]
+        if upload["total"] < start or moved:
+            return upload, None
+        fingerprints = await self._fingerprint_products(upload["tail"])
+        return upload, [(start + offset, product_id, fingerprints.get(product_id))
+                        for offset, product_id in enumerate(upload["tail"])]
+
+    async def _fingerprint_products(self, product_ids, reuse_stored=False):
+        """{product_id: fingerprint}, read from the index when `reuse_stored`, else hashed from products."""
+        fingerprints = {}
+        missing = list(set(product_ids))
+        if reuse_stored and missing:
+            async for row in self.fingerprints.find({"_id": {"$in": missing}}, {"fingerprint": 1}):
+                fingerprints[row["_id"]] = row["fingerprint"]
+            missing = [product_id for product_id in missing if product_id not in fingerprints]
+        if missing:
+            async for product in self.db["products"].find({"_id": {"$in": missing}}, PRODUCT_PROJECTION):
+                fingerprints[product["_id"]] = product_fingerprint(product)
+        return fingerprints
+
+    async def _store(self, upload, entries):
+        now = datetime.utcnow()
+        writes = [
+            UpdateOne(
+                {"_id": product_id},
+                {"$set": {
+                    "fingerprint": fingerprint,
+                    "uploadId": upload["_id"],
+                    "donorId": upload.get("donerId"),
+                    "updatedAt": now
+                }},
+                upsert=True
+            )
+            for _, product_id, fingerprint in entries if fingerprint
+        ]
+        if writes:
+            await self.fingerprints.bulk_write(writes, ordered=False)
+        fields = {"indexedCount": upload["total"], "donorId": upload.get("donerId"), "updatedAt": now}
+        if entries:
+            fields["lastProductId"] = entries[-1][1]
+        await self.state.update_one({"_id": upload["_id"]}, {"$set": fields}, upsert=True)
+
+    async def check_upload(self, upload_id):
+        """
+        Duplicate check by fingerprint: every product of the upload against
+        the fingerprints of the donor's other uploads, and against each
+        other. Lookups use the (donorId, fingerprint) index; products already
+        indexed are not re-read. Nothing is stored.
+        """
+        if not ObjectId.is_valid(upload_id):
+            return None
+        upload_oid = ObjectId(upload_id)
+        upload = await self.db["product_uploads"].find_one(
+            {"_id": upload_oid, "products": {"$type": "array"}}, {"donerId": 1, "products": 1}
+        )
+        if upload is None:
+            return None
+        fingerprints = await self._fingerprint_products(upload["products"], reuse_stored=True)
+        entries = [(position, product_id, fingerprints.get(product_id))
+                   for position, product_id in enumerate(upload["products"])]
+
+        upload_fingerprints = {fp for _, _, fp in entries if fp}
+        earlier = {}
+        if upload_fingerprints:
+            async for row in self.fingerprints.find(
+                {"donorId": upload.get("donerId"), "fingerprint": {"$in": list(upload_fingerprints)},
+                 "uploadId": {"$ne": upload_oid}},
+                {"fingerprint": 1, "uploadId": 1}
+            ):
+                earlier.setdefault(row["fingerprint"], []).append(row)
+            for row in await self._unindexed_rows(upload.get("donerId"), upload_oid, upload_fingerprints):
+                earlier.setdefault(row["fingerprint"], []).append(row)
+
+        duplicates = []
+        matches = []
+        seen_in_upload = {}
+        for position, product_id, fingerprint in entries:
+            if not fingerprint:
+                continue
+            matched = [
+                {"product_id": str(row["_id"]), "upload_id": str(row["uploadId"])}
+                for row in earlier.get(fingerprint, [])
+            ]
+            if fingerprint in seen_in_upload:
+                first_position, first_id = seen_in_upload[fingerprint]
+                matched.append({"product_id": str(first_id), "upload_id": str(upload["_id"]), "position": first_position})
+            else:
+                seen_in_upload[fingerprint] = (position, product_id)
+            if matched:
+                duplicates.append(position)
+                matches.append({"position": position, "product_id": str(product_id), "matches": matched})
+
+        return {
+            "message": "Duplicate products found." if duplicates else "No duplicates found.",
+            "duplicates": duplicates,
+            "matches": matches,
+            "items_checked": len(entries),
+            "status": "flagged" if duplicates else "clean"
+        }
+
+    async def _unindexed_rows(self, donor_id, upload_oid, fingerprints):
+        """
+        Rows like the index's for products of the donor's other uploads that
+        the index has not caught up with yet, restricted to `fingerprints`,
+        so a check does not depend on when the index was last advanced.
+        """
+        cursor = await self.db["product_uploads"].aggregate([
+            {"$match": {"donerId": donor_id, "_id": {"$ne": upload_oid}, "products": {"$type": "array"}}},
+            {"$project": {"total": {"$size": "$products"}}}
+        ])
+        totals = {u["_id"]: u["total"] async for u in cursor}
+        if not totals:
+            return []
+        indexed = {}
+        async for row in self.state.find({"_id": {"$in": list(totals)}}, {"indexedCount": 1}):
+            indexed[row["_id"]] = row.get("indexedCount", 0)
+        rows = []
+        for other_id, total in totals.items():
+            if indexed.get(other_id, 0) == total:
+                continue
+            _, entries = await self._load_new_items(str(other_id))
+            if entries is None:
+                # Rewritten since it was indexed: every product counts
+                other = await self.db["product_uploads"].find_one({"_id": other_id}, {"products": 1})
+                product_ids = other.get("products") or [] if other else []
+                hashed = await self._fingerprint_products(product_ids)
+                entries = [(position, product_id, hashed.get(product_id)) for position, product_id in enumerate(product_ids)]
+            rows.extend({"_id": product_id, "uploadId": other_id, "fingerprint": fingerprint}
+                        for _, product_id, fingerprint in entries if fingerprint in fingerprints)
+        return rows
+
+    async def refresh_changed_products(self):
+        """
+        Re-fingerprint products edited since the last refresh, using the
+        products updatedAt timestamp (with _id as tiebreak) as a watermark.
+        """
+        state = await self.state.find_one({"_id": PRODUCTS_WATERMARK_ID}) or {}
+        since, since_id = state.get("watermark"), state.get("watermarkId")
+        query = {}
+        if since is not None:
+            # Products sharing the watermark's timestamp are not skipped
+            query = {"$or": [{"updatedAt": {"$gt": since}}, {"updatedAt": since, "_id": {"$gt": since_id}}]}
+            if since_id is None:
+                query = {"updatedAt": {"$gte": since}}
+        writes = []
+        last = None
+        async for product in self.db["products"].find(query, dict(PRODUCT_PROJECTION, updatedAt=1)).sort(
+                [("updatedAt", ASCENDING), ("_id", ASCENDING)]):
+            fingerprint = product_fingerprint(product)
+            if fingerprint:
+                # Only products already listed by an indexed upload are updated
+                writes.append(UpdateOne({"_id": product["_id"]}, {"$set": {"fingerprint": fingerprint, "updatedAt": datetime.utcnow()}}))
+            else:
+                writes.append(DeleteOne({"_id": product["_id"]}))
+            if product.get("updatedAt") is not None:
+                last = product
+        if writes:
+            await self.fingerprints.bulk_write(writes, ordered=False)
+        if last is not None:
+            await self.state.update_one(
+                {"_id": PRODUCTS_WATERMARK_ID},
+                {"$set": {"watermark": last["updatedAt"], "watermarkId": last["_id"]}},
+                upsert=True
+            )
+        return len(writes)
+
+    async def sync_uploads(self):
+        """
+        Bring every upload up to date. Only array sizes are read to find the
+        uploads that grew; each of those then indexes just its new tail.
+        """
+        indexed = {}
+        async for row in self.state.find({"_id": {"$ne": PRODUCTS_WATERMARK_ID}}, {"indexedCount": 1}):
+            indexed[row["_id"]] = row.get("indexedCount", 0)
+        cursor = await self.db["product_uploads"].aggregate([
+            {"$match": {"products": {"$type": "array"}}},
+            {"$project": {"total": {"$size": "$products"}}}
+        ])
+        synced = 0
+        async for upload in cursor:
+            if indexed.get(upload["_id"]) != upload["total"]:
+                await self.index_upload(str(upload["_id"]))
+                synced += 1
+        return synced
+
+    async def sync(self):
+        """Advance the index: uploads that grew or changed, then edited products. Returns (uploads, products)."""
+        return await self.sync_uploads(), await self.refresh_changed_products()
+
+    async def run(self, interval=FINGERPRINT_SYNC_SECONDS):
+        """sync() every `interval` seconds until cancelled."""
+        while True:
+            try:
+                uploads, products = await self.sync()
+                if uploads or products:
+                    print(f"[INFO] Fingerprint index synced: {uploads} uploads, {products} changed products")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[ERROR] Fingerprint index sync failed: {e}")
+            await asyncio.sleep(interval)
+
+async def _sync(interval=None):
+    from REC_AGENT.db import create_async_client, DB_NAME
+    client = create_async_client()
+    try:
+        index = FingerprintIndex(client[DB_NAME])
+        await index.ensure_indexes()
+        if interval:
+            await index.run(interval)
+        uploads, products = await index.sync()
+        print(f"[INFO] Fingerprint index synced: {uploads} uploads, {products} changed products")
+    finally:
+        await client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bring the product fingerprint index up to date")
+    parser.add_argument("--interval", type=int, help="keep syncing every INTERVAL seconds")
+    args = parser.parse_args()
+    asyncio.run(_sync(args.interval))
@@ -1,18 +1,88 @@
+import hashlib
 import requests
 import os
+import threading
+from requests.adapters import HTTPAdapter
+from REC_AGENT.llm_gateway import LLMGateway
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")  # Store your key in .env or as an environment variable
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-pro")
+# "gemini" for the real API, "stub" for a local canned backend (tests, offline runs)
+GEMINI_BACKEND = os.getenv("GEMINI_BACKEND", "gemini")
+# (connect, read) seconds
+GEMINI_TIMEOUT = (3.05, float(os.getenv("GEMINI_TIMEOUT", "30")))
+# On-disk response cache; empty to keep responses in memory only
+GEMINI_CACHE_DIR = os.getenv("GEMINI_CACHE_DIR", "REC_AGENT/.gemini_cache")
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+class GeminiBackend:
+    """generateContent over one pooled keep-alive session, with timeouts."""
+
+    def __init__(self, api_key=None, model=GEMINI_MODEL, timeout=GEMINI_TIMEOUT, pool_size=8):
+        self.api_key = api_key or GEMINI_API_KEY
+        self.model = model
+        self.name = f"gemini:{model}"
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def generate(self, prompt, context=None):
+        url = f"https://generativelanguage.googleapis.com/v1beta/models/{self.model}:generateContent"
+        headers = {"Content-Type": "application/json"}
+        data = {
+            "contents": [{"parts": [{"text": prompt}]}]
+        }
+        if context:
+            data["contents"][0]["parts"].append({"text": context})
+        params = {"key": self.api_key}
+        response = self.session.post(url, headers=headers, params=params, json=data, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()["candidates"][0]["content"]["parts"][0]["text"]
+
+class StubBackend:
+    """
+    Local stand-in: canned answers by exact prompt, otherwise a deterministic
+    echo. Never touches the network.
+    """
+    name = "stub"
+
+    def __init__(self, responses=None):
+        self.responses = responses or {}
+        self.calls = 0
+
+    def generate(self, prompt, context=None):
+        self.calls += 1
+        if prompt in self.responses:
+            return self.responses[prompt]
+        digest = hashlib.sha1(f"{prompt}\n{context or ''}".encode("utf-8")).hexdigest()[:8]
+        return f"[stub {digest}] {prompt[:200]}"
+
+def create_backend(kind=None):
+    kind = kind or GEMINI_BACKEND
+    if kind == "stub":
+        return StubBackend()
+    if kind == "gemini":
+        return GeminiBackend()
+    raise ValueError(f"Unknown Gemini backend '{kind}'")
+
+def get_gateway():
+    """The process-wide gateway (response cache + coalescing) in front of the configured backend."""
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = LLMGateway(create_backend(), cache_dir=GEMINI_CACHE_DIR or None)
+    return _gateway
+
+def set_gateway(gateway):
+    """Swap the gateway, e.g. LLMGateway(StubBackend({...})) in tests."""
+    global _gateway
+    _gateway = gateway
 
 def ask_gemini(prompt, context=None):
-    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent"
-    headers = {"Content-Type": "application/json"}
-    data = {
-        "contents": [{"parts": [{"text": prompt}]}]
-    }
-    if context:
-        data["contents"][0]["parts"].append({"text": context})
-    params = {"key": GEMINI_API_KEY}
-    response = requests.post(url, headers=headers, params=params, json=data)
-    response.raise_for_status()
-    return response.json()["candidates"][0]["content"]["parts"][0]["text"]
+    return get_gateway().ask(prompt, context)
 
+def ask_gemini_many(prompts, context=None):
+    return get_gateway().ask_many(prompts, context)
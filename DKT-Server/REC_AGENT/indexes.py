@@ -0,0 +1,150 @@
+import argparse
+import os
+from bson import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+
+# "strict" raises at startup if a hot query would scan its collection, "warn" only logs, "off" skips
+INDEX_CHECK = os.getenv("INDEX_CHECK", "strict")
+
+# Index already there under another name or with other options
+_INDEX_CONFLICTS = {85, 86}
+
+class IndexVerificationError(Exception):
+    pass
+
+# Indexes the REC_AGENT query patterns rely on, on collections owned by the Node app
+INDEXES = [
+    # delivery_watcher: Delivered and not yet verified
+    ("assetsdeleveries", [("status", ASCENDING), ("deliveryVerification", ASCENDING)], {"name": "rec_status_verification"}),
+    # reschedule endpoints, bulk reschedule
+    ("assetsdeleveries", [("shippingDetails.shipment_id", ASCENDING)], {"name": "rec_shipment_id"}),
+    # shipment sweep
+    ("assetsdeleveries", [("shippingDetails.status", ASCENDING)], {"name": "rec_shipping_status"}),
+    # change feed polling fallback
+    ("assetsdeleveries", [("updatedAt", ASCENDING), ("_id", ASCENDING)], {"name": "rec_updated_at"}),
+    # beneficiary_delivery_watcher and the beneficiary check
+    ("beneficiaryrequests", [("status", ASCENDING), ("assignedDetails.status", ASCENDING)], {"name": "rec_status_assigned"}),
+    ("beneficiaryrequests", [("updatedAt", ASCENDING), ("_id", ASCENDING)], {"name": "rec_updated_at"}),
+    # committed quantity from requested products
+    ("requestedproducts", [("partnerId", ASCENDING), ("productId", ASCENDING), ("status", ASCENDING)], {"name": "rec_partner_product_status"}),
+    # donor of a product (enrich_deliveries)
+    ("product_uploads", [("products", ASCENDING)], {"name": "rec_products"}),
+    # near-duplicate check scoped to donors
+    ("product_uploads", [("donerId", ASCENDING)], {"name": "rec_doner"}),
+    # near-duplicate signature sync
+    ("products", [("updatedAt", ASCENDING), ("_id", ASCENDING)], {"name": "rec_updated_at"}),
+]
+
+# Placeholder ID for the hot queries; an empty $in would be planned as EOF and pass without an index
+_PLACEHOLDER_ID = ObjectId()
+
+# Hot queries (collection, filter, sort) whose plans must use an index
+HOT_QUERIES = [
+    ("assetsdeleveries", {"status": "Delivered", "deliveryVerification": {"$exists": False}}, None),
+    ("assetsdeleveries", {"shippingDetails.shipment_id": 0}, None),
+    ("assetsdeleveries", {"shippingDetails.status": "In-progress"}, None),
+    ("beneficiaryrequests", {"status": "Approved", "assignedDetails.status": "Assigned"}, None),
+    ("requestedproducts", {"partnerId": _PLACEHOLDER_ID, "productId": {"$in": [_PLACEHOLDER_ID]}, "status": {"$in": ["Assigned", "Delivered"]}}, None),
+    ("product_uploads", {"products": {"$in": [_PLACEHOLDER_ID]}}, None),
+    ("product_uploads", {"donerId": {"$in": [_PLACEHOLDER_ID]}}, None),
+    ("products", {"updatedAt": {"$gt": 0}}, {"updatedAt": 1, "_id": 1}),
+]
+
+def _explain_command(collection, query, sort):
+    command = {"find": collection, "filter": query}
+    if sort:
+        command["sort"] = sort
+    return {"explain": command, "verbosity": "queryPlanner"}
+
+def _stages(plan):
+    """Every stage name in a winning plan tree (classic and slot-based engines)."""
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for key in ("inputStage", "queryPlan"):
+            if key in plan:
+                yield from _stages(plan[key])
+        for child in plan.get("inputStages", []):
+            yield from _stages(child)
+
+def _plan_problem(collection, query, explain):
+    winning = explain.get("queryPlanner", {}).get("winningPlan", {})
+    if "COLLSCAN" in set(_stages(winning)):
+        return f"{collection} {query}: COLLSCAN"
+    return None
+
+def _report(problems, mode):
+    if not problems:
+        print("[INFO] All hot REC_AGENT queries use an index")
+        return
+    message = "Hot queries without an index:\n  " + "\n  ".join(problems)
+    if mode == "strict":
+        raise IndexVerificationError(message)
+    print(f"[WARNING] {message}")
+
+def ensure_indexes(db, create=True):
+    """
+    Create (or with create=False only check for) every declared index.
+    Returns the list of missing indexes when not creating.
+    """
+    missing = []
+    for collection, keys, options in INDEXES:
+        if create:
+            try:
+                db[collection].create_index(keys, **options)
+            except OperationFailure as e:
+                if e.code not in _INDEX_CONFLICTS:
+                    raise
+        else:
+            existing = [list(info["key"]) for info in db[collection].index_information().values()]
+            if [tuple(k) for k in keys] not in [[tuple(k) for k in e] for e in existing]:
+                missing.append(f"{collection} {keys}")
+    return missing
+
+def verify_query_plans(db, mode=None):
+    """Explain every hot query; raise IndexVerificationError (strict) or log if any is a COLLSCAN."""
+    mode = mode or INDEX_CHECK
+    if mode == "off":
+        return []
+    problems = []
+    for collection, query, sort in HOT_QUERIES:
+        explain = db.command(_explain_command(collection, query, sort))
+        problem = _plan_problem(collection, query, explain)
+        if problem:
+            problems.append(problem)
+    _report(problems, mode)
+    return problems
+
+async def ensure_indexes_async(db):
+    """ensure_indexes for the API's async client."""
+    for collection, keys, options in INDEXES:
+        try:
+            await db[collection].create_index(keys, **options)
+        except OperationFailure as e:
+            if e.code not in _INDEX_CONFLICTS:
+                raise
+
+async def verify_query_plans_async(db, mode=None):
+    mode = mode or INDEX_CHECK
+    if mode == "off":
+        return []
+    problems = []
+    for collection, query, sort in HOT_QUERIES:
+        explain = await db.command(_explain_command(collection, query, sort))
+        problem = _plan_problem(collection, query, explain)
+        if problem:
+            problems.append(problem)
+    _report(problems, mode)
+    return problems
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create and verify the indexes REC_AGENT queries rely on")
+    parser.add_argument("--verify-only", action="store_true", help="do not create anything, only report")
+    args = parser.parse_args()
+    from REC_AGENT.db import get_sync_db
+    db = get_sync_db()
+    missing = ensure_indexes(db, create=not args.verify_only)
+    for index in missing:
+        print(f"[WARNING] Missing index: {index}")
+    verify_query_plans(db, mode="warn" if args.verify_only else None)
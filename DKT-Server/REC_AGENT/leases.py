@@ -0,0 +1,128 @@
+import os
+import socket
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+LEASES_COLLECTION = "watcher_leases"
+LEASE_SECONDS = int(os.getenv("WATCHER_LEASE_SECONDS", "120"))
+# Completed leases are removed by a TTL index after this long; by then the
+# watcher's checkpoint store has the item, so it is not processed again
+LEASE_RETENTION_SECONDS = int(os.getenv("WATCHER_LEASE_RETENTION_SECONDS", str(7 * 24 * 3600)))
+
+CLAIMED = "claimed"
+DONE = "done"
+
+def default_worker_id():
+    """Unique per process: WATCHER_ID, or host:pid."""
+    return os.getenv("WATCHER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+def stable_worker_name():
+    """
+    Per-worker name that survives restarts (WATCHER_ID, or the host name),
+    for state like change-stream resume tokens. Set WATCHER_ID when running
+    several workers on one host.
+    """
+    return os.getenv("WATCHER_ID") or socket.gethostname()
+
+class LeaseManager:
+    """
+    Work claims shared by every watcher process, so several can run at once.
+
+    A worker claims an item (a delivery, a request) with one atomic
+    findOneAndUpdate; the claim is a lease that expires after `lease_seconds`
+    unless completed or renewed. Items whose lease ran out (the worker
+    crashed) can be claimed again by anyone through claim_expired(), and a
+    completed item is not claimed again. Completed leases expire after
+    `retention_seconds` (TTL index on expireAt), so the collection holds
+    only recent work.
+    """
+
+    def __init__(self, db, namespace, worker_id=None, lease_seconds=LEASE_SECONDS,
+                 retention_seconds=LEASE_RETENTION_SECONDS):
+        self.collection = db[LEASES_COLLECTION]
+        self.namespace = namespace
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.retention_seconds = retention_seconds
+
+    def ensure_indexes(self):
+        self.collection.create_index([("namespace", ASCENDING), ("status", ASCENDING), ("leaseUntil", ASCENDING)])
+        self.collection.create_index([("expireAt", ASCENDING)], expireAfterSeconds=0)
+
+    def _id(self, key):
+        return f"{self.namespace}:{key}"
+
+    def claim(self, key):
+        """True if this worker now holds the lease on `key`."""
+        now = datetime.utcnow()
+        try:
+            lease = self.collection.find_one_and_update(
+                {
+                    "_id": self._id(key),
+                    "status": CLAIMED,
+                    "$or": [{"leaseUntil": {"$lt": now}}, {"owner": self.worker_id}]
+                },
+                {
+                    "$set": {"owner": self.worker_id, "leaseUntil": now + timedelta(seconds=self.lease_seconds)},
+                    "$setOnInsert": {"namespace": self.namespace, "key": str(key), "claimedAt": now},
+                    "$inc": {"attempts": 1}
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The lease exists and is held by another live worker, or is done
+            return False
+        return lease is not None
+
+    def claim_many(self, keys):
+        """The subset of `keys` this worker claimed, in order."""
+        return [key for key in keys if self.claim(key)]
+
+    def claim_expired(self, limit=100):
+        """
+        Take over items whose worker stopped renewing its lease. Returns their
+        keys; the caller reloads and processes them.
+        """
+        keys = []
+        while len(keys) < limit:
+            now = datetime.utcnow()
+            lease = self.collection.find_one_and_update(
+                {"namespace": self.namespace, "status": CLAIMED, "leaseUntil": {"$lt": now}},
+                {
+                    "$set": {"owner": self.worker_id, "leaseUntil": now + timedelta(seconds=self.lease_seconds)},
+                    "$inc": {"attempts": 1}
+                },
+                sort=[("leaseUntil", ASCENDING)],
+                return_document=ReturnDocument.AFTER
+            )
+            if lease is None:
+                break
+            keys.append(lease["key"])
+        return keys
+
+    def renew(self, key):
+        result = self.collection.update_one(
+            {"_id": self._id(key), "owner": self.worker_id, "status": CLAIMED},
+            {"$set": {"leaseUntil": datetime.utcnow() + timedelta(seconds=self.lease_seconds)}}
+        )
+        return result.modified_count == 1
+
+    def complete(self, key):
+        now = datetime.utcnow()
+        result = self.collection.update_one(
+            {"_id": self._id(key), "owner": self.worker_id},
+            {
+                "$set": {"status": DONE, "completedAt": now, "expireAt": now + timedelta(seconds=self.retention_seconds)},
+                "$unset": {"leaseUntil": ""}
+            }
+        )
+        return result.modified_count == 1
+
+    def release(self, key):
+        """Give the item back immediately, e.g. after a failure, so another worker can retry it."""
+        self.collection.update_one(
+            {"_id": self._id(key), "owner": self.worker_id, "status": CLAIMED},
+            {"$set": {"leaseUntil": datetime.utcnow()}}
+        )
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from REC_AGENT.metrics import counter, histogram
+from REC_AGENT.ttl_cache import TTLCache
+
+LLM_SECONDS = histogram("llm_request_seconds", "LLM backend call latency", ["backend", "outcome"])
+LLM_LOOKUPS = counter("llm_lookups_total", "LLM gateway lookups by where the answer came from", ["backend", "source"])
+
+class LLMGateway:
+    """
+    Front for an LLM backend (anything with `name` and `generate(prompt, context)`).
+
+    Responses are cached by a SHA-256 of (backend, prompt, context): first
+    in an in-memory LRU, then on disk as one JSON file per response, so
+    repeated prompts cost nothing across restarts. Identical prompts that
+    are already in flight wait for the same call instead of issuing their own.
+    """
+
+    def __init__(self, backend, cache_dir=None, max_entries=2048, max_concurrency=4):
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.memory = TTLCache(maxsize=max_entries, ttl=float("inf"))
+        self.max_concurrency = max_concurrency
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "coalesced": 0, "calls": 0, "errors": 0, "disk_errors": 0}
+
+    def cache_key(self, prompt, context=None):
+        payload = json.dumps([self.backend.name, prompt, context], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _read_disk(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._disk_path(key), "r", encoding="utf-8") as f:
+                return json.load(f)["response"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_disk(self, key, prompt, response):
+        """Best effort: a response that cannot be stored is still returned, just not cached on disk."""
+        if not self.cache_dir:
+            return
+        path = self._disk_path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"backend": self.backend.name, "prompt": prompt, "response": response}, f, ensure_ascii=False)
+            # Readers never see a half-written file
+            os.replace(tmp, path)
+        except (OSError, TypeError, ValueError) as e:
+            self.stats["disk_errors"] += 1
+            print(f"[WARNING] LLM gateway: could not write {path}: {e}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def ask(self, prompt, context=None):
+        key = self.cache_key(prompt, context)
+        response = self.memory.get(key)
+        if response is not None:
+            self.stats["memory_hits"] += 1
+            LLM_LOOKUPS.inc(backend=self.backend.name, source="memory")
+            return response
+        response = self._read_disk(key)
+        if response is not None:
+            self.stats["disk_hits"] += 1
+            LLM_LOOKUPS.inc(backend=self.backend.name, source="disk")
+            self.memory.set(key, response)
+            return response
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            self.stats["coalesced"] += 1
+            LLM_LOOKUPS.inc(backend=self.backend.name, source="coalesced")
+            return future.result()
+
+        try:
+            self.stats["calls"] += 1
+            LLM_LOOKUPS.inc(backend=self.backend.name, source="call")
+            with LLM_SECONDS.time(backend=self.backend.name, outcome="error") as labels:
+                response = self.backend.generate(prompt, context)
+                labels["outcome"] = "ok"
+            self.memory.set(key, response)
+            future.set_result(response)
+        except Exception as e:
+            self.stats["errors"] += 1
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+        self._write_disk(key, prompt, response)
+        return response
+
+    def ask_many(self, prompts, context=None):
+        """
+        Answers for a list of prompts, in order. Duplicates and cached prompts
+        are served without a call; the remaining calls run concurrently (at
+        most max_concurrency at a time). An answer that failed is the exception.
+        """
+        unique = list(dict.fromkeys(prompts))
+        answers = {}
+        if len(unique) == 1 or self.max_concurrency <= 1:
+            for prompt in unique:
+                answers[prompt] = self._ask_or_error(prompt, context)
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(unique))) as executor:
+                for prompt, answer in zip(unique, executor.map(lambda p: self._ask_or_error(p, context), unique)):
+                    answers[prompt] = answer
+        return [answers[prompt] for prompt in prompts]
+
+    def _ask_or_error(self, prompt, context):
+        try:
+            return self.ask(prompt, context)
+        except Exception as e:
+            return e
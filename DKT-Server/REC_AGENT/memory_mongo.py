@@ -0,0 +1,177 @@
+from pymongo.errors import OperationFailure
+
+# Options the async driver accepts that mongomock does not know
+_IGNORED_OPTIONS = ("allowDiskUse", "session", "comment", "hint", "maxTimeMS")
+
+def _strip(kwargs):
+    for option in _IGNORED_OPTIONS:
+        kwargs.pop(option, None)
+    return kwargs
+
+class MemoryCursor:
+    """Async cursor over a mongomock cursor or a list of documents."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        self._cursor = self._cursor.sort(*args, **kwargs)
+        return self
+
+    def limit(self, n):
+        self._cursor = self._cursor.limit(n)
+        return self
+
+    def skip(self, n):
+        self._cursor = self._cursor.skip(n)
+        return self
+
+    def batch_size(self, n):
+        return self
+
+    async def to_list(self, length=None):
+        documents = list(self._cursor)
+        return documents if length is None else documents[:length]
+
+    def __aiter__(self):
+        self._iterator = iter(self._cursor)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+
+class _BulkResult:
+    def __init__(self, counts):
+        self.inserted_count = counts["inserted"]
+        self.matched_count = counts["matched"]
+        self.modified_count = counts["modified"]
+        self.deleted_count = counts["deleted"]
+        self.upserted_count = counts["upserted"]
+
+class _BulkReader:
+    """
+    Collects write models (InsertOne, UpdateOne, ...) through the calls the
+    driver makes on any bulk builder (add_insert, add_update, add_replace,
+    add_delete), rather than reading each model's private fields.
+    """
+
+    def __init__(self):
+        self.operations = []
+
+    def add_insert(self, document):
+        self.operations.append(("insert_one", document))
+
+    def add_update(self, selector, update, multi, upsert, **kwargs):
+        self.operations.append(("update_many" if multi else "update_one", selector, update, bool(upsert)))
+
+    def add_replace(self, selector, replacement, upsert, **kwargs):
+        self.operations.append(("replace_one", selector, replacement, bool(upsert)))
+
+    def add_delete(self, selector, limit, **kwargs):
+        self.operations.append(("delete_one" if limit == 1 else "delete_many", selector))
+
+class MemoryCollection:
+    """AsyncCollection-shaped wrapper around a mongomock collection."""
+
+    def __init__(self, collection):
+        self.sync = collection
+        self.name = collection.name
+
+    def find(self, *args, **kwargs):
+        return MemoryCursor(self.sync.find(*args, **_strip(kwargs)))
+
+    async def aggregate(self, pipeline, **kwargs):
+        return MemoryCursor(self.sync.aggregate(pipeline, **_strip(kwargs)))
+
+    async def bulk_write(self, requests, ordered=True, **kwargs):
+        # mongomock's bulk_write does not understand current pymongo operation objects
+        counts = dict.fromkeys(("inserted", "matched", "modified", "deleted", "upserted"), 0)
+        reader = _BulkReader()
+        for op in requests:
+            op._add_to_bulk(reader)
+        for method, *args in reader.operations:
+            if method == "insert_one":
+                self.sync.insert_one(*args)
+                counts["inserted"] += 1
+            elif method in ("delete_one", "delete_many"):
+                counts["deleted"] += getattr(self.sync, method)(*args).deleted_count
+            else:
+                selector, document, upsert = args
+                result = getattr(self.sync, method)(selector, document, upsert=upsert)
+                counts["matched"] += result.matched_count
+                counts["modified"] += result.modified_count
+                counts["upserted"] += result.upserted_id is not None
+        return _BulkResult(counts)
+
+    async def watch(self, *args, **kwargs):
+        # Like a standalone mongod: callers fall back to polling
+        raise OperationFailure("The $changeStream stage is only supported on replica sets", code=40573)
+
+    def __getattr__(self, name):
+        method = getattr(self.sync, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **_strip(kwargs))
+        return call
+
+class _MemorySession:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def start_transaction(self):
+        # Same answer as a standalone mongod, so callers take their non-transactional path
+        raise OperationFailure("Transaction numbers are only allowed on a replica set member or mongos", code=20)
+
+class MemoryClient:
+    def __init__(self, sync_client):
+        self.sync = sync_client
+
+    def start_session(self, **kwargs):
+        return _MemorySession()
+
+    def __getitem__(self, name):
+        return MemoryDatabase(self.sync[name], self)
+
+    async def close(self):
+        self.sync.close()
+
+class MemoryDatabase:
+    """
+    In-memory stand-in for an AsyncMongoClient database, backed by mongomock
+    (optional dependency, `pip install mongomock`). Good enough for the
+    reconciliation code paths in benchmarks and offline runs; features
+    mongomock lacks (change streams, explain, some aggregation operators)
+    raise as they would on an unsupported server.
+
+    `.sync` is the matching synchronous database for the watcher-side code.
+    """
+
+    def __init__(self, sync_db, client=None):
+        self.sync = sync_db
+        self.name = sync_db.name
+        self.client = client or MemoryClient(sync_db.client)
+
+    def __getitem__(self, name):
+        return MemoryCollection(self.sync[name])
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return MemoryCollection(self.sync[name])
+
+    async def command(self, *args, **kwargs):
+        return self.sync.command(*args, **kwargs)
+
+def create_memory_db(db_name="reconciliation"):
+    """A fresh, empty in-memory database (async handle; `.sync` for the sync one)."""
+    try:
+        import mongomock
+    except ImportError:
+        raise RuntimeError("The in-memory backend needs mongomock: pip install mongomock")
+    return MemoryDatabase(mongomock.MongoClient()[db_name])
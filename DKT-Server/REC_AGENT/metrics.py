@@ -0,0 +1,244 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pymongo import monitoring
+
+# Seconds; covers a fast indexed query up to a slow Shiprocket or Gemini call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Watcher backlog counts stop at this many documents, and are refreshed at most this often
+BACKLOG_COUNT_LIMIT = 100000
+BACKLOG_REFRESH_SECONDS = 30
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (the last one is +Inf), sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block; `labels` may be updated inside it (e.g. an outcome)."""
+        started = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self, key, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            le = [("le", _format_value(float(bound)) if bound != float("inf") else "+Inf")]
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def get_or_create(self, cls, name, description, labelnames=(), **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, description, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} is already registered with another type or labels")
+            return metric
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def counter(name, description, labelnames=()):
+    return REGISTRY.get_or_create(Counter, name, description, labelnames)
+
+def gauge(name, description, labelnames=()):
+    return REGISTRY.get_or_create(Gauge, name, description, labelnames)
+
+def histogram(name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.get_or_create(Histogram, name, description, labelnames, buckets=buckets)
+
+# Mongo
+
+MONGO_COMMAND_SECONDS = histogram(
+    "mongo_command_seconds", "MongoDB command latency by collection and command", ["collection", "command", "outcome"]
+)
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every command a client sends; see install_mongo_listener."""
+
+    def __init__(self):
+        self._collections = {}
+
+    @staticmethod
+    def _event_key(event):
+        return (event.connection_id, event.request_id, event.operation_id)
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            target = event.command.get("collection")
+        self._collections[self._event_key(event)] = target if isinstance(target, str) else ""
+
+    def _finish(self, event, outcome):
+        collection = self._collections.pop(self._event_key(event), "")
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, collection=collection,
+                                      command=event.command_name, outcome=outcome)
+
+    def succeeded(self, event):
+        self._finish(event, "ok")
+
+    def failed(self, event):
+        self._finish(event, "error")
+
+_mongo_listener = None
+_mongo_listener_lock = threading.Lock()
+
+def install_mongo_listener():
+    """
+    Register the command listener globally. It applies to clients created
+    afterwards, so call it before creating them (db.py does so on import).
+    """
+    global _mongo_listener
+    with _mongo_listener_lock:
+        if _mongo_listener is None:
+            _mongo_listener = MongoCommandMetrics()
+            monitoring.register(_mongo_listener)
+    return _mongo_listener
+
+# Watchers
+
+WATCHER_BACKLOG = gauge("watcher_backlog", "Documents matching the watcher query (capped at BACKLOG_COUNT_LIMIT)", ["watcher"])
+WATCHER_BATCH_SECONDS = histogram("watcher_batch_seconds", "Time to handle one watcher batch", ["watcher"])
+WATCHER_DOCUMENTS = counter("watcher_documents_total", "Documents handled by a watcher", ["watcher"])
+WATCHER_ERRORS = counter("watcher_errors_total", "Watcher batches that failed", ["watcher"])
+
+_backlog_checked = {}
+
+def observe_backlog(db, watcher, collection, query):
+    """Refresh the watcher_backlog gauge, at most every BACKLOG_REFRESH_SECONDS."""
+    now = time.monotonic()
+    if now - _backlog_checked.get(watcher, float("-inf")) < BACKLOG_REFRESH_SECONDS:
+        return
+    _backlog_checked[watcher] = now
+    WATCHER_BACKLOG.set(db[collection].count_documents(query, limit=BACKLOG_COUNT_LIMIT), watcher=watcher)
+
+# Exposition for processes without the API (watchers, sweep)
+
+def start_metrics_server(port=None, host="0.0.0.0"):
+    """
+    Serve GET /metrics from a background thread. Without a port (argument or
+    the METRICS_PORT environment variable) nothing is started. Returns the
+    server or None.
+    """
+    port = port or os.getenv("METRICS_PORT")
+    if not port:
+        return None
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            payload = REGISTRY.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[INFO] Metrics on http://{host}:{server.server_port}/metrics")
+    return server
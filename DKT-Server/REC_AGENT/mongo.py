@@ -1,13 +1,12 @@
 from pymongo import MongoClient
-import pandas as pd
-df = pd.read_csv("C:/Users/rj054/OneDrive/Desktop/rec-chatbot/DKT-Server/REC_AGENT/sample.csv")
-print(df)
+from REC_AGENT.csv_ingest import ingest_csv
 client = MongoClient("mongodb://localhost:27017")
 db = client["reconciliation"]
-collection = db["product_uploads"]
 
-asset_id = collection.insert_one({
-    "csv_data": df.to_dict(orient="records")
-}).inserted_id
+# Streams the CSV in chunks instead of loading it whole
+result = ingest_csv("C:/Users/rj054/OneDrive/Desktop/rec-chatbot/DKT-Server/REC_AGENT/sample.csv", db=db)
+print(result["stats"])
+
+asset_id = result["upload_id"]
 
 print("Test Asset ID:", asset_id)
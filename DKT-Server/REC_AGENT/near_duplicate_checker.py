@@ -0,0 +1,461 @@
+import asyncio
+import hashlib
+import os
+import random
+import re
+import zlib
+from datetime import datetime
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DeleteOne, UpdateOne
+
+# Product fields that identify a physical device, in signature order
+SIGNATURE_FIELDS = ["manufacturer", "model", "name"]
+SPECIFICATION_FIELDS = ["processor", "RAM", "storage"]
+
+PRODUCT_PROJECTION = {
+    "name": 1, "model": 1, "manufacturer": 1, "specification": 1, "donorId": 1
+}
+
+# Stored per product: signature text, LSH band keys and model key
+SIGNATURES_COLLECTION = "near_duplicate_signatures"
+SIGNATURE_STATE_COLLECTION = "near_duplicate_signature_state"
+SIGNATURE_STATE_ID = "products"
+SIGNATURE_WRITE_BATCH = 1000
+# Scoped checks look up candidates for this many products per query
+SCOPE_CHUNK_SIZE = 1000
+# The API brings the stored signatures up to date in the background this often (0 disables)
+NEAR_DUPLICATE_SYNC_SECONDS = int(os.getenv("NEAR_DUPLICATE_SYNC_SECONDS", "300"))
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+def normalize_text(value):
+    """Lowercase, drop punctuation and collapse whitespace ("M-1234 " -> "m 1234")."""
+    if value is None:
+        return ""
+    value = re.sub(r"[^0-9a-z]+", " ", str(value).lower())
+    return " ".join(value.split())
+
+def product_signature(product):
+    """
+    Normalized text describing the device: manufacturer, model, name and the
+    processor/RAM/storage specification. Description and condition are left
+    out on purpose, they differ between two registrations of the same laptop.
+    """
+    parts = [normalize_text(product.get(field)) for field in SIGNATURE_FIELDS]
+    spec = product.get("specification") or {}
+    if isinstance(spec, dict):
+        parts.extend(normalize_text(spec.get(field)) for field in SPECIFICATION_FIELDS)
+    else:
+        parts.append(normalize_text(spec))
+    return " ".join(part for part in parts if part)
+
+def shingles(text, k=3):
+    """Character k-grams of the signature, plus whole tokens so short models still match."""
+    if not text:
+        return set()
+    grams = {text[i:i + k] for i in range(max(len(text) - k + 1, 1))}
+    grams.update(text.split())
+    return grams
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+class MinHasher:
+    """MinHash signatures with num_perm universal hash functions over crc32 of each shingle."""
+
+    def __init__(self, num_perm=64, seed=1):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self.params = [
+            (rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
+
+    def signature(self, shingle_set):
+        hashes = [zlib.crc32(s.encode("utf-8")) for s in shingle_set]
+        if not hashes:
+            return None
+        return [
+            min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+            for a, b in self.params
+        ]
+
+class _UnionFind:
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        self.parent.setdefault(x, x)
+        while self.parent[x] != x:
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[root_b] = root_a
+
+class NearDuplicateIndex:
+    """
+    Blocking index for near-duplicate products. Each product is placed in
+    LSH band buckets (bands x rows of its MinHash signature) and in an exact
+    bucket for its normalized manufacturer+model. Only products sharing a
+    bucket are compared, so the work stays close to linear in the number of
+    products instead of O(n^2).
+
+    Buckets over `max_bucket_size` (a very common model, or mass duplication
+    of one) are not compared pairwise; their members are grouped by exact
+    signature instead, so identical registrations are still flagged.
+    """
+
+    def __init__(self, threshold=0.7, model_threshold=0.3, num_perm=64, bands=16, max_bucket_size=200):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.model_threshold = model_threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_bucket_size = max_bucket_size
+        self.hasher = MinHasher(num_perm)
+        # Stored band keys are only valid for the same hashing parameters
+        self.version = f"minhash-{num_perm}x{bands}"
+        self.texts = {}
+        self.shingles = {}
+        self.model_keys = {}
+        self.buckets = {}
+
+    def describe(self, product):
+        """(signature text, band keys, model key) of a product, or None if it has no signature."""
+        text = product_signature(product)
+        signature = self.hasher.signature(shingles(text))
+        if signature is None:
+            return None
+        bands = []
+        for band in range(self.bands):
+            rows = ",".join(str(v) for v in signature[band * self.rows:(band + 1) * self.rows])
+            bands.append(f"{band}:{hashlib.blake2b(rows.encode(), digest_size=8).hexdigest()}")
+        model = normalize_text(product.get("model"))
+        model_key = f"{normalize_text(product.get('manufacturer'))}|{model}" if model else None
+        return text, bands, model_key
+
+    def add(self, key, product):
+        described = self.describe(product)
+        if described is not None:
+            self.add_described(key, *described)
+
+    def add_described(self, key, text, bands, model_key):
+        """add() for a product already described (e.g. loaded from SignatureStore)."""
+        self.texts[key] = text
+        self.shingles[key] = shingles(text)
+        for band_key in bands:
+            self.buckets.setdefault(("lsh", band_key), []).append(key)
+        if model_key:
+            self.model_keys[key] = model_key
+            self.buckets.setdefault(("model", model_key), []).append(key)
+
+    def find_pairs(self):
+        """
+        Returns (pairs, stats). pairs maps (key_a, key_b) to the Jaccard
+        similarity of every candidate pair that passed verification.
+        """
+        pairs = {}
+        compared = set()
+        oversized_buckets = 0
+        for bucket in self.buckets.values():
+            if len(bucket) < 2:
+                continue
+            if len(bucket) > self.max_bucket_size:
+                # Pairwise comparison would bring back the O(n^2) blow-up; chain the
+                # exact copies instead (cluster_pairs joins them into one group)
+                oversized_buckets += 1
+                identical = {}
+                for key in bucket:
+                    identical.setdefault(self.texts[key], []).append(key)
+                for keys in identical.values():
+                    keys.sort()
+                    for a, b in zip(keys, keys[1:]):
+                        pairs[(a, b)] = 1.0
+                continue
+            for i in range(len(bucket)):
+                for j in range(i + 1, len(bucket)):
+                    pair = (bucket[i], bucket[j]) if bucket[i] < bucket[j] else (bucket[j], bucket[i])
+                    if pair in compared:
+                        continue
+                    compared.add(pair)
+                    similarity = jaccard(self.shingles[pair[0]], self.shingles[pair[1]])
+                    same_model = (
+                        pair[0] in self.model_keys
+                        and self.model_keys.get(pair[0]) == self.model_keys.get(pair[1])
+                    )
+                    if similarity >= self.threshold or (same_model and similarity >= self.model_threshold):
+                        pairs[pair] = similarity
+        stats = {
+            "products_indexed": len(self.shingles),
+            "pairs_compared": len(compared),
+            "oversized_buckets": oversized_buckets
+        }
+        return pairs, stats
+
+def cluster_pairs(pairs):
+    """Group verified pairs into clusters (connected components)."""
+    uf = _UnionFind()
+    for a, b in pairs:
+        uf.union(a, b)
+    clusters = {}
+    for a, b in pairs:
+        root = uf.find(a)
+        cluster = clusters.setdefault(root, {"members": set(), "max_similarity": 0.0})
+        cluster["members"].update((a, b))
+        cluster["max_similarity"] = max(cluster["max_similarity"], pairs[(a, b)])
+    return list(clusters.values())
+
+class SignatureStore:
+    """
+    Persisted near-duplicate signatures, one document per product:
+    {_id: productId, text, bands, modelKey}. sync() only describes products
+    changed since the last sync (products updatedAt, with _id as tiebreak),
+    so a check no longer re-hashes the whole catalogue; prune() drops the
+    signatures of deleted products. run() does both in the background.
+    """
+
+    def __init__(self, db, index=None):
+        self.db = db
+        self.signatures = db[SIGNATURES_COLLECTION]
+        self.state = db[SIGNATURE_STATE_COLLECTION]
+        self.index = index or NearDuplicateIndex()
+
+    async def ensure_indexes(self):
+        await self.signatures.create_index([("bands", ASCENDING)])
+        await self.signatures.create_index([("modelKey", ASCENDING)])
+
+    def _write(self, product):
+        described = self.index.describe(product)
+        if described is None:
+            return DeleteOne({"_id": product["_id"]})
+        text, bands, model_key = described
+        return UpdateOne(
+            {"_id": product["_id"]},
+            {"$set": {"text": text, "bands": bands, "modelKey": model_key, "updatedAt": datetime.utcnow()}},
+            upsert=True
+        )
+
+    async def _describe_products(self, query):
+        writes = []
+        count = 0
+        last = None
+        async for product in self.db["products"].find(query, dict(PRODUCT_PROJECTION, updatedAt=1)).sort(
+                [("updatedAt", ASCENDING), ("_id", ASCENDING)]):
+            writes.append(self._write(product))
+            count += 1
+            if product.get("updatedAt") is not None:
+                last = product
+            if len(writes) >= SIGNATURE_WRITE_BATCH:
+                await self.signatures.bulk_write(writes, ordered=False)
+                writes = []
+        if writes:
+            await self.signatures.bulk_write(writes, ordered=False)
+        return count, last
+
+    async def sync(self):
+        """Describe the products changed since the last sync (every product the first time). Returns the count."""
+        state = await self.state.find_one({"_id": SIGNATURE_STATE_ID}) or {}
+        if state and state.get("version") != self.index.version:
+            await self.signatures.delete_many({})
+            state = {}
+        watermark, last_id = state.get("watermark"), state.get("watermarkId")
+        query = {}
+        if watermark is not None:
+            query = {"$or": [{"updatedAt": {"$gt": watermark}}, {"updatedAt": watermark, "_id": {"$gt": last_id}}]}
+        count, last = await self._describe_products(query)
+        if last is not None or not state:
+            fields = {"version": self.index.version, "updatedAt": datetime.utcnow()}
+            if last is not None:
+                fields.update(watermark=last["updatedAt"], watermarkId=last["_id"])
+            await self.state.update_one({"_id": SIGNATURE_STATE_ID}, {"$set": fields}, upsert=True)
+        return count
+
+    async def prune(self, ids=None):
+        """Delete the signatures of products that no longer exist (of `ids`, or all). Returns the count."""
+        query = {} if ids is None else {"_id": {"$in": list(ids)}}
+        removed = 0
+        chunk = []
+        async for doc in self.signatures.find(query, {"_id": 1}):
+            chunk.append(doc["_id"])
+            if len(chunk) >= SIGNATURE_WRITE_BATCH:
+                removed += await self._prune_chunk(chunk)
+                chunk = []
+        if chunk:
+            removed += await self._prune_chunk(chunk)
+        return removed
+
+    async def _prune_chunk(self, ids):
+        existing = {doc["_id"] async for doc in self.db["products"].find({"_id": {"$in": ids}}, {"_id": 1})}
+        gone = [i for i in ids if i not in existing]
+        if not gone:
+            return 0
+        return (await self.signatures.delete_many({"_id": {"$in": gone}})).deleted_count
+
+    async def run(self, interval=NEAR_DUPLICATE_SYNC_SECONDS):
+        """sync() and prune() every `interval` seconds until cancelled."""
+        while True:
+            try:
+                synced = await self.sync()
+                pruned = await self.prune()
+                if synced or pruned:
+                    print(f"[INFO] Near-duplicate signatures synced: {synced} changed, {pruned} removed")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[ERROR] Near-duplicate signature sync failed: {e}")
+            await asyncio.sleep(interval)
+
+    async def load(self, product_ids):
+        """Signature documents of `product_ids`; products never described (no updatedAt) are described now."""
+        product_ids = list(product_ids)
+        docs = await self.signatures.find({"_id": {"$in": product_ids}}).to_list(None)
+        missing = set(product_ids) - {doc["_id"] for doc in docs}
+        if missing:
+            await self._describe_products({"_id": {"$in": list(missing)}})
+            docs += await self.signatures.find({"_id": {"$in": list(missing)}}).to_list(None)
+        return docs
+
+    async def candidates(self, docs):
+        """Signature documents sharing a band or model bucket with any of `docs` (including them)."""
+        bands = sorted({band for doc in docs for band in doc.get("bands", [])})
+        models = sorted({doc["modelKey"] for doc in docs if doc.get("modelKey")})
+        query = {"$or": [{"bands": {"$in": bands}}] + ([{"modelKey": {"$in": models}}] if models else [])}
+        return await self.signatures.find(query).to_list(None) if bands else []
+
+class NearDuplicateChecker:
+    def __init__(self, db):
+        """`db` is an async database handle (the API's shared client)."""
+        self.db = db
+        self.signatures = SignatureStore(db)
+
+    async def ensure_indexes(self):
+        await self.signatures.ensure_indexes()
+
+    async def load_product_owners(self, product_ids):
+        """
+        Map product _id -> (upload _id, donor _id) from product_uploads, for
+        `product_ids` only. Products do not store their donor, the upload that
+        lists them does.
+        """
+        product_ids = list(product_ids)
+        owners = {}
+        cursor = await self.db["product_uploads"].aggregate([
+            {"$match": {"products": {"$in": product_ids}}},
+            {"$project": {"products": 1, "donerId": 1}},
+            {"$unwind": "$products"},
+            {"$match": {"products": {"$in": product_ids}}},
+            {"$project": {"_id": 0, "product": "$products", "upload": "$_id", "donor": "$donerId"}}
+        ], allowDiskUse=True)
+        async for row in cursor:
+            owners.setdefault(row["product"], (row["upload"], row.get("donor")))
+        return owners
+
+    async def scope_products(self, upload_ids=None, donor_ids=None):
+        """Product IDs listed by the given uploads or by any upload of the given donors; None means everything."""
+        upload_oids = [ObjectId(u) for u in upload_ids or [] if ObjectId.is_valid(u)]
+        donor_oids = [ObjectId(d) for d in donor_ids or [] if ObjectId.is_valid(d)]
+        if not upload_ids and not donor_ids:
+            return None
+        clauses = []
+        if upload_oids:
+            clauses.append({"_id": {"$in": upload_oids}})
+        if donor_oids:
+            clauses.append({"donerId": {"$in": donor_oids}})
+        products = set()
+        if clauses:
+            async for upload in self.db["product_uploads"].find({"$or": clauses}, {"products": 1}):
+                products.update(upload.get("products") or [])
+        return products
+
+    async def find_near_duplicates(self, upload_ids=None, donor_ids=None, threshold=0.7, cross_donor_only=False):
+        """
+        Report clusters of likely duplicates across uploads and donors.
+
+        Only the products listed by `upload_ids` / `donor_ids` (one of them is
+        required, a ValueError otherwise) and the products sharing a bucket
+        with them are matched, and a reported cluster must touch the scope.
+        Signatures are read from the SignatureStore, which SignatureStore.run
+        keeps current in the background; scope products never described yet
+        are described on the spot.
+        """
+        scope = await self.scope_products(upload_ids, donor_ids)
+        if scope is None:
+            raise ValueError("Provide upload_ids or donor_ids to scope the near-duplicate check")
+        scope = list(scope)
+        docs = {}
+        for i in range(0, len(scope), SCOPE_CHUNK_SIZE):
+            scoped = await self.signatures.load(scope[i:i + SCOPE_CHUNK_SIZE])
+            for doc in await self.signatures.candidates(scoped):
+                docs[doc["_id"]] = doc
+        docs = list(docs.values())
+        index = NearDuplicateIndex(threshold=threshold)
+        # Shingling and bucket comparisons are CPU work, keep them off the event loop
+        pairs, stats = await asyncio.to_thread(self._build_and_match, index, docs)
+
+        clusters = cluster_pairs(pairs)
+        scope_keys = {str(p) for p in scope}
+        clusters = [c for c in clusters if c["members"] & scope_keys]
+        member_ids = [ObjectId(key) for cluster in clusters for key in cluster["members"]]
+        owners = await self.load_product_owners(member_ids) if member_ids else {}
+        products = {}
+        if member_ids:
+            async for product in self.db["products"].find({"_id": {"$in": member_ids}}, PRODUCT_PROJECTION):
+                products[str(product["_id"])] = product
+        # Products deleted since the last prune: left out, and their signatures dropped now
+        gone = [oid for oid in member_ids if str(oid) not in products]
+        if gone:
+            await self.signatures.prune(gone)
+            for cluster in clusters:
+                cluster["members"] = {key for key in cluster["members"] if key in products}
+            clusters = [c for c in clusters if len(c["members"]) > 1 and c["members"] & scope_keys]
+
+        groups = []
+        for cluster in clusters:
+            members = []
+            for key in sorted(cluster["members"]):
+                product = products[key]
+                upload_id, donor_id = owners.get(product["_id"], (None, product.get("donorId")))
+                members.append({
+                    "product_id": key,
+                    "upload_id": str(upload_id) if upload_id else None,
+                    "donor_id": str(donor_id) if donor_id else None,
+                    "name": product.get("name"),
+                    "model": product.get("model"),
+                    "manufacturer": product.get("manufacturer"),
+                    "_upload": upload_id,
+                    "_donor": donor_id
+                })
+            donors = {m["_donor"] for m in members if m["_donor"]}
+            uploads = {m["_upload"] for m in members if m["_upload"]}
+            if cross_donor_only and len(donors) < 2:
+                continue
+            for m in members:
+                del m["_upload"], m["_donor"]
+            groups.append({
+                "products": members,
+                "donor_ids": sorted(str(d) for d in donors),
+                "upload_ids": sorted(str(u) for u in uploads),
+                "max_similarity": round(cluster["max_similarity"], 3)
+            })
+        groups.sort(key=lambda g: (-g["max_similarity"], g["products"][0]["product_id"]))
+
+        return {
+            "message": "Likely duplicate products found." if groups else "No near-duplicate products found.",
+            "groups": groups,
+            "stats": stats,
+            "status": "flagged" if groups else "clean"
+        }
+
+    @staticmethod
+    def _build_and_match(index, docs):
+        for doc in docs:
+            index.add_described(str(doc["_id"]), doc["text"], doc["bands"], doc.get("modelKey"))
+        return index.find_pairs()
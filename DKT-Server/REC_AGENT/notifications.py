@@ -0,0 +1,337 @@
+import argparse
+import json
+import os
+import random
+import smtplib
+import threading
+import time
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+from REC_AGENT.leases import default_worker_id
+from REC_AGENT.metrics import counter, histogram
+
+NOTIFICATIONS_COLLECTION = "notification_outbox"
+RECIPIENTS_COLLECTION = "notification_recipients"
+
+# "log" (print), "file" (JSON lines, for tests and offline runs) or "smtp"
+NOTIFY_SINK = os.getenv("NOTIFY_SINK", "log")
+NOTIFY_FILE = os.getenv("NOTIFY_FILE", "REC_AGENT/notifications.jsonl")
+SMTP_HOST = os.getenv("SMTP_HOST", "localhost")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "25"))
+SMTP_USER = os.getenv("SMTP_USER")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "false").lower() == "true"
+NOTIFY_FROM = os.getenv("NOTIFY_FROM", "alerts@dkt.com")
+ADMIN_EMAIL = os.getenv("ADMIN_EMAIL", "admin@dkt.com")
+
+# At most one message per recipient per window; alerts raised in between go out as one digest
+DIGEST_SECONDS = int(os.getenv("NOTIFY_DIGEST_SECONDS", "300"))
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "2"))
+MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "6"))
+# Retry after 30s, 60s, 120s, ... (with jitter), never more than an hour
+BACKOFF_SECONDS = 30
+MAX_BACKOFF_SECONDS = 3600
+MAX_DIGEST_ITEMS = 200
+# Sent and dead notifications are removed after this many days; their dedupe keys with them
+RETENTION_DAYS = 30
+SEND_LEASE_SECONDS = 120
+
+PENDING = "pending"
+SENT = "sent"
+DEAD = "dead"
+
+NOTIFICATIONS = counter("notifications_total", "Notifications by outcome", ["outcome"])
+SEND_SECONDS = histogram("notification_send_seconds", "Time to hand one message to the sink", ["sink", "outcome"])
+
+class LogSink:
+    """Prints messages, as the alerts did before there was a queue."""
+    name = "log"
+
+    def send(self, recipient, subject, body):
+        print(f"[ALERT] To {recipient}: {subject}\n{body}")
+
+class FileSink:
+    """Appends every message as a JSON line; the stand-in for SMTP in tests and offline runs."""
+    name = "file"
+
+    def __init__(self, path=NOTIFY_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def send(self, recipient, subject, body):
+        line = json.dumps({"to": recipient, "subject": subject, "body": body,
+                           "sentAt": datetime.utcnow().isoformat()}, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    def read(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+class SMTPSink:
+    name = "smtp"
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, user=SMTP_USER, password=SMTP_PASSWORD,
+                 sender=NOTIFY_FROM, starttls=SMTP_STARTTLS, timeout=30):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.sender = sender
+        self.starttls = starttls
+        self.timeout = timeout
+
+    def send(self, recipient, subject, body):
+        message = EmailMessage()
+        message["From"] = self.sender
+        message["To"] = recipient
+        message["Subject"] = subject
+        message.set_content(body)
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            if self.starttls:
+                smtp.starttls()
+            if self.user:
+                smtp.login(self.user, self.password)
+            smtp.send_message(message)
+
+def create_sink(kind=None):
+    kind = kind or NOTIFY_SINK
+    if kind == "log":
+        return LogSink()
+    if kind == "file":
+        return FileSink()
+    if kind == "smtp":
+        return SMTPSink()
+    raise ValueError(f"Unknown notification sink '{kind}'")
+
+def ensure_indexes(db):
+    outbox = db[NOTIFICATIONS_COLLECTION]
+    outbox.create_index([("status", ASCENDING), ("nextAttemptAt", ASCENDING)])
+    outbox.create_index([("recipient", ASCENDING), ("status", ASCENDING), ("createdAt", ASCENDING)])
+    # The same alert (e.g. one per delivery) is queued once per recipient
+    outbox.create_index([("dedupeKey", ASCENDING), ("recipient", ASCENDING)], unique=True,
+                        partialFilterExpression={"dedupeKey": {"$type": "string"}})
+    outbox.create_index([("expireAt", ASCENDING)], expireAfterSeconds=0)
+    # Tailed by the API's alert stream when change streams are unavailable
+    outbox.create_index([("createdAt", ASCENDING)])
+
+def _notification(recipient, subject, body, dedupe_key, kind):
+    now = datetime.utcnow()
+    doc = {
+        "recipient": recipient,
+        "subject": subject,
+        "body": body,
+        "kind": kind,
+        "status": PENDING,
+        "attempts": 0,
+        "createdAt": now,
+        "nextAttemptAt": now
+    }
+    if dedupe_key is not None:
+        doc["dedupeKey"] = str(dedupe_key)
+    return doc
+
+def enqueue(db, recipient, subject, body, dedupe_key=None, kind="alert"):
+    """
+    Queue a message for `recipient` (an email address). Returns the
+    notification _id, or None if `dedupe_key` was already queued for this
+    recipient. Only a single insert: the caller never waits on delivery.
+    `kind` (e.g. "delivery_mismatch") lets alert stream subscribers filter.
+    """
+    if not recipient or recipient == "unknown":
+        return None
+    try:
+        result = db[NOTIFICATIONS_COLLECTION].insert_one(_notification(recipient, subject, body, dedupe_key, kind))
+    except DuplicateKeyError:
+        NOTIFICATIONS.inc(outcome="deduped")
+        return None
+    NOTIFICATIONS.inc(outcome="queued")
+    return result.inserted_id
+
+async def enqueue_async(db, recipient, subject, body, dedupe_key=None, kind="alert"):
+    """enqueue for the API's async database handle."""
+    if not recipient or recipient == "unknown":
+        return None
+    try:
+        result = await db[NOTIFICATIONS_COLLECTION].insert_one(_notification(recipient, subject, body, dedupe_key, kind))
+    except DuplicateKeyError:
+        NOTIFICATIONS.inc(outcome="deduped")
+        return None
+    NOTIFICATIONS.inc(outcome="queued")
+    return result.inserted_id
+
+def enqueue_many(db, recipients, subject, body, dedupe_key=None, kind="alert"):
+    """enqueue for each distinct recipient; returns the queued _ids."""
+    queued = [enqueue(db, r, subject, body, dedupe_key, kind) for r in dict.fromkeys(recipients)]
+    return [q for q in queued if q is not None]
+
+def build_digest(items):
+    """(subject, body) for one or more queued notifications to the same recipient."""
+    if len(items) == 1:
+        return items[0]["subject"], items[0]["body"]
+    subject = f"[DKT] {len(items)} reconciliation alerts"
+    sections = [f"{i}. {item['subject']}\n{item['body']}" for i, item in enumerate(items, 1)]
+    return subject, f"{len(items)} alerts since the last message:\n\n" + "\n\n".join(sections)
+
+class NotificationDispatcher:
+    """
+    Background sender for the notification outbox.
+
+    Callers only insert into the outbox (enqueue). Worker threads pick a
+    recipient with due messages, lease it (so with several processes each
+    recipient is served by one sender at a time), send everything due for
+    it as one digest and then hold further messages for `digest_seconds`.
+    A failed send is retried with exponential backoff; after
+    `max_attempts` the messages are marked dead. A sender that dies
+    mid-send loses its lease and the messages go out again (at least once).
+    """
+
+    def __init__(self, db, sink=None, workers=NOTIFY_WORKERS, digest_seconds=DIGEST_SECONDS,
+                 max_attempts=MAX_ATTEMPTS, poll_interval=5, owner=None):
+        self.db = db
+        self.outbox = db[NOTIFICATIONS_COLLECTION]
+        self.recipients = db[RECIPIENTS_COLLECTION]
+        self.sink = sink or create_sink()
+        self.workers = workers
+        self.digest_seconds = digest_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.owner = owner or default_worker_id()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def due_recipients(self, limit=200):
+        now = datetime.utcnow()
+        return [group["_id"] for group in self.outbox.aggregate([
+            {"$match": {"status": PENDING, "nextAttemptAt": {"$lte": now}}},
+            {"$group": {"_id": "$recipient"}},
+            {"$limit": limit}
+        ])]
+
+    def _claim(self, recipient):
+        now = datetime.utcnow()
+        try:
+            claimed = self.recipients.find_one_and_update(
+                {
+                    "_id": recipient,
+                    "$and": [
+                        {"$or": [{"leaseUntil": None}, {"leaseUntil": {"$lt": now}}]},
+                        {"$or": [{"nextSendAt": None}, {"nextSendAt": {"$lte": now}}]}
+                    ]
+                },
+                {"$set": {"leaseOwner": self.owner, "leaseUntil": now + timedelta(seconds=SEND_LEASE_SECONDS)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Leased by another sender, or still inside its digest window
+            return False
+        return True
+
+    def _release(self, recipient, next_send_at=None):
+        update = {"$set": {"leaseUntil": None}}
+        if next_send_at is not None:
+            update["$set"]["nextSendAt"] = next_send_at
+        self.recipients.update_one({"_id": recipient, "leaseOwner": self.owner}, update)
+
+    def send_to(self, recipient):
+        """Send everything due for `recipient` as one message. Returns how many notifications went out."""
+        if not self._claim(recipient):
+            return 0
+        items = []
+        try:
+            items = list(self.outbox.find(
+                {"recipient": recipient, "status": PENDING, "nextAttemptAt": {"$lte": datetime.utcnow()}}
+            ).sort("createdAt", ASCENDING).limit(MAX_DIGEST_ITEMS))
+            if not items:
+                self._release(recipient)
+                return 0
+            subject, body = build_digest(items)
+            with SEND_SECONDS.time(sink=self.sink.name, outcome="error") as labels:
+                self.sink.send(recipient, subject, body)
+                labels["outcome"] = "ok"
+        except Exception as e:
+            print(f"[WARNING] Sending {len(items)} notification(s) to {recipient} failed: {e}")
+            self._retry_later(items)
+            self._release(recipient)
+            return 0
+
+        now = datetime.utcnow()
+        self.outbox.update_many(
+            {"_id": {"$in": [item["_id"] for item in items]}},
+            {"$set": {"status": SENT, "sentAt": now, "expireAt": now + timedelta(days=RETENTION_DAYS)},
+             "$inc": {"attempts": 1}}
+        )
+        NOTIFICATIONS.inc(len(items), outcome="sent")
+        self._release(recipient, next_send_at=now + timedelta(seconds=self.digest_seconds))
+        return len(items)
+
+    def _retry_later(self, items):
+        now = datetime.utcnow()
+        for item in items:
+            attempts = item.get("attempts", 0) + 1
+            if attempts >= self.max_attempts:
+                update = {"status": DEAD, "attempts": attempts, "expireAt": now + timedelta(days=RETENTION_DAYS)}
+                NOTIFICATIONS.inc(outcome="dead")
+            else:
+                delay = min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+                update = {"attempts": attempts, "nextAttemptAt": now + timedelta(seconds=delay)}
+                NOTIFICATIONS.inc(outcome="retry")
+            self.outbox.update_one({"_id": item["_id"], "status": PENDING}, {"$set": update})
+
+    def run_once(self):
+        """One pass over the recipients with due messages. Returns how many notifications were sent."""
+        recipients = self.due_recipients()
+        # Several threads (and processes) start on different recipients
+        random.shuffle(recipients)
+        return sum(self.send_to(recipient) for recipient in recipients)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                sent = self.run_once()
+            except Exception as e:
+                print(f"[ERROR] Notification dispatcher: {e}")
+                sent = 0
+            if not sent:
+                self._stop.wait(self.poll_interval)
+
+    def start(self):
+        """Start the sender threads (daemon threads; call stop() for a clean shutdown)."""
+        ensure_indexes(self.db)
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._loop, name=f"notify-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send queued notifications")
+    parser.add_argument("--workers", type=int, default=NOTIFY_WORKERS)
+    parser.add_argument("--sink", choices=["log", "file", "smtp"], default=NOTIFY_SINK)
+    parser.add_argument("--once", action="store_true", help="one pass, then exit")
+    args = parser.parse_args()
+    from REC_AGENT.db import get_sync_db
+    dispatcher = NotificationDispatcher(get_sync_db(), sink=create_sink(args.sink), workers=args.workers)
+    if args.once:
+        ensure_indexes(dispatcher.db)
+        print(f"[INFO] Sent {dispatcher.run_once()} notification(s)")
+    else:
+        dispatcher.start()
+        print(f"[INFO] Notification dispatcher running with {args.workers} sender(s), sink {args.sink}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            dispatcher.stop()
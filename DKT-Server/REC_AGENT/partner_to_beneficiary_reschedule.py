@@ -1,48 +1,31 @@
-import os
-import requests
-from dotenv import load_dotenv
-from pymongo import MongoClient
+import asyncio
 from bson import ObjectId
-from datetime import datetime
+from datetime import datetime, timedelta
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from REC_AGENT.db import get_sync_db
+from REC_AGENT.shiprocket_client import get_shiprocket_client
+from REC_AGENT.tracking_cache import AsyncTrackingCache, get_tracking_cache
 
-# Load environment variables
-load_dotenv()
-MONGO_URI = os.getenv("MONGO_URI")
-DB_NAME = os.getenv("DB_NAME", "dkt")
-SHIPROCKET_EMAIL = os.getenv("SHIPROCKET_EMAIL")
-SHIPROCKET_PASSWORD = os.getenv("SHIPROCKET_PASSWORD")
+# One document per shipment a request has been cloned for: "pending" while the
+# clone is written, then "done". A pending record older than
+# RESCHEDULE_CLAIM_SECONDS was left by a process that died mid-way.
+RESCHEDULE_RECORDS_COLLECTION = "reschedule_records"
+RESCHEDULE_CLAIM_SECONDS = 300
+PENDING = "pending"
+DONE = "done"
 
-# MongoDB setup
-client = MongoClient(MONGO_URI)
-db = client[DB_NAME]
-
-# Shiprocket API helpers
+# Shiprocket API helpers, backed by the shared client (cached token, pooled session)
 def get_shiprocket_token():
-    url = "https://apiv2.shiprocket.in/v1/external/auth/login"
-    payload = {"email": SHIPROCKET_EMAIL, "password": SHIPROCKET_PASSWORD}
-    response = requests.post(url, json=payload)
-    response.raise_for_status()
-    return response.json()["token"]
-
-def get_shipment_status(shipment_id, token):
-    url = f"https://apiv2.shiprocket.in/v1/external/courier/track?shipment_id={shipment_id}"
-    headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.json()
-
-# def get_shiprocket_token():
-#     # Return a fake token for testing
-#     return "mock_token"
-
-# def get_shipment_status(shipment_id, token):
-#     # Return a fake status for testing
-#     # Simulate a failed delivery
-#     return {
-#         "tracking_data": {
-#             "shipment_status": "Failed"
-#         }
-#     }
+    return get_shiprocket_client().get_token()
+
+def get_shipment_status(shipment_id, token=None):
+    # The token argument is kept for old callers; the client manages its own.
+    # Results come from the shared tracking cache when still valid.
+    return get_tracking_cache().get(shipment_id)
+
+# For offline runs, point the client at the local fake instead of mocking these:
+# SHIPROCKET_BACKEND=fake with `python -m REC_AGENT.fake_shiprocket` (see fake_shiprocket.py)
     
 def is_delivery_failed(shiprocket_status):
     failed_statuses = ["Undelivered", "RTO", "Failed", "Cancelled"]
@@ -50,20 +33,20 @@ def is_delivery_failed(shiprocket_status):
     current_status = shiprocket_status.get("tracking_data", {}).get("shipment_status", "")
     return current_status in failed_statuses
 
-# def is_delivery_failed(shiprocket_status):
-#     return True  # Force failure for testing
+def notify_users(beneficiary, partner, admin, message, dedupe_key=None, db=None, kind="alert"):
+    """
+    Queue `message` for the beneficiary, partner and admin (email addresses;
+    "unknown" is skipped). The notification dispatcher sends it.
+    """
+    # Import here to avoid circular imports
+    from REC_AGENT.notifications import enqueue_many
+    if db is None:
+        db = get_sync_db()
+    queued = enqueue_many(db, [beneficiary, partner, admin], message, message, dedupe_key=dedupe_key, kind=kind)
+    print(f"Notify Beneficiary ({beneficiary}), Partner ({partner}), Admin ({admin}): {message} "
+          f"[{len(queued)} queued]")
 
-def notify_users(beneficiary, partner, admin, message):
-    # Replace with actual email/SMS logic as needed
-    print(f"Notify Beneficiary ({beneficiary}): {message}")
-    print(f"Notify Partner ({partner}): {message}")
-    print(f"Notify Admin ({admin}): {message}")
-
-def reschedule_beneficiary_request(old_request_id, partner_id):
-    old_request = db.beneficiaryrequests.find_one({"_id": ObjectId(old_request_id)})
-    if not old_request:
-        print("Original request not found.")
-        return None
+def build_rescheduled_request(old_request):
     new_request = old_request.copy()
     new_request["_id"] = ObjectId()  # New ID
     new_request["status"] = "Pending"
@@ -72,44 +55,327 @@ def reschedule_beneficiary_request(old_request_id, partner_id):
         "status": "Pending",
         "date": datetime.utcnow()
     }
-    db.beneficiaryrequests.insert_one(new_request)
+    return new_request
+
+def _reschedule_record(shipment_id, old_id, new_id):
+    return {"_id": str(shipment_id), "shipmentId": shipment_id, "requestId": old_id, "newRequestId": new_id,
+            "state": PENDING, "claimedAt": datetime.utcnow()}
+
+def _is_stale(record):
+    cutoff = datetime.utcnow() - timedelta(seconds=RESCHEDULE_CLAIM_SECONDS)
+    return record.get("state") == PENDING and record.get("claimedAt", cutoff) <= cutoff
+
+def reschedule_beneficiary_request(old_request_id, partner_id, db=None, shipment_id=None):
+    """
+    Clone the beneficiary request as a new Pending one. With `shipment_id`
+    the reschedule is recorded like the bulk path's, so the same shipment is
+    never rescheduled twice; the earlier clone's ID is returned instead.
+    """
+    if db is None:
+        db = get_sync_db()
+    old_request = db.beneficiaryrequests.find_one({"_id": ObjectId(old_request_id)})
+    if not old_request:
+        print("Original request not found.")
+        return None
+    new_request = build_rescheduled_request(old_request)
+    records = db[RESCHEDULE_RECORDS_COLLECTION]
+    if shipment_id is not None:
+        record = records.find_one({"_id": str(shipment_id)})
+        if record is not None and _is_stale(record):
+            if db.beneficiaryrequests.find_one({"_id": record["newRequestId"]}, {"_id": 1}):
+                records.update_one({"_id": record["_id"]}, {"$set": {"state": DONE}})
+            else:
+                records.delete_one({"_id": record["_id"], "state": PENDING, "claimedAt": record["claimedAt"]})
+                record = None
+        if record is None:
+            try:
+                records.insert_one(_reschedule_record(shipment_id, old_request["_id"], new_request["_id"]))
+            except DuplicateKeyError:
+                record = records.find_one({"_id": str(shipment_id)})
+        if record is not None:
+            print(f"Shipment {shipment_id} was already rescheduled as {record['newRequestId']}")
+            return record["newRequestId"]
+    try:
+        db.beneficiaryrequests.insert_one(new_request)
+    except Exception:
+        if shipment_id is not None:
+            records.delete_one({"_id": str(shipment_id), "newRequestId": new_request["_id"]})
+        raise
+    if shipment_id is not None:
+        records.update_one({"_id": str(shipment_id)}, {"$set": {"state": DONE}})
     print(f"Rescheduled new request with ID: {new_request['_id']}")
     return new_request["_id"]
 
-def check_and_handle_failed_deliveries():
-    token = get_shiprocket_token()
-    # Find all in-progress deliveries
-    deliveries = db.assetsdeleveries.find({"shippingDetails.status": "In-progress"})
+async def reschedule_beneficiary_request_async(db, old_request_id, partner_id, shipment_id=None):
+    """
+    Same as reschedule_beneficiary_request, on the API's shared async client.
+    """
+    old_request = await db.beneficiaryrequests.find_one({"_id": ObjectId(old_request_id)})
+    if not old_request:
+        print("Original request not found.")
+        return None
+    new_request = build_rescheduled_request(old_request)
+    if shipment_id is not None:
+        planned = [(shipment_id, old_request["_id"], new_request["_id"])]
+        record = (await _existing_reschedules(db, [shipment_id])).get(shipment_id)
+        if record is None and await _claim_shipments(db, planned):
+            record = await db[RESCHEDULE_RECORDS_COLLECTION].find_one({"_id": str(shipment_id)})
+        if record is not None:
+            print(f"Shipment {shipment_id} was already rescheduled as {record['newRequestId']}")
+            return record["newRequestId"]
+    try:
+        await db.beneficiaryrequests.insert_one(new_request)
+    except Exception:
+        if shipment_id is not None:
+            await _complete_reschedules(db, planned, set())
+        raise
+    if shipment_id is not None:
+        await _complete_reschedules(db, planned, {new_request["_id"]})
+    print(f"Rescheduled new request with ID: {new_request['_id']}")
+    return new_request["_id"]
+
+# Query operators that run server-side JavaScript; not accepted in bulk filters
+_FORBIDDEN_OPERATORS = {"$where", "$function", "$accumulator"}
+
+def _check_filter(value):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key in _FORBIDDEN_OPERATORS:
+                raise ValueError(f"Operator {key} is not allowed in a delivery filter")
+            _check_filter(item)
+    elif isinstance(value, list):
+        for item in value:
+            _check_filter(item)
+
+async def _insert_requests(db, new_requests):
+    """
+    insert_many the clones, inside a transaction when the deployment
+    supports one (replica set / mongos) so the batch lands all or nothing.
+    Returns (inserted ids, per-index errors, transactional).
+    """
+    try:
+        async with db.client.start_session() as session:
+            async with await session.start_transaction():
+                await db.beneficiaryrequests.insert_many(new_requests, session=session)
+        return {r["_id"] for r in new_requests}, {}, True
+    except OperationFailure as e:
+        # Standalone servers reject transactions (IllegalOperation)
+        if e.code != 20 and "Transaction numbers" not in str(e):
+            raise
+    try:
+        await db.beneficiaryrequests.insert_many(new_requests, ordered=False)
+        return {r["_id"] for r in new_requests}, {}, False
+    except BulkWriteError as e:
+        errors = {err["index"]: err.get("errmsg", "insert failed") for err in e.details.get("writeErrors", [])}
+        inserted = {r["_id"] for i, r in enumerate(new_requests) if i not in errors}
+        return inserted, errors, False
+
+async def _existing_reschedules(db, shipment_ids):
+    """
+    {shipment_id: record} for the shipments already rescheduled, or being
+    rescheduled by another call. A stale pending record counts as done if
+    its clone was written, and is dropped (the shipment is free) if not.
+    """
+    records = db[RESCHEDULE_RECORDS_COLLECTION]
+    existing = {}
+    stale = []
+    async for record in records.find({"_id": {"$in": [str(s) for s in shipment_ids]}}):
+        if _is_stale(record):
+            stale.append(record)
+        else:
+            existing[record["shipmentId"]] = record
+    if stale:
+        written = {r["_id"] async for r in db.beneficiaryrequests.find(
+            {"_id": {"$in": [record["newRequestId"] for record in stale]}}, {"_id": 1})}
+        for record in stale:
+            if record["newRequestId"] in written:
+                await records.update_one({"_id": record["_id"]}, {"$set": {"state": DONE}})
+                existing[record["shipmentId"]] = dict(record, state=DONE)
+            else:
+                await records.delete_one({"_id": record["_id"], "state": PENDING, "claimedAt": record["claimedAt"]})
+    return existing
+
+async def _claim_shipments(db, planned):
+    """
+    Record each (shipment_id, old_id, new_id) as a pending reschedule in
+    reschedule_records, keyed by shipment ID. Returns the shipment IDs
+    another call recorded first (a concurrent or repeated request).
+    """
+    records = [_reschedule_record(shipment_id, old_id, new_id) for shipment_id, old_id, new_id in planned]
+    try:
+        await db[RESCHEDULE_RECORDS_COLLECTION].insert_many(records, ordered=False)
+    except BulkWriteError as e:
+        taken = {records[err["index"]]["shipmentId"] for err in e.details.get("writeErrors", []) if err.get("code") == 11000}
+        if len(taken) < len(e.details.get("writeErrors", [])):
+            raise
+        return taken
+    return set()
+
+async def _complete_reschedules(db, planned, inserted):
+    """Mark the claims whose clone is in `inserted` done; drop the others so a later call can retry them."""
+    records = db[RESCHEDULE_RECORDS_COLLECTION]
+    done = [str(shipment_id) for shipment_id, _, new_id in planned if new_id in inserted]
+    failed = [str(shipment_id) for shipment_id, _, new_id in planned if new_id not in inserted]
+    if done:
+        await records.update_many({"_id": {"$in": done}}, {"$set": {"state": DONE, "completedAt": datetime.utcnow()}})
+    if failed:
+        await records.delete_many({"_id": {"$in": failed}, "state": PENDING})
+
+async def reschedule_beneficiary_requests_bulk_async(db, shipment_ids=None, delivery_filter=None,
+                                                     require_failed=True, limit=1000, cache=None, after=None):
+    """
+    Reschedule the beneficiary requests behind many deliveries at once.
+
+    Deliveries are resolved with one query (by shipment ID, or by
+    `delivery_filter`), `limit` at a time in _id order: when more match,
+    the result carries `next_after` to pass as `after` for the next page.
+    More than `limit` shipment IDs in one call is a ValueError.
+
+    Each rescheduled shipment is recorded in reschedule_records, so calling
+    again (or concurrently) reports it as already_rescheduled instead of
+    cloning the request twice. Shiprocket status is checked through the
+    tracking cache when `require_failed` (`cache`, an AsyncTrackingCache
+    on `db` by default), the original requests are loaded with one $in
+    query and the clones are written with a single insert_many.
+    Returns per-shipment results and a summary.
+    """
+    if shipment_ids and len(shipment_ids) > limit:
+        raise ValueError(f"{len(shipment_ids)} shipment IDs exceed the limit of {limit}; split the request")
+    query = {}
+    if shipment_ids:
+        query["shippingDetails.shipment_id"] = {"$in": list(shipment_ids)}
+    if delivery_filter:
+        _check_filter(delivery_filter)
+        query = {"$and": [query, delivery_filter]} if query else delivery_filter
+    if not query:
+        raise ValueError("Provide shipment_ids or a delivery filter")
+    if after:
+        if not ObjectId.is_valid(after):
+            raise ValueError(f"Invalid after: {after}")
+        query = {"$and": [query, {"_id": {"$gt": ObjectId(after)}}]}
+
+    cursor = db.assetsdeleveries.find(
+        query, {"shippingDetails.shipment_id": 1, "beneficeryRequestId": 1, "partnerId": 1}
+    ).sort("_id", ASCENDING).limit(limit + 1)
+    deliveries = await cursor.to_list(length=limit + 1)
+    next_after = None
+    if len(deliveries) > limit:
+        deliveries = deliveries[:limit]
+        next_after = str(deliveries[-1]["_id"])
+
+    results = []
+    found = {d.get("shippingDetails", {}).get("shipment_id") for d in deliveries}
+    if shipment_ids and after is None:
+        # Against every page, not just this one
+        known = set(await db.assetsdeleveries.distinct("shippingDetails.shipment_id",
+                                                       {"shippingDetails.shipment_id": {"$in": list(shipment_ids)}}))
+        for shipment_id in shipment_ids:
+            if shipment_id not in known:
+                results.append({"shipment_id": shipment_id, "status": "not_found"})
+
+    # Deliveries without a shipment ID cannot be checked or recorded
+    for delivery in deliveries:
+        if delivery.get("shippingDetails", {}).get("shipment_id") is None:
+            results.append({"shipment_id": None, "delivery_id": str(delivery["_id"]), "status": "no_shipment_id"})
+    deliveries = [d for d in deliveries if d.get("shippingDetails", {}).get("shipment_id") is not None]
+    found.discard(None)
+
+    # Shipments a previous call already rescheduled; no status check or clone for them
+    done = await _existing_reschedules(db, found) if found else {}
+    for shipment_id, record in done.items():
+        results.append({
+            "shipment_id": shipment_id,
+            "status": "already_rescheduled",
+            "old_request_id": str(record["requestId"]),
+            "new_request_id": str(record["newRequestId"])
+        })
+    deliveries = [d for d in deliveries if d.get("shippingDetails", {}).get("shipment_id") not in done]
+    found -= set(done)
+
+    statuses = {}
+    if require_failed:
+        # Import here to avoid circular imports
+        from REC_AGENT.shipment_sweep import check_shipments
+        statuses = await check_shipments(list(found), cache=cache or AsyncTrackingCache(db))
+
+    candidates = []
     for delivery in deliveries:
         shipment_id = delivery.get("shippingDetails", {}).get("shipment_id")
-        if not shipment_id:
-            continue
-        try:
-            status = get_shipment_status(shipment_id, token)
-        except Exception as e:
-            print(f"Error fetching status for shipment {shipment_id}: {e}")
+        if require_failed:
+            status = statuses.get(shipment_id)
+            if isinstance(status, Exception) or status is None:
+                results.append({"shipment_id": shipment_id, "status": "error", "message": f"Could not fetch status: {status}"})
+                continue
+            if not is_delivery_failed(status):
+                results.append({
+                    "shipment_id": shipment_id,
+                    "status": "not_failed",
+                    "current_status": status.get("tracking_data", {}).get("shipment_status", "Unknown")
+                })
+                continue
+        candidates.append(delivery)
+
+    request_ids = list({d.get("beneficeryRequestId") for d in candidates if d.get("beneficeryRequestId")})
+    originals = {}
+    if request_ids:
+        async for request in db.beneficiaryrequests.find({"_id": {"$in": request_ids}}):
+            originals[request["_id"]] = request
+
+    new_requests = {}
+    planned = []
+    for delivery in candidates:
+        shipment_id = delivery.get("shippingDetails", {}).get("shipment_id")
+        original = originals.get(delivery.get("beneficeryRequestId"))
+        if original is None:
+            results.append({"shipment_id": shipment_id, "status": "request_not_found"})
             continue
-        if is_delivery_failed(status):
-            # Get related info
-            beneficiary_request_id = delivery.get("beneficeryRequestId")
-            partner_id = delivery.get("partnerId")
-            beneficiary = db.beneficiaryrequests.find_one({"_id": beneficiary_request_id})
-            partner = db.partners.find_one({"_id": partner_id})
-            admin = {"email": "admin@example.com"}  # Replace with actual admin logic
-
-            # Notify all
-            notify_users(
-                beneficiary.get("email", "unknown") if beneficiary else "unknown",
-                partner.get("email", "unknown") if partner else "unknown",
-                admin.get("email", "unknown"),
-                f"Delivery failed for shipment {shipment_id}."
-            )
-            # Optionally, reschedule (could be triggered by admin via chatbot)
-            # new_request_id = reschedule_beneficiary_request(beneficiary_request_id, partner_id)
+        # Several deliveries of one request are rescheduled once
+        if original["_id"] not in new_requests:
+            new_requests[original["_id"]] = build_rescheduled_request(original)
+        planned.append((shipment_id, original["_id"], new_requests[original["_id"]]["_id"]))
+
+    # A concurrent call may have recorded some of these since the check above
+    taken = await _claim_shipments(db, planned) if planned else set()
+    for shipment_id in taken:
+        results.append({"shipment_id": shipment_id, "status": "already_rescheduled"})
+    planned = [p for p in planned if p[0] not in taken]
+    new_requests = [r for r in new_requests.values() if r["_id"] in {new_id for _, _, new_id in planned}]
+
+    inserted, errors, transactional = set(), {}, False
+    if new_requests:
+        # If this raises, the claims stay pending; once stale they are resolved by
+        # whether their clone was written (see _existing_reschedules)
+        inserted, errors, transactional = await _insert_requests(db, new_requests)
+        # Claims of clones that were not written are dropped; a later call may retry them
+        await _complete_reschedules(db, planned, inserted)
+    error_by_id = {new_requests[i]["_id"]: message for i, message in errors.items()}
+    for shipment_id, old_id, new_id in planned:
+        if new_id in inserted:
+            results.append({
+                "shipment_id": shipment_id,
+                "status": "rescheduled",
+                "old_request_id": str(old_id),
+                "new_request_id": str(new_id)
+            })
+        else:
+            results.append({"shipment_id": shipment_id, "status": "error", "message": error_by_id.get(new_id, "insert failed")})
+
+    summary = {}
+    for result in results:
+        summary[result["status"]] = summary.get(result["status"], 0) + 1
+    print(f"Bulk reschedule: {len(inserted)} new requests from {len(deliveries)} deliveries "
+          f"({'transactional' if transactional else 'non-transactional'} insert)")
+    return {"results": results, "summary": summary, "transactional": transactional, "next_after": next_after}
+
+def check_and_handle_failed_deliveries(db=None):
+    # Import here to avoid circular imports; see shipment_sweep for the tuning knobs
+    from REC_AGENT.shipment_sweep import sweep_failed_deliveries
+    return asyncio.run(sweep_failed_deliveries(db))
 
 def chatbot_check_delivery_status(shipment_id):
-    token = get_shiprocket_token()
-    status = get_shipment_status(shipment_id, token)
+    return delivery_status_message(get_shipment_status(shipment_id))
+
+def delivery_status_message(status):
     if is_delivery_failed(status):
         return "Delivery failed. Please contact admin to reschedule."
     else:
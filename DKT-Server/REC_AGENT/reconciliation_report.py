@@ -0,0 +1,256 @@
+import argparse
+import os
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from REC_AGENT.db import get_sync_db
+
+DEFAULT_CHUNK_SIZE = 200000
+# Pandas period aliases: D(ay), W(eek), M(onth), Q(uarter)
+DEFAULT_FREQ = "W"
+REPORT_TABLES = ["by_partner", "by_donor", "by_period", "partner_trend", "donor_trend"]
+
+# Everything the report needs from a verified delivery, computed server-side: IDs as
+# strings, committed/received units (verified deliveries only store a flag, so both
+# are the assetId count) and the verification time
+VERIFICATION_PROJECTION = {
+    "_id": 0,
+    "delivery_id": {"$toString": "$_id"},
+    "partner_id": {"$toString": "$partnerId"},
+    "first_asset": {"$toString": {"$arrayElemAt": ["$assetId", 0]}},
+    "verification_status": "$deliveryVerification.status",
+    "committed": {"$ifNull": ["$deliveryVerification.committedQuantity", {"$size": {"$ifNull": ["$assetId", []]}}]},
+    "received": {"$ifNull": [
+        "$deliveryVerification.receivedQuantity",
+        {"$cond": [{"$eq": ["$deliveryVerification.verified", True]}, {"$size": {"$ifNull": ["$assetId", []]}}, None]}
+    ]},
+    "verified_at": {"$ifNull": ["$deliveryVerification.verifiedAt", "$updatedAt"]}
+}
+COLUMNS = list(k for k in VERIFICATION_PROJECTION if k != "_id")
+
+def verification_pipeline(since=None, until=None):
+    match = {"deliveryVerification": {"$exists": True}}
+    window = {}
+    if since:
+        window["$gte"] = since
+    if until:
+        window["$lt"] = until
+    if window:
+        match["deliveryVerification.verifiedAt"] = window
+    return [{"$match": match}, {"$project": VERIFICATION_PROJECTION}]
+
+def _frame(columns):
+    # Typed arrays per column; letting DataFrame infer types from lists is several times slower
+    frame = pd.DataFrame({
+        name: np.array(columns[name], dtype=object)
+        for name in ("delivery_id", "partner_id", "first_asset", "verification_status")
+    })
+    # None becomes NaN: an unanswered verification has no received count
+    frame["committed"] = np.nan_to_num(np.array(columns["committed"], dtype=float)).astype(np.int64)
+    frame["received"] = np.array(columns["received"], dtype=float)
+    frame["verified_at"] = pd.to_datetime(columns["verified_at"], errors="coerce")
+    return frame
+
+def load_verifications(db, since=None, until=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Verified deliveries as DataFrame chunks of up to `chunk_size` rows, one
+    column per field. Documents are fetched in large batches and appended
+    column-wise, never kept as a list of dicts.
+    """
+    cursor = db["assetsdeleveries"].aggregate(verification_pipeline(since, until), batchSize=10000)
+    columns = {name: [] for name in COLUMNS}
+    appenders = [(name, columns[name].append) for name in COLUMNS]
+    rows = 0
+    for doc in cursor:
+        for name, append in appenders:
+            append(doc.get(name))
+        rows += 1
+        if rows >= chunk_size:
+            yield _frame(columns)
+            for values in columns.values():
+                values.clear()
+            rows = 0
+    if rows:
+        yield _frame(columns)
+
+def load_product_donors(db):
+    """
+    Series product ID -> donor ID from product_uploads (products.donorId wins
+    where set), built by repeating each upload's donor over its products.
+    """
+    donors, products = [], []
+    for upload in db["product_uploads"].aggregate([
+        {"$match": {"products.0": {"$exists": True}}},
+        {"$project": {"_id": 0, "d": {"$toString": "$donerId"},
+                      "p": {"$map": {"input": "$products", "in": {"$toString": "$$this"}}}}}
+    ], batchSize=10000):
+        donors.append(upload["d"])
+        products.append(upload["p"])
+    lengths = np.fromiter((len(p) for p in products), dtype=np.int64, count=len(products))
+    mapping = pd.Series(np.repeat(np.array(donors, dtype=object), lengths),
+                        index=pd.Index([p for group in products for p in group], dtype=object))
+    for product in db["products"].find({"donorId": {"$exists": True}}, {"donorId": 1}):
+        mapping[str(product["_id"])] = str(product["donorId"])
+    return mapping[~mapping.index.duplicated(keep="last")]
+
+def _names(db, collection, field, ids):
+    from bson import ObjectId
+    object_ids = [ObjectId(i) for i in ids if ObjectId.is_valid(i)]
+    return {str(doc["_id"]): doc.get(field) for doc in db[collection].find({"_id": {"$in": object_ids}}, {field: 1})}
+
+def prepare(frame, product_donors, freq=DEFAULT_FREQ):
+    """Derived columns, all vectorized: donor, period, mismatch flag, shortfall and surplus units."""
+    frame = frame.copy()
+    frame["donor_id"] = frame["first_asset"].map(product_donors)
+    # Unanswered verifications (no received count) are counted, but not as mismatches
+    received = frame["received"].to_numpy(dtype=float)
+    committed = frame["committed"].to_numpy(dtype=float)
+    answered = ~np.isnan(received)
+    difference = np.where(answered, committed - np.nan_to_num(received), 0.0)
+    frame["answered"] = answered
+    frame["mismatch"] = answered & (difference != 0)
+    frame["shortfall"] = np.clip(difference, 0, None).astype(np.int64)
+    frame["surplus"] = np.clip(-difference, 0, None).astype(np.int64)
+    frame["period"] = frame["verified_at"].dt.to_period(freq).dt.start_time
+    for column in ("partner_id", "donor_id"):
+        frame[column] = frame[column].fillna("unknown").astype("category")
+    return frame
+
+def summarize(frame, keys):
+    """Mismatch counts and rates, unit totals and shortfall per group of `keys`."""
+    summary = frame.groupby(keys, observed=True, sort=True).agg(
+        deliveries=("delivery_id", "size"),
+        answered=("answered", "sum"),
+        mismatches=("mismatch", "sum"),
+        committed_units=("committed", "sum"),
+        received_units=("received", "sum"),
+        shortfall_units=("shortfall", "sum"),
+        surplus_units=("surplus", "sum")
+    )
+    answered = summary["answered"].to_numpy(dtype=float)
+    committed = summary["committed_units"].to_numpy(dtype=float)
+    summary["mismatch_rate"] = np.divide(summary["mismatches"].to_numpy(dtype=float), answered,
+                                         out=np.zeros_like(answered), where=answered > 0).round(4)
+    summary["shortfall_rate"] = np.divide(summary["shortfall_units"].to_numpy(dtype=float), committed,
+                                          out=np.zeros_like(committed), where=committed > 0).round(4)
+    return summary.reset_index()
+
+def trend(frame, key):
+    """summarize per (`key`, period), with the change in mismatch rate from the entity's previous period."""
+    summary = summarize(frame, [key, "period"])
+    summary["mismatch_rate_change"] = summary.groupby(key, observed=True)["mismatch_rate"].diff().round(4)
+    return summary
+
+def build_report(db, freq=DEFAULT_FREQ, since=None, until=None, chunk_size=DEFAULT_CHUNK_SIZE, details=None):
+    """
+    The fleet-wide report as {table name: DataFrame} (see REPORT_TABLES).
+    `details`, a TableWriter, receives every prepared delivery row chunk by
+    chunk as it is loaded.
+    """
+    product_donors = load_product_donors(db)
+    chunks = []
+    for chunk in load_verifications(db, since, until, chunk_size):
+        chunk = prepare(chunk, product_donors, freq)
+        if details is not None:
+            details.write(chunk.drop(columns=["first_asset"]))
+        chunks.append(chunk.drop(columns=["first_asset", "verification_status"]))
+    if not chunks:
+        return {name: pd.DataFrame() for name in REPORT_TABLES}
+    frame = pd.concat(chunks, ignore_index=True)
+    for column in ("partner_id", "donor_id"):
+        frame[column] = frame[column].astype(str).astype("category")
+
+    partner_names = _names(db, "partners", "partnerName", frame["partner_id"].cat.categories)
+    donor_names = _names(db, "donors", "companyName", frame["donor_id"].cat.categories)
+    report = {
+        "by_partner": summarize(frame, ["partner_id"]),
+        "by_donor": summarize(frame, ["donor_id"]),
+        "by_period": summarize(frame, ["period"]),
+        "partner_trend": trend(frame, "partner_id"),
+        "donor_trend": trend(frame, "donor_id")
+    }
+    for name, table in report.items():
+        if "partner_id" in table:
+            table.insert(1, "partner_name", table["partner_id"].astype(str).map(partner_names))
+        if "donor_id" in table:
+            table.insert(1, "donor_name", table["donor_id"].astype(str).map(donor_names))
+    return report
+
+class TableWriter:
+    """Appends DataFrame chunks to one CSV or Parquet file (Parquet needs pyarrow)."""
+
+    def __init__(self, path, fmt="csv"):
+        self.path = path
+        self.fmt = fmt
+        self._parquet = None
+        self._header = True
+        if fmt == "parquet":
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise RuntimeError("Parquet output needs pyarrow: pip install pyarrow")
+        elif fmt != "csv":
+            raise ValueError(f"Unknown format '{fmt}'")
+        if os.path.exists(path):
+            os.remove(path)
+
+    def write(self, frame):
+        if self.fmt == "csv":
+            frame.to_csv(self.path, mode="a", header=self._header, index=False)
+            self._header = False
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        if self._parquet is None:
+            self._parquet = pq.ParquetWriter(self.path, table.schema)
+        self._parquet.write_table(table.cast(self._parquet.schema))
+
+    def close(self):
+        if self._parquet is not None:
+            self._parquet.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def write_report(report, out_dir, fmt="csv"):
+    """One file per table. Returns the paths written."""
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for name, table in report.items():
+        path = os.path.join(out_dir, f"{name}.{fmt}")
+        with TableWriter(path, fmt) as writer:
+            writer.write(table)
+        paths.append(path)
+    return paths
+
+def _date(value):
+    return datetime.strptime(value, "%Y-%m-%d")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fleet-wide commitment vs delivery reconciliation report")
+    parser.add_argument("--out", default="REC_AGENT/reports", help="output directory")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--freq", default=DEFAULT_FREQ, help="time bucket: D, W, M or Q")
+    parser.add_argument("--since", type=_date, help="YYYY-MM-DD, by verification date")
+    parser.add_argument("--until", type=_date, help="YYYY-MM-DD, exclusive")
+    parser.add_argument("--details", action="store_true", help="also write one row per delivery")
+    parser.add_argument("--db", help="database name (default: DB_NAME)")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    db = get_sync_db(args.db)
+    os.makedirs(args.out, exist_ok=True)
+    details = TableWriter(os.path.join(args.out, f"deliveries.{args.format}"), args.format) if args.details else None
+    try:
+        report = build_report(db, freq=args.freq, since=args.since, until=args.until, details=details)
+    finally:
+        if details is not None:
+            details.close()
+    paths = write_report(report, args.out, args.format)
+    deliveries = int(report["by_period"]["deliveries"].sum()) if len(report["by_period"]) else 0
+    print(f"[INFO] Report over {deliveries} verified deliveries in {time.perf_counter() - started:.1f}s: {', '.join(paths)}")
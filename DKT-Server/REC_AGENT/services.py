@@ -0,0 +1,190 @@
+import asyncio
+import os
+import threading
+import requests
+from bson import ObjectId
+from requests.adapters import HTTPAdapter
+from REC_AGENT.conversations import ConversationEngine
+from REC_AGENT.duplicate_checker import DuplicateChecker
+from REC_AGENT.indexes import ensure_indexes_async, verify_query_plans_async
+from REC_AGENT.near_duplicate_checker import NearDuplicateChecker
+from REC_AGENT.notifications import ADMIN_EMAIL, enqueue_async
+from REC_AGENT.partner_to_beneficiary_reschedule import (
+    delivery_status_message,
+    reschedule_beneficiary_request_async,
+    reschedule_beneficiary_requests_bulk_async,
+)
+from REC_AGENT.tracking_cache import AsyncTrackingCache
+
+RECONCILIATION_API_URL = os.getenv("RECONCILIATION_API_URL", "http://localhost:8000")
+# (connect, read) seconds for calls to a remote reconciliation API
+RECONCILIATION_API_TIMEOUT = (3.05, float(os.getenv("RECONCILIATION_API_TIMEOUT", "30")))
+
+_remote_client = None
+_local_client = None
+_local_lock = threading.Lock()
+
+class ReconciliationService:
+    """
+    Reconciliation operations shared by the HTTP endpoints and the chatbot
+    flows. The endpoints are thin wrappers around these methods, and the
+    chatbot calls them in-process instead of going back through HTTP.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.duplicate_checker = DuplicateChecker(db=db)
+        self.near_duplicate_checker = NearDuplicateChecker(db)
+        # Shiprocket tracking, cached in Mongo through the same async client
+        self.tracking = AsyncTrackingCache(db)
+        # Conversation side effects (Shiprocket, rescheduling) go through this service
+        self.conversations = ConversationEngine(db, effects=self)
+
+    async def startup(self):
+        await self.duplicate_checker.fingerprints.ensure_indexes()
+        await self.conversations.ensure_indexes()
+        await self.near_duplicate_checker.ensure_indexes()
+        await self.tracking.ensure_indexes()
+        # Indexes the hot reconciliation queries need; refuses to start on a collection scan
+        await ensure_indexes_async(self.db)
+        await verify_query_plans_async(self.db)
+
+    async def check_duplicates(self, asset_id, auto_remove=False, mode="aggregate"):
+        result = await self.duplicate_checker.check_and_handle_duplicates(asset_id, auto_remove, mode)
+        await self.alert_duplicates({asset_id: result})
+        return result
+
+    async def check_duplicates_bulk(self, asset_ids):
+        results = await self.duplicate_checker.check_many(asset_ids)
+        await self.alert_duplicates(results)
+        return results
+
+    async def alert_duplicates(self, results):
+        """Queue an alert to the admin and the uploading donor for every flagged upload in {asset_id: result}."""
+        flagged = {asset_id: r for asset_id, r in results.items()
+                   if r and r.get("status") == "flagged" and ObjectId.is_valid(asset_id)}
+        if not flagged:
+            return
+        uploads = await self.db.product_uploads.find(
+            {"_id": {"$in": [ObjectId(a) for a in flagged]}}, {"donerId": 1}
+        ).to_list(None)
+        donor_ids = {str(u["_id"]): u.get("donerId") for u in uploads}
+        donors = await self.db.donors.find(
+            {"_id": {"$in": [d for d in donor_ids.values() if d is not None]}}, {"email": 1}
+        ).to_list(None)
+        emails = {d["_id"]: d.get("email") for d in donors}
+        for asset_id, result in flagged.items():
+            subject = f"Duplicate products in upload {asset_id}"
+            body = f"{result.get('message', 'Duplicate products found.')} Duplicates: {result.get('duplicates')}"
+            for recipient in dict.fromkeys([ADMIN_EMAIL, emails.get(donor_ids.get(asset_id))]):
+                await enqueue_async(self.db, recipient, subject, body, dedupe_key=f"duplicate:{asset_id}", kind="duplicate")
+
+    async def find_near_duplicates(self, upload_ids=None, donor_ids=None, threshold=0.7, cross_donor_only=False):
+        return await self.near_duplicate_checker.find_near_duplicates(
+            upload_ids=upload_ids,
+            donor_ids=donor_ids,
+            threshold=threshold,
+            cross_donor_only=cross_donor_only
+        )
+
+    async def check_delivery_status(self, shipment_id):
+        return delivery_status_message(await self.tracking.get(shipment_id))
+
+    async def find_delivery_by_shipment(self, shipment_id):
+        return await self.db.assetsdeleveries.find_one({"shippingDetails.shipment_id": shipment_id})
+
+    async def reschedule_beneficiary_request(self, beneficiary_request_id, partner_id, shipment_id=None):
+        return await reschedule_beneficiary_request_async(self.db, beneficiary_request_id, partner_id,
+                                                          shipment_id=shipment_id)
+
+    async def reschedule_beneficiary_requests_bulk(self, shipment_ids=None, delivery_filter=None, require_failed=True,
+                                                   limit=1000, after=None):
+        return await reschedule_beneficiary_requests_bulk_async(
+            self.db,
+            shipment_ids=shipment_ids,
+            delivery_filter=delivery_filter,
+            require_failed=require_failed,
+            limit=limit,
+            cache=self.tracking,
+            after=after
+        )
+
+class ThreadedServiceClient:
+    """
+    Blocking facade over ReconciliationService for code running outside its
+    event loop (the console chatbot flows). Calls are scheduled on `loop`,
+    which owns the service's async Mongo client, and waited for here.
+    """
+
+    def __init__(self, service, loop, timeout=RECONCILIATION_API_TIMEOUT[1]):
+        self.service = service
+        self.loop = loop
+        self.timeout = timeout
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(self.timeout)
+
+    def check_duplicates(self, asset_id, auto_remove=False, mode="aggregate"):
+        return self._call(self.service.check_duplicates(asset_id, auto_remove, mode))
+
+class RemoteReconciliationClient:
+    """
+    Client for a reconciliation API running elsewhere, for deployments where
+    the bot runs remotely. One keep-alive session with a bounded connection
+    pool and timeouts on every call.
+    """
+
+    def __init__(self, base_url=None, timeout=RECONCILIATION_API_TIMEOUT, pool_size=10):
+        self.base_url = (base_url or RECONCILIATION_API_URL).rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def check_duplicates(self, asset_id, auto_remove=False, mode="aggregate"):
+        response = self.session.post(
+            f"{self.base_url}/api/reconciliation/check-duplicates",
+            json={"asset_id": asset_id, "auto_remove": auto_remove, "mode": mode},
+            timeout=self.timeout
+        )
+        if response.status_code == 404:
+            return {"message": response.json().get("detail"), "duplicates": [], "status": "not_found"}
+        response.raise_for_status()
+        return response.json()
+
+    def close(self):
+        self.session.close()
+
+def get_remote_client():
+    global _remote_client
+    if _remote_client is None:
+        _remote_client = RemoteReconciliationClient()
+    return _remote_client
+
+def get_local_client():
+    """
+    The process-wide in-process client: a ReconciliationService on its own
+    pooled async client, served by an event loop in a daemon thread.
+    """
+    global _local_client
+    with _local_lock:
+        if _local_client is None:
+            from REC_AGENT.db import DB_NAME, create_async_client
+
+            async def start():
+                service = ReconciliationService(create_async_client()[DB_NAME])
+                await service.startup()
+                return service
+
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="reconciliation-service", daemon=True).start()
+            service = asyncio.run_coroutine_threadsafe(start(), loop).result()
+            _local_client = ThreadedServiceClient(service, loop)
+    return _local_client
+
+def get_service_client():
+    """RemoteReconciliationClient when RECONCILIATION_API_URL is set, else the in-process client."""
+    if os.getenv("RECONCILIATION_API_URL"):
+        return get_remote_client()
+    return get_local_client()
@@ -0,0 +1,178 @@
+import argparse
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from REC_AGENT.db import get_sync_db
+from REC_AGENT.metrics import counter, gauge, histogram, start_metrics_server
+from REC_AGENT.notifications import ADMIN_EMAIL
+from REC_AGENT.partner_to_beneficiary_reschedule import is_delivery_failed, notify_users
+from REC_AGENT.tracking_cache import AsyncTrackingCache, TrackingCache, get_tracking_cache
+
+# Shiprocket throttles per account; stay under it with a steady rate and a small burst
+SHIPROCKET_RATE_LIMIT = float(os.getenv("SHIPROCKET_RATE_LIMIT", "8"))  # requests per second
+SHIPROCKET_BURST = int(os.getenv("SHIPROCKET_BURST", "8"))
+SWEEP_CONCURRENCY = int(os.getenv("SHIPROCKET_SWEEP_CONCURRENCY", "16"))
+# Wall-clock limit per status check, retries included
+SWEEP_CALL_DEADLINE = float(os.getenv("SHIPROCKET_CALL_DEADLINE", "20"))
+
+SWEEP_SECONDS = histogram("shipment_sweep_seconds", "Duration of a full shipment sweep",
+                          buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600))
+SWEEP_SHIPMENTS = gauge("shipment_sweep_last", "Outcome counts of the last shipment sweep", ["result"])
+SWEEP_RUNS = counter("shipment_sweep_runs_total", "Shipment sweeps completed")
+
+DELIVERY_PROJECTION = {"shippingDetails.shipment_id": 1, "beneficeryRequestId": 1, "partnerId": 1}
+
+class TokenBucket:
+    """
+    Async token bucket: `rate` tokens per second, at most `capacity` banked.
+    acquire() waits until a token is available.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+async def check_shipments(shipment_ids, client=None, concurrency=SWEEP_CONCURRENCY,
+                          rate=SHIPROCKET_RATE_LIMIT, burst=SHIPROCKET_BURST, deadline=SWEEP_CALL_DEADLINE,
+                          cache=None):
+    """
+    Tracking for every shipment. Cached results (see tracking_cache) are
+    loaded with one query; the rest are fetched from Shiprocket with at most
+    `concurrency` calls in flight and at most `rate` calls per second.
+    `cache` may be a TrackingCache or, from the API, an AsyncTrackingCache.
+    Returns {shipment_id: tracking json, or an Exception for errors and timeouts}.
+    """
+    if cache is None:
+        cache = get_tracking_cache() if client is None else TrackingCache(client=client)
+    if isinstance(cache, AsyncTrackingCache):
+        results = await cache.prime(shipment_ids)
+    else:
+        results = await asyncio.to_thread(cache.prime, shipment_ids)
+    shipment_ids = [s for s in shipment_ids if s not in results]
+    bucket = TokenBucket(rate, burst)
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+
+    async def check(shipment_id):
+        async with semaphore:
+            await bucket.acquire()
+            try:
+                if isinstance(cache, AsyncTrackingCache):
+                    fetch = cache.fetch(shipment_id, executor)
+                else:
+                    fetch = loop.run_in_executor(executor, cache.fetch, shipment_id)
+                results[shipment_id] = await asyncio.wait_for(fetch, timeout=deadline)
+            except Exception as e:
+                results[shipment_id] = e
+
+    # The client is blocking (pooled requests session); one worker thread per in-flight call
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="shiprocket")
+    try:
+        await asyncio.gather(*(check(shipment_id) for shipment_id in shipment_ids))
+    finally:
+        # Calls past their deadline finish on their own (the session has timeouts)
+        executor.shutdown(wait=False)
+    return results
+
+async def sweep_failed_deliveries(db=None, client=None, concurrency=SWEEP_CONCURRENCY,
+                                  rate=SHIPROCKET_RATE_LIMIT, deadline=SWEEP_CALL_DEADLINE, notify=True, cache=None):
+    """
+    Check every In-progress delivery against Shiprocket and notify the
+    beneficiary, partner and admin of each failed one. Beneficiary requests
+    and partners for all failures are loaded with one $in query each.
+    Returns the failed deliveries and sweep statistics.
+    """
+    if db is None:
+        db = get_sync_db()
+    if cache is None and client is not None:
+        cache = TrackingCache(db, client=client)
+    started = time.perf_counter()
+    deliveries = [
+        d for d in db.assetsdeleveries.find({"shippingDetails.status": "In-progress"}, DELIVERY_PROJECTION)
+        if d.get("shippingDetails", {}).get("shipment_id")
+    ]
+    by_shipment = {}
+    for delivery in deliveries:
+        by_shipment.setdefault(delivery["shippingDetails"]["shipment_id"], []).append(delivery)
+
+    statuses = await check_shipments(list(by_shipment), client=client, concurrency=concurrency,
+                                     rate=rate, deadline=deadline, cache=cache)
+    failed = []
+    errors = timeouts = 0
+    for shipment_id, status in statuses.items():
+        if isinstance(status, asyncio.TimeoutError):
+            timeouts += 1
+            print(f"Timed out fetching status for shipment {shipment_id}")
+        elif isinstance(status, Exception):
+            errors += 1
+            print(f"Error fetching status for shipment {shipment_id}: {status}")
+        elif is_delivery_failed(status):
+            failed.extend(by_shipment[shipment_id])
+
+    if failed and notify:
+        beneficiaries = {
+            b["_id"]: b for b in db.beneficiaryrequests.find(
+                {"_id": {"$in": list({d.get("beneficeryRequestId") for d in failed})}}, {"email": 1}
+            )
+        }
+        partners = {
+            p["_id"]: p for p in db.partners.find(
+                {"_id": {"$in": list({d.get("partnerId") for d in failed})}}, {"email": 1}
+            )
+        }
+        admin = {"email": ADMIN_EMAIL}
+        for delivery in failed:
+            beneficiary = beneficiaries.get(delivery.get("beneficeryRequestId"))
+            partner = partners.get(delivery.get("partnerId"))
+            notify_users(
+                beneficiary.get("email", "unknown") if beneficiary else "unknown",
+                partner.get("email", "unknown") if partner else "unknown",
+                admin.get("email", "unknown"),
+                f"Delivery failed for shipment {delivery['shippingDetails']['shipment_id']}.",
+                dedupe_key=f"delivery_failed:{delivery['_id']}",
+                db=db,
+                kind="delivery_failed"
+            )
+
+    elapsed = time.perf_counter() - started
+    stats = {
+        "deliveries": len(deliveries),
+        "shipments_checked": len(statuses),
+        "failed": len(failed),
+        "errors": errors,
+        "timeouts": timeouts,
+        "seconds": round(elapsed, 3),
+        "checks_per_second": round(len(statuses) / elapsed, 1) if elapsed else None
+    }
+    SWEEP_SECONDS.observe(elapsed)
+    SWEEP_RUNS.inc()
+    for result in ("deliveries", "shipments_checked", "failed", "errors", "timeouts"):
+        SWEEP_SHIPMENTS.set(stats[result], result=result)
+    print(f"[INFO] Shipment sweep: {stats['shipments_checked']} shipments in {elapsed:.2f}s "
+          f"({stats['checks_per_second']}/s), {stats['failed']} failed deliveries, "
+          f"{errors} errors, {timeouts} timeouts")
+    return {"failed": failed, "stats": stats}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check In-progress deliveries against Shiprocket")
+    parser.add_argument("--concurrency", type=int, default=SWEEP_CONCURRENCY)
+    parser.add_argument("--rate", type=float, default=SHIPROCKET_RATE_LIMIT)
+    parser.add_argument("--deadline", type=float, default=SWEEP_CALL_DEADLINE)
+    args = parser.parse_args()
+    start_metrics_server()
+    asyncio.run(sweep_failed_deliveries(concurrency=args.concurrency, rate=args.rate, deadline=args.deadline))
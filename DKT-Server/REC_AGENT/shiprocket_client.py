@@ -0,0 +1,151 @@
+import base64
+import json
+import os
+import threading
+import time
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from REC_AGENT.metrics import histogram
+
+load_dotenv()
+# "live" or "fake" (the local stand-in in fake_shiprocket.py, for offline runs)
+SHIPROCKET_BACKEND = os.getenv("SHIPROCKET_BACKEND", "live")
+SHIPROCKET_FAKE_URL = os.getenv("SHIPROCKET_FAKE_URL", "http://127.0.0.1:8081")
+SHIPROCKET_API_URL = os.getenv(
+    "SHIPROCKET_API_URL",
+    SHIPROCKET_FAKE_URL if SHIPROCKET_BACKEND == "fake" else "https://apiv2.shiprocket.in/v1/external"
+)
+SHIPROCKET_EMAIL = os.getenv("SHIPROCKET_EMAIL", "fake@example.com" if SHIPROCKET_BACKEND == "fake" else None)
+SHIPROCKET_PASSWORD = os.getenv("SHIPROCKET_PASSWORD", "fake" if SHIPROCKET_BACKEND == "fake" else None)
+# (connect, read) seconds
+SHIPROCKET_TIMEOUT = (3.05, float(os.getenv("SHIPROCKET_TIMEOUT", "15")))
+# Shiprocket tokens are valid for 10 days; used when the token carries no exp claim
+SHIPROCKET_TOKEN_TTL = int(os.getenv("SHIPROCKET_TOKEN_TTL", str(9 * 24 * 3600)))
+# Refresh this many seconds before the token expires
+TOKEN_REFRESH_MARGIN = 300
+# Retries after a 429, waiting Retry-After (capped) in between
+RATE_LIMIT_RETRIES = 2
+MAX_RETRY_AFTER = 5.0
+
+_shared_client = None
+
+SHIPROCKET_SECONDS = histogram("shiprocket_request_seconds", "Shiprocket API call latency", ["endpoint", "status"])
+_shared_lock = threading.Lock()
+
+def _token_expiry(token, default_ttl):
+    """exp claim of a JWT bearer token, or now + default_ttl if it cannot be read."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, ValueError, TypeError):
+        return time.time() + default_ttl
+
+class ShiprocketClient:
+    """
+    Shiprocket API client shared by every caller in the process.
+
+    The bearer token is cached until TOKEN_REFRESH_MARGIN before it expires.
+    When it needs refreshing, one thread logs in while the others wait for
+    its result (single flight). Calls go through one keep-alive session with
+    a bounded connection pool and timeouts, so a status check is a single
+    request on a warm connection.
+    """
+
+    def __init__(self, base_url=None, email=None, password=None, timeout=SHIPROCKET_TIMEOUT,
+                 token_ttl=SHIPROCKET_TOKEN_TTL, pool_size=20):
+        self.base_url = (base_url or SHIPROCKET_API_URL).rstrip("/")
+        self.email = email or SHIPROCKET_EMAIL
+        self.password = password or SHIPROCKET_PASSWORD
+        self.timeout = timeout
+        self.token_ttl = token_ttl
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._token = None
+        self._expires_at = 0.0
+        self._token_lock = threading.Lock()
+        self.logins = 0
+
+    def _login(self):
+        with SHIPROCKET_SECONDS.time(endpoint="/auth/login", status="error") as labels:
+            response = self.session.post(
+                f"{self.base_url}/auth/login",
+                json={"email": self.email, "password": self.password},
+                timeout=self.timeout
+            )
+            labels["status"] = response.status_code
+        response.raise_for_status()
+        token = response.json()["token"]
+        self.logins += 1
+        return token, _token_expiry(token, self.token_ttl)
+
+    def _token_valid(self):
+        return self._token is not None and time.time() < self._expires_at - TOKEN_REFRESH_MARGIN
+
+    def get_token(self, stale_token=None):
+        """
+        The cached token, logging in if it is missing or about to expire.
+        `stale_token` is a token the server just rejected: it is replaced
+        unless another thread has already done so.
+        """
+        if stale_token is None and self._token_valid():
+            return self._token
+        with self._token_lock:
+            # Another thread may have logged in while we waited for the lock
+            if self._token_valid() and self._token != stale_token:
+                return self._token
+            self._token, self._expires_at = self._login()
+            return self._token
+
+    def invalidate_token(self):
+        with self._token_lock:
+            self._token = None
+            self._expires_at = 0.0
+
+    def _send_get(self, path, params, token):
+        with SHIPROCKET_SECONDS.time(endpoint=path, status="error") as labels:
+            response = self.session.get(
+                f"{self.base_url}{path}",
+                params=params,
+                headers={"Authorization": f"Bearer {token}"},
+                timeout=self.timeout
+            )
+            labels["status"] = response.status_code
+        return response
+
+    def _get(self, path, params=None):
+        token = self.get_token()
+        response = self._send_get(path, params, token)
+        if response.status_code == 401:
+            # Revoked or expired early: log in again once and retry
+            token = self.get_token(stale_token=token)
+            response = self._send_get(path, params, token)
+        for _ in range(RATE_LIMIT_RETRIES):
+            if response.status_code != 429:
+                break
+            try:
+                retry_after = float(response.headers.get("Retry-After", 1))
+            except ValueError:
+                retry_after = 1.0
+            time.sleep(min(retry_after, MAX_RETRY_AFTER))
+            response = self._send_get(path, params, token)
+        response.raise_for_status()
+        return response.json()
+
+    def track_shipment(self, shipment_id):
+        return self._get("/courier/track", params={"shipment_id": shipment_id})
+
+    def close(self):
+        self.session.close()
+
+def get_shiprocket_client():
+    """The process-wide ShiprocketClient."""
+    global _shared_client
+    if _shared_client is None:
+        with _shared_lock:
+            if _shared_client is None:
+                _shared_client = ShiprocketClient()
+    return _shared_client
@@ -0,0 +1,266 @@
+import argparse
+import random
+from datetime import datetime, timedelta
+from bson import ObjectId
+
+MANIFEST_COLLECTION = "synthetic_dataset"
+# Collections the generator writes (and drops before writing)
+COLLECTIONS = ["donors", "partners", "products", "product_uploads", "requestedproducts",
+               "beneficiaryrequests", "assetsdeleveries"]
+# Roughly how many documents one upload brings with it (products, requests, deliveries)
+DOCS_PER_UPLOAD = 11.7
+SAMPLE_SIZE = 1000
+
+CATEGORIES = ["Laptop", "Desktop", "Tablet", "Monitor", "Printer"]
+MANUFACTURERS = {
+    "Laptop": ["Dell", "HP", "Lenovo", "Acer", "Asus"],
+    "Desktop": ["Dell", "HP", "Lenovo"],
+    "Tablet": ["Samsung", "Lenovo", "Apple"],
+    "Monitor": ["Dell", "LG", "Samsung"],
+    "Printer": ["HP", "Canon", "Epson"]
+}
+PROCESSORS = ["Intel i3", "Intel i5", "Intel i7", "Ryzen 5", "Ryzen 7", "Apple M1"]
+RAM = ["4GB", "8GB", "16GB", "32GB"]
+STORAGE = ["128GB SSD", "256GB SSD", "512GB SSD", "1TB HDD"]
+CITIES = [("Mumbai", "Maharashtra"), ("Pune", "Maharashtra"), ("Bengaluru", "Karnataka"),
+          ("Chennai", "Tamil Nadu"), ("Delhi", "Delhi"), ("Kolkata", "West Bengal")]
+ROLES = ["Student", "Teacher", "NGO"]
+
+class _Writer:
+    """Buffers documents per collection and writes them with unordered insert_many."""
+
+    def __init__(self, db, batch_size):
+        self.db = db
+        self.batch_size = batch_size
+        self.buffers = {name: [] for name in COLLECTIONS}
+        self.counts = dict.fromkeys(COLLECTIONS, 0)
+
+    def add(self, collection, doc):
+        buffer = self.buffers[collection]
+        buffer.append(doc)
+        if len(buffer) >= self.batch_size:
+            self.flush(collection)
+
+    def flush(self, collection=None):
+        for name in [collection] if collection else COLLECTIONS:
+            buffer = self.buffers[name]
+            if buffer:
+                self.db[name].insert_many(buffer, ordered=False)
+                self.counts[name] += len(buffer)
+                buffer.clear()
+
+class _Sample:
+    """Reservoir sample of at most `size` items out of a stream."""
+
+    def __init__(self, rng, size=SAMPLE_SIZE):
+        self.rng = rng
+        self.size = size
+        self.seen = 0
+        self.items = []
+
+    def offer(self, item):
+        self.seen += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+        else:
+            slot = self.rng.randrange(self.seen)
+            if slot < self.size:
+                self.items[slot] = item
+
+def _product(rng, donor, now):
+    category = rng.choice(CATEGORIES)
+    manufacturer = rng.choice(MANUFACTURERS[category])
+    model = f"{manufacturer[:2].upper()}-{rng.randint(100, 999)}"
+    created = now - timedelta(days=rng.randint(0, 365))
+    return {
+        "_id": ObjectId(),
+        "companyDetails": {
+            "name": donor["companyName"],
+            "address": donor["address"][0]["address"],
+            "contactPerson": {"name": "Contact Person", "phone": f"9{rng.randint(100000000, 999999999)}"},
+            "authorizedPerson": {"name": "Authorized Person", "phone": f"9{rng.randint(100000000, 999999999)}"}
+        },
+        "name": f"{manufacturer} {category} {model}",
+        "description": f"{manufacturer} {model} {category.lower()} in working condition",
+        "category": category,
+        "condition": rng.choice(["Recycle", "Repair", "Unclassified", "Allocation-Ready"]),
+        "quantity": 1,
+        "manufacturer": manufacturer,
+        "model": model,
+        "specification": {"processor": rng.choice(PROCESSORS), "RAM": rng.choice(RAM), "storage": rng.choice(STORAGE)},
+        "ageOfProduct": f"{rng.randint(1, 6)} years",
+        "adminApproval": "Approved",
+        "status": "Available",
+        "createdAt": created,
+        "updatedAt": created
+    }
+
+def _beneficiary_request(rng, asset_ids, now):
+    city, state = rng.choice(CITIES)
+    created = now - timedelta(days=rng.randint(0, 90))
+    return {
+        "_id": ObjectId(),
+        "beneficiaryId": ObjectId(),
+        "fullName": f"Beneficiary {rng.randint(1, 10 ** 6)}",
+        "contactNumber": f"9{rng.randint(100000000, 999999999)}",
+        "email": f"beneficiary{rng.randint(1, 10 ** 6)}@example.org",
+        "organizationName": f"School {rng.randint(1, 5000)}",
+        "role": rng.choice(ROLES),
+        "address": {"pickupCode": f"P{rng.randint(1000, 9999)}", "fullAddress": f"{rng.randint(1, 300)} Main Road, {city}"},
+        "city": city,
+        "state": state,
+        "pincode": f"{rng.randint(100000, 999999)}",
+        "deviceType": rng.choice(["Laptop", "Desktop", "Tablet"]),
+        "ram": rng.choice(RAM),
+        "storage": rng.choice(STORAGE),
+        "purpose": "Online classes",
+        "reasonForRequest": "No device at home",
+        "quantity": len(asset_ids),
+        "urgency": rng.choice(["Urgent", "Normal", "Flexible"]),
+        "status": "Approved",
+        "assignedDetails": {"assetIds": asset_ids, "status": "Assigned", "date": created},
+        "createdAt": created,
+        "updatedAt": created
+    }
+
+def generate_dataset(db, scale=10000, seed=42, batch_size=5000, duplicate_rate=0.05,
+                     request_rate=0.6, failure_rate=0.2):
+    """
+    Fill `db` (sync handle) with about `scale` documents shaped like the Node
+    app's data: donors, partners, products, product_uploads (a
+    `duplicate_rate` share with a repeated product ID), requestedproducts,
+    beneficiaryrequests and assetsdeleveries. Existing documents in those
+    collections are dropped first. Generation streams in batches, so memory
+    stays flat up to tens of millions of documents.
+
+    Every `request_rate` share of uploads gets a partner request, a delivery
+    and a beneficiary request. In-progress deliveries whose shipment ID is
+    listed in the returned `failed_shipments` should be reported as failed by
+    the Shiprocket fake.
+
+    Returns a manifest: counts per collection and samples of IDs to run
+    queries against. The manifest is also stored in MANIFEST_COLLECTION.
+    """
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    for name in COLLECTIONS + [MANIFEST_COLLECTION]:
+        db[name].drop()
+    writer = _Writer(db, batch_size)
+    uploads = max(1, int(scale / DOCS_PER_UPLOAD))
+
+    donors = []
+    for i in range(max(5, uploads // 20)):
+        donor = {
+            "_id": ObjectId(),
+            "companyName": f"Donor Company {i}",
+            "email": f"donor{i}@example.com",
+            "role": "donor",
+            "address": [{"address": f"{i} Industrial Estate, {rng.choice(CITIES)[0]}", "verified": True}],
+            "verify": "Approved",
+            "createdAt": now,
+            "updatedAt": now
+        }
+        donors.append(donor)
+        writer.add("donors", donor)
+    partners = []
+    for i in range(max(3, uploads // 50)):
+        partner = {"_id": ObjectId(), "partnerName": f"Partner NGO {i}", "email": f"partner{i}@example.org",
+                   "createdAt": now, "updatedAt": now}
+        partners.append(partner)
+        writer.add("partners", partner)
+
+    samples = {name: _Sample(rng) for name in (
+        "upload_ids", "duplicate_upload_ids", "donor_ids", "in_progress_shipment_ids",
+        "assigned_request_ids", "unverified_delivery_ids")}
+    for donor in donors:
+        samples["donor_ids"].offer(str(donor["_id"]))
+    failed_shipments = []
+    shipment_id = 100000
+
+    for _ in range(uploads):
+        donor = rng.choice(donors)
+        products = [_product(rng, donor, now) for _ in range(max(1, int(rng.gauss(8, 3))))]
+        for product in products:
+            writer.add("products", product)
+        product_ids = [p["_id"] for p in products]
+        listed = list(product_ids)
+        if rng.random() < duplicate_rate:
+            listed.insert(rng.randrange(len(listed) + 1), rng.choice(product_ids))
+        upload = {"_id": ObjectId(), "donerId": donor["_id"], "products": listed,
+                  "adminApproval": "Approved", "createdAt": products[0]["createdAt"]}
+        writer.add("product_uploads", upload)
+        samples["upload_ids"].offer(str(upload["_id"]))
+        if len(listed) != len(product_ids):
+            samples["duplicate_upload_ids"].offer(str(upload["_id"]))
+
+        if rng.random() >= request_rate:
+            continue
+        partner = rng.choice(partners)
+        assets = rng.sample(product_ids, min(len(product_ids), rng.randint(1, 4)))
+        delivered = rng.random() < 0.5
+        for asset in assets:
+            writer.add("requestedproducts", {
+                "_id": ObjectId(), "requestId": ObjectId(), "productId": asset, "donorId": donor["_id"],
+                "partnerId": partner["_id"], "quantity": 1,
+                # A few requests never got assigned, which shows up as a quantity mismatch
+                "status": "Requested" if rng.random() < 0.05 else ("Delivered" if delivered else "Assigned"),
+                "createdAt": now, "updatedAt": now
+            })
+        request = _beneficiary_request(rng, assets, now)
+        writer.add("beneficiaryrequests", request)
+        samples["assigned_request_ids"].offer(str(request["_id"]))
+
+        shipment_id += 1
+        delivery = {
+            "_id": ObjectId(),
+            "assetId": assets,
+            "partnerId": partner["_id"],
+            "beneficeryRequestId": request["_id"],
+            "status": "Delivered" if delivered else "In-progress",
+            "shippingDetails": {
+                "order_id": shipment_id * 10,
+                "shipment_id": shipment_id,
+                "status": "Delivered" if delivered else "In-progress",
+                "awb_code": f"AWB{shipment_id}",
+                "courier_name": rng.choice(["Delhivery", "BlueDart", "Ekart"])
+            },
+            "createdAt": now,
+            "updatedAt": now
+        }
+        writer.add("assetsdeleveries", delivery)
+        if delivered:
+            samples["unverified_delivery_ids"].offer(str(delivery["_id"]))
+        else:
+            samples["in_progress_shipment_ids"].offer(shipment_id)
+            if rng.random() < failure_rate:
+                failed_shipments.append(shipment_id)
+
+    writer.flush()
+    manifest = {
+        "_id": "manifest",
+        "scale": scale,
+        "seed": seed,
+        "generatedAt": now,
+        "counts": writer.counts,
+        "samples": {name: sample.items for name, sample in samples.items()},
+        "failed_shipments": failed_shipments
+    }
+    db[MANIFEST_COLLECTION].insert_one(manifest)
+    return manifest
+
+def load_manifest(db):
+    """The manifest of the dataset already in `db`, or None."""
+    return db[MANIFEST_COLLECTION].find_one({"_id": "manifest"})
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic reconciliation dataset")
+    parser.add_argument("--scale", type=int, default=10000, help="approximate number of documents")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--db", default="reconciliation_bench", help="database to (re)fill")
+    parser.add_argument("--uri", help="Mongo URI (default: MONGO_URI)")
+    args = parser.parse_args()
+    import pymongo
+    from REC_AGENT.db import MONGO_URI
+    db = pymongo.MongoClient(args.uri or MONGO_URI)[args.db]
+    manifest = generate_dataset(db, scale=args.scale, seed=args.seed)
+    print(f"[INFO] Generated {sum(manifest['counts'].values())} documents in {args.db}: {manifest['counts']}")
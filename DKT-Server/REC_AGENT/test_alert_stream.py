@@ -0,0 +1,86 @@
+import asyncio
+import time
+from bson import ObjectId
+from REC_AGENT.alert_stream import AlertBroker, resolve_recipient, sign_subscription, verify_subscription
+from REC_AGENT.memory_mongo import create_memory_db
+from REC_AGENT.notifications import ADMIN_EMAIL, enqueue, ensure_indexes
+
+async def _next_frames(events, count):
+    return [await events.__anext__() for _ in range(count)]
+
+async def run_alert_stream_test():
+    db = create_memory_db("alert_stream_test")
+    ensure_indexes(db.sync)
+    donor_id = db.sync["donors"].insert_one({"companyName": "Donor Co", "email": "donor@example.com"}).inserted_id
+    donor_email = await resolve_recipient(db, "donor", str(donor_id))
+    assert donor_email == "donor@example.com"
+    assert await resolve_recipient(db, "partner", str(ObjectId())) is None
+
+    broker = AlertBroker(db, queue_size=3, heartbeat_seconds=0.05)
+    admin = broker.subscribe(ADMIN_EMAIL)
+    donor = broker.subscribe(donor_email, kinds=["duplicate"])
+    # Idle subscribers for other recipients are not touched when an alert is published
+    idle = [broker.subscribe(f"partner{i}@example.org") for i in range(5000)]
+
+    await broker.poll_once()
+    enqueue(db.sync, ADMIN_EMAIL, "Mismatch for delivery 1", "Committed 3, Received 2", "delivery_mismatch:1",
+            kind="delivery_mismatch")
+    enqueue(db.sync, donor_email, "Mismatch for delivery 1", "Committed 3, Received 2", "delivery_mismatch:1",
+            kind="delivery_mismatch")
+    enqueue(db.sync, donor_email, "Duplicate products in upload 1", "Duplicates: [2]", "duplicate:1", kind="duplicate")
+    started = time.perf_counter()
+    published = await broker.poll_once()
+    print(f"Published {published} alerts to {broker._count} subscribers in {time.perf_counter() - started:.4f}s")
+    assert admin.queue.qsize() == 1
+    assert donor.queue.qsize() == 1 and donor.queue.get_nowait()["kind"] == "duplicate"
+    assert all(s.queue.empty() for s in idle)
+    # A second poll over the overlap window publishes nothing again
+    await broker.poll_once()
+    assert admin.queue.qsize() == 1
+    first_id = admin.queue.get_nowait()["id"]
+
+    # Backpressure: a client that does not read keeps only the newest queue_size alerts
+    for i in range(2, 7):
+        enqueue(db.sync, ADMIN_EMAIL, f"Delivery failed for shipment {i}", "", f"delivery_failed:{i}",
+                kind="delivery_failed")
+    await broker.poll_once()
+    assert admin.queue.qsize() == 3 and admin.dropped == 2
+
+    events = broker.events(admin, last_event_id=first_id)
+    frames = await _next_frames(events, 7)
+    assert frames[0].startswith(": connected")
+    assert sum(f.startswith("id: ") for f in frames[1:6]) == 5, "All 5 alerts after first_id are replayed"
+    assert frames[6].startswith("event: overflow")
+    assert (await events.__anext__()).startswith(": keep-alive"), "Alerts already replayed are not sent twice"
+    await events.aclose()
+    assert admin not in broker._subscriptions.get(ADMIN_EMAIL, ())
+
+    # A long backlog is replayed a page at a time, and cut off with an overflow event
+    paged = AlertBroker(db, heartbeat_seconds=0.05, replay_limit=2, replay_max=4)
+    events = paged.events(paged.subscribe(ADMIN_EMAIL), last_event_id=first_id)
+    frames = await _next_frames(events, 6)
+    assert sum(f.startswith("id: ") for f in frames[1:5]) == 4
+    assert frames[5].startswith("event: overflow") and "replay_truncated" in frames[5]
+    await events.aclose()
+
+    # Subscription tokens are bound to one role and id
+    token = sign_subscription("donor", str(donor_id), secret="test-secret")
+    assert verify_subscription(token, "donor", str(donor_id), secret="test-secret")
+    assert not verify_subscription(token, "donor", str(ObjectId()), secret="test-secret")
+    assert not verify_subscription(token, "admin", secret="test-secret")
+    assert not verify_subscription(token, "donor", str(donor_id), secret="other-secret")
+    assert not verify_subscription(sign_subscription("admin", ttl=-1, secret="test-secret"), "admin", secret="test-secret")
+    print("✅ Alert stream test passed")
+
+def test_alert_stream():
+    """
+    Offline check of the alert stream broker on the in-memory stand-in
+    (needs mongomock): alerts go only to their recipient's subscribers and
+    kinds, slow clients drop the oldest alerts, reconnecting with
+    Last-Event-ID replays what was missed (with an overflow event past the
+    replay cap), and subscription tokens only open their own stream.
+    """
+    asyncio.run(run_alert_stream_test())
+
+if __name__ == "__main__":
+    test_alert_stream()
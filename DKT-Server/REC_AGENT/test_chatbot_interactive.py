@@ -3,6 +3,7 @@ from pymongo import MongoClient
 from bson.objectid import ObjectId
 import requests
 import json
+from REC_AGENT.csv_ingest import ingest_csv
 
 # Test configuration
 DONER_ID = "6866da6882eaeda30f3e6c29"  # Replace with actual doner ID
@@ -23,29 +24,17 @@ def create_test_csv():
     print(f"✅ Test CSV created at: {CSV_PATH}")
     return test_data
 
-def upload_csv_to_mongodb(csv_data):
-    """Simulate CSV upload by inserting data into MongoDB"""
+def upload_csv_to_mongodb(csv_path=CSV_PATH):
+    """Simulate CSV upload by streaming the CSV at `csv_path` into MongoDB"""
     client = MongoClient("mongodb://localhost:27017")
     db = client["reconciliation"]
     
-    # Insert products (simulating the upload process)
-    product_ids = []
-    for record in csv_data:
-        result = db["products"].insert_one(record)
-        product_ids.append(result.inserted_id)
-    
-    # Insert product upload record with csv_data
-    upload_doc = {
-        "donerId": ObjectId(DONER_ID),
-        "products": product_ids,
-        "adminApproval": "Pending",
-        "csv_data": csv_data
-    }
-    
-    result = db["product_uploads"].insert_one(upload_doc)
-    asset_id = str(result.inserted_id)
+    # Chunked ingestion: products, product upload record and fingerprints
+    result = ingest_csv(csv_path, db=db, doner_id=DONER_ID)
+    asset_id = result["upload_id"]
     
     print(f"✅ CSV data uploaded to MongoDB with asset_id: {asset_id}")
+    print(f"📊 Ingestion stats: {result['stats']}")
     return asset_id
 
 def interactive_duplicate_check(asset_id):
@@ -118,10 +107,10 @@ def main():
     print("=" * 60)
     
     # Step 1: Create test CSV
-    csv_data = create_test_csv()
+    create_test_csv()
     
     # Step 2: Upload to MongoDB (simulate frontend upload)
-    asset_id = upload_csv_to_mongodb(csv_data)
+    asset_id = upload_csv_to_mongodb(CSV_PATH)
     
     # Step 3: Interactive duplicate check
     interactive_duplicate_check(asset_id)
@@ -0,0 +1,27 @@
+import io
+import pandas as pd
+from REC_AGENT.csv_ingest import fingerprint_chunk, normalize_chunk
+
+CSV_WITHOUT_QUANTITY = """name,description,category,condition,model
+Laptop A,High performance,Electronics,Good,M1234
+Laptop B,Basic use,Electronics,Repair,M1234
+,No name,Electronics,Fair,M5678
+"""
+
+def test_csv_without_quantity_column():
+    """
+    Offline check of chunk normalization (no MongoDB needed): a CSV without a
+    quantity column gets quantity 1 on every row, unknown conditions fall back
+    to the default, and rows without a name are rejected.
+    """
+    chunk = pd.read_csv(io.StringIO(CSV_WITHOUT_QUANTITY), dtype=str, skipinitialspace=True)
+    valid, rejected = normalize_chunk(chunk)
+    print(valid[["name", "condition", "quantity"]].to_string())
+    assert list(valid["quantity"]) == [1, 1]
+    assert list(valid["condition"]) == ["Unclassified", "Repair"]
+    assert list(rejected["reason"]) == ["name is required"]
+    assert fingerprint_chunk(valid).notna().all()
+    print("✅ CSV without quantity column test passed")
+
+if __name__ == "__main__":
+    test_csv_without_quantity_column()
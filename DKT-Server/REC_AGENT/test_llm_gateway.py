@@ -0,0 +1,54 @@
+import os
+import tempfile
+import threading
+import time
+from REC_AGENT.gemini_helper import StubBackend
+from REC_AGENT.llm_gateway import LLMGateway
+
+class SlowStub(StubBackend):
+    def generate(self, prompt, context=None):
+        time.sleep(0.2)
+        return super().generate(prompt, context)
+
+def test_llm_gateway():
+    """
+    Offline check of the LLM gateway on the stub backend (no network):
+    answers are cached in memory and on disk, identical prompts in flight
+    share one call, and a failed disk write still returns the answer.
+    """
+    with tempfile.TemporaryDirectory() as cache_dir:
+        backend = StubBackend({"Is 3 equal to 3?": "yes"})
+        gateway = LLMGateway(backend, cache_dir=cache_dir)
+        assert gateway.ask("Is 3 equal to 3?") == "yes"
+        assert gateway.ask("Is 3 equal to 3?") == "yes"
+        assert backend.calls == 1 and gateway.stats["memory_hits"] == 1
+
+        # A new process (fresh gateway) answers from the disk cache
+        restarted = LLMGateway(backend, cache_dir=cache_dir)
+        assert restarted.ask("Is 3 equal to 3?") == "yes"
+        assert backend.calls == 1 and restarted.stats["disk_hits"] == 1
+
+        slow = SlowStub()
+        gateway = LLMGateway(slow, cache_dir=cache_dir)
+        answers = []
+        threads = [threading.Thread(target=lambda: answers.append(gateway.ask("Summarize delivery 7"))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(set(answers)) == 1 and slow.calls == 1, "Concurrent identical prompts share one call"
+        assert gateway.ask_many(["a", "b", "a"]) == [gateway.ask("a"), gateway.ask("b"), gateway.ask("a")]
+
+        # The cache directory is a file: the write fails, the answer is still returned
+        blocked = os.path.join(cache_dir, "not_a_directory")
+        open(blocked, "w").close()
+        backend = StubBackend({"Hello": "Hi"})
+        gateway = LLMGateway(backend, cache_dir=blocked)
+        assert gateway.ask("Hello") == "Hi"
+        assert gateway.stats["disk_errors"] == 1 and gateway.stats["errors"] == 0
+        assert gateway.ask("Hello") == "Hi" and backend.calls == 1
+    print(f"Gateway stats: {gateway.stats}")
+    print("✅ LLM gateway test passed")
+
+if __name__ == "__main__":
+    test_llm_gateway()
@@ -0,0 +1,59 @@
+import os
+import tempfile
+from datetime import datetime
+from REC_AGENT.memory_mongo import create_memory_db
+from REC_AGENT.notifications import (DEAD, NOTIFICATIONS_COLLECTION, PENDING, FileSink, NotificationDispatcher,
+                                     enqueue, ensure_indexes)
+
+class FailingSink:
+    name = "failing"
+
+    def send(self, recipient, subject, body):
+        raise ConnectionError("SMTP server unavailable")
+
+def test_notification_dispatcher():
+    """
+    Offline check of the notification outbox on the in-memory stand-in
+    (needs mongomock) with the file sink: repeated alerts are deduped, many
+    alerts to one admin go out as one digest, and failed sends are retried
+    until they are marked dead.
+    """
+    db = create_memory_db("notifications_test").sync
+    ensure_indexes(db)
+    path = os.path.join(tempfile.mkdtemp(), "outbox.jsonl")
+    sink = FileSink(path)
+
+    for i in range(150):
+        enqueue(db, "admin@dkt.com", f"Mismatch for delivery {i}", "Committed 3, Received 2",
+                dedupe_key=f"delivery_mismatch:{i}")
+    enqueue(db, "donor@example.com", "Mismatch for delivery 0", "Committed 3, Received 2",
+            dedupe_key="delivery_mismatch:0")
+    repeated = enqueue(db, "admin@dkt.com", "Mismatch for delivery 0", "Committed 3, Received 2",
+                       dedupe_key="delivery_mismatch:0")
+    assert repeated is None, "A repeated alert for the same delivery should be deduped"
+
+    dispatcher = NotificationDispatcher(db, sink=sink, workers=0, digest_seconds=300)
+    sent = dispatcher.run_once()
+    messages = sink.read()
+    print(f"Sent {sent} notifications as {len(messages)} messages")
+    assert sent == 151
+    assert sorted(m["to"] for m in messages) == ["admin@dkt.com", "donor@example.com"]
+
+    # Inside the digest window nothing more goes to the admin
+    enqueue(db, "admin@dkt.com", "Mismatch for delivery 999", "Committed 1, Received 0")
+    assert dispatcher.run_once() == 0
+    assert db[NOTIFICATIONS_COLLECTION].count_documents({"status": PENDING}) == 1
+
+    # A failing sink backs off and gives up after max_attempts
+    failing = NotificationDispatcher(db, sink=FailingSink(), workers=0, max_attempts=2)
+    enqueue(db, "partner@example.org", "Delivery failed for shipment 1", "Delivery failed for shipment 1.")
+    failing.run_once()
+    doc = db[NOTIFICATIONS_COLLECTION].find_one({"recipient": "partner@example.org"})
+    assert doc["status"] == PENDING and doc["attempts"] == 1 and doc["nextAttemptAt"] > datetime.utcnow()
+    db[NOTIFICATIONS_COLLECTION].update_one({"_id": doc["_id"]}, {"$set": {"nextAttemptAt": datetime.utcnow()}})
+    failing.run_once()
+    assert db[NOTIFICATIONS_COLLECTION].find_one({"_id": doc["_id"]})["status"] == DEAD
+    print("✅ Notification dispatcher test passed")
+
+if __name__ == "__main__":
+    test_notification_dispatcher()
@@ -0,0 +1,40 @@
+from REC_AGENT.fake_shiprocket import start_fake_shiprocket
+from REC_AGENT.partner_to_beneficiary_reschedule import is_delivery_failed
+from REC_AGENT.shiprocket_client import ShiprocketClient
+
+def test_client_against_fake_shiprocket():
+    """
+    Offline check of ShiprocketClient and is_delivery_failed against the local
+    fake (no network or Shiprocket account needed): scripted statuses, one
+    login for many calls, re-login after a rejected token and 429 retries.
+    """
+    server, base_url = start_fake_shiprocket({
+        "shipments": {"101": ["In Transit", "Undelivered"]},
+        "rate_limit_per_second": 5
+    })
+    try:
+        client = ShiprocketClient(base_url=base_url, email="test@example.com", password="test")
+
+        first = client.track_shipment(101)
+        second = client.track_shipment(101)
+        print(f"Shipment 101: {first['tracking_data']['shipment_status']} -> {second['tracking_data']['shipment_status']}")
+        assert not is_delivery_failed(first)
+        assert is_delivery_failed(second)
+
+        # Token revoked on the server side: the client logs in again once
+        server.state.tokens.clear()
+        client.track_shipment(102)
+        assert client.logins == 2, f"Expected 2 logins, got {client.logins}"
+
+        # More calls than the rate limit allows: 429s are retried after Retry-After
+        for shipment_id in range(200, 210):
+            client.track_shipment(shipment_id)
+        stats = server.state.stats
+        print(f"Fake Shiprocket stats: {stats}")
+        assert stats["rate_limited"] > 0
+        print("✅ Offline Shiprocket client test passed")
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    test_client_against_fake_shiprocket()
@@ -0,0 +1,247 @@
+import asyncio
+import os
+import threading
+from datetime import datetime, timedelta
+from pymongo import ASCENDING
+from REC_AGENT.shiprocket_client import get_shiprocket_client
+from REC_AGENT.ttl_cache import TTLCache
+
+TRACKING_CACHE_COLLECTION = "shipment_tracking_cache"
+# Seconds a non-terminal status (in transit, out for delivery, ...) is reused
+TRACKING_CACHE_TTL = int(os.getenv("TRACKING_CACHE_TTL", "300"))
+# Statuses that will not change again; cached without expiry
+TERMINAL_STATUSES = {"delivered", "rto", "rto delivered", "cancelled", "canceled", "failed", "lost", "destroyed"}
+# In-process layer in front of Mongo; terminal entries are re-read from Mongo after this
+MEMORY_TTL = 3600
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+def shipment_status_of(tracking):
+    return (tracking or {}).get("tracking_data", {}).get("shipment_status", "") or ""
+
+def tracking_ttl(tracking):
+    """None (keep forever) for terminal statuses, TRACKING_CACHE_TTL otherwise, 0 to skip caching."""
+    status = str(shipment_status_of(tracking)).strip().lower()
+    if not status:
+        return 0
+    if status in TERMINAL_STATUSES:
+        return None
+    return TRACKING_CACHE_TTL
+
+def _cache_entry(key, tracking):
+    """(Mongo document, expiry) for a tracking result, or (None, None) if it is not cached."""
+    ttl = tracking_ttl(tracking)
+    if ttl == 0:
+        return None, None
+    now = datetime.utcnow()
+    expires_at = None if ttl is None else now + timedelta(seconds=ttl)
+    doc = {"_id": key, "tracking": tracking, "status": shipment_status_of(tracking),
+           "fetchedAt": now, "expiresAt": expires_at}
+    return doc, expires_at
+
+class _MemoryLayer:
+    """The in-process layer and counters shared by the sync and async caches."""
+
+    def __init__(self, client=None):
+        self.client = client
+        self.memory = TTLCache(maxsize=50000, ttl=MEMORY_TTL)
+        self._inflight = {}
+        self.hits = self.misses = 0
+
+    def _shiprocket(self):
+        return self.client or get_shiprocket_client()
+
+    def _remember(self, key, tracking, expires_at):
+        ttl = MEMORY_TTL
+        if expires_at is not None:
+            ttl = min(ttl, (expires_at - datetime.utcnow()).total_seconds())
+        if ttl > 0:
+            self.memory.set(key, tracking, ttl=ttl)
+
+    def _from_doc(self, doc):
+        expires_at = doc.get("expiresAt")
+        if expires_at is not None and expires_at <= datetime.utcnow():
+            # The TTL monitor runs once a minute; treat it as gone already
+            return None
+        self._remember(doc["_id"], doc["tracking"], expires_at)
+        return doc["tracking"]
+
+class TrackingCache(_MemoryLayer):
+    """
+    Shiprocket tracking results by shipment_id, shared by the chatbot flows,
+    the watchers and the sweep. Lookups go memory -> Mongo -> Shiprocket.
+
+    Terminal statuses are stored without expiry; others for
+    TRACKING_CACHE_TTL seconds (a TTL index removes them in Mongo).
+    Entries survive restarts, so a cold process does not re-fetch every
+    shipment at once, and concurrent lookups of the same shipment in one
+    process share a single Shiprocket call.
+    """
+
+    def __init__(self, db=None, client=None):
+        super().__init__(client)
+        if db is None:
+            from REC_AGENT.db import get_sync_db
+            db = get_sync_db()
+        self.collection = db[TRACKING_CACHE_COLLECTION]
+        self._inflight_lock = threading.Lock()
+
+    def ensure_indexes(self):
+        self.collection.create_index([("expiresAt", ASCENDING)], expireAfterSeconds=0)
+
+    def prime(self, shipment_ids):
+        """Load cached entries for many shipments with one query. Returns {shipment_id: tracking}."""
+        keys = {str(s): s for s in shipment_ids}
+        found, missing = self.memory.get_many(keys)
+        if missing:
+            for doc in self.collection.find({"_id": {"$in": missing}}):
+                tracking = self._from_doc(doc)
+                if tracking is not None:
+                    found[doc["_id"]] = tracking
+        return {keys[k]: v for k, v in found.items()}
+
+    def get(self, shipment_id):
+        """Tracking json for the shipment, from cache if still valid, else fetched and stored."""
+        key = str(shipment_id)
+        tracking = self.memory.get(key)
+        if tracking is None:
+            doc = self.collection.find_one({"_id": key})
+            tracking = self._from_doc(doc) if doc else None
+        if tracking is not None:
+            self.hits += 1
+            return tracking
+        self.misses += 1
+        return self.fetch(shipment_id)
+
+    def fetch(self, shipment_id):
+        """Fetch from Shiprocket and store, sharing one call between concurrent callers."""
+        key = str(shipment_id)
+        with self._inflight_lock:
+            event = self._inflight.get(key)
+            leader = event is None
+            if leader:
+                event = self._inflight[key] = threading.Event()
+        if not leader:
+            event.wait()
+            tracking = self.memory.get(key)
+            if tracking is not None:
+                return tracking
+            # The leader failed or the result is not cacheable; fetch ourselves
+            return self._fetch(shipment_id)
+        try:
+            return self._fetch(shipment_id)
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+            event.set()
+
+    def _fetch(self, shipment_id):
+        tracking = self._shiprocket().track_shipment(shipment_id)
+        self.put(shipment_id, tracking)
+        return tracking
+
+    def put(self, shipment_id, tracking):
+        key = str(shipment_id)
+        doc, expires_at = _cache_entry(key, tracking)
+        if doc is None:
+            return
+        self._remember(key, tracking, expires_at)
+        self.collection.replace_one({"_id": key}, doc, upsert=True)
+
+    def invalidate(self, shipment_id):
+        key = str(shipment_id)
+        self.memory.pop(key)
+        self.collection.delete_one({"_id": key})
+
+class AsyncTrackingCache(_MemoryLayer):
+    """
+    TrackingCache for the API, on its shared async Mongo client, so status
+    checks do not open the sync pool. Same collection and expiry rules;
+    the blocking Shiprocket call runs in a worker thread, and concurrent
+    lookups of one shipment share it.
+    """
+
+    def __init__(self, db, client=None):
+        super().__init__(client)
+        self.collection = db[TRACKING_CACHE_COLLECTION]
+
+    async def ensure_indexes(self):
+        await self.collection.create_index([("expiresAt", ASCENDING)], expireAfterSeconds=0)
+
+    async def prime(self, shipment_ids):
+        """Load cached entries for many shipments with one query. Returns {shipment_id: tracking}."""
+        keys = {str(s): s for s in shipment_ids}
+        found, missing = self.memory.get_many(keys)
+        if missing:
+            async for doc in self.collection.find({"_id": {"$in": missing}}):
+                tracking = self._from_doc(doc)
+                if tracking is not None:
+                    found[doc["_id"]] = tracking
+        return {keys[k]: v for k, v in found.items()}
+
+    async def get(self, shipment_id):
+        """Tracking json for the shipment, from cache if still valid, else fetched and stored."""
+        key = str(shipment_id)
+        tracking = self.memory.get(key)
+        if tracking is None:
+            doc = await self.collection.find_one({"_id": key})
+            tracking = self._from_doc(doc) if doc else None
+        if tracking is not None:
+            self.hits += 1
+            return tracking
+        self.misses += 1
+        return await self.fetch(shipment_id)
+
+    async def fetch(self, shipment_id, executor=None):
+        """Fetch from Shiprocket (in `executor`, default the loop's) and store, one call per shipment at a time."""
+        key = str(shipment_id)
+        event = self._inflight.get(key)
+        if event is not None:
+            await event.wait()
+            tracking = self.memory.get(key)
+            if tracking is not None:
+                return tracking
+            # The leader failed or the result is not cacheable; fetch ourselves
+            return await self._fetch(shipment_id, executor)
+        event = self._inflight[key] = asyncio.Event()
+        try:
+            return await self._fetch(shipment_id, executor)
+        finally:
+            del self._inflight[key]
+            event.set()
+
+    async def _fetch(self, shipment_id, executor):
+        loop = asyncio.get_running_loop()
+        tracking = await loop.run_in_executor(executor, self._shiprocket().track_shipment, shipment_id)
+        await self.put(shipment_id, tracking)
+        return tracking
+
+    async def put(self, shipment_id, tracking):
+        key = str(shipment_id)
+        doc, expires_at = _cache_entry(key, tracking)
+        if doc is None:
+            return
+        self._remember(key, tracking, expires_at)
+        await self.collection.replace_one({"_id": key}, doc, upsert=True)
+
+    async def invalidate(self, shipment_id):
+        key = str(shipment_id)
+        self.memory.pop(key)
+        await self.collection.delete_one({"_id": key})
+
+def get_tracking_cache():
+    """The process-wide TrackingCache (on the shared sync Mongo client)."""
+    global _shared_cache
+    if _shared_cache is None:
+        with _shared_lock:
+            if _shared_cache is None:
+                cache = TrackingCache()
+                cache.ensure_indexes()
+                _shared_cache = cache
+    return _shared_cache
+
+def set_tracking_cache(cache):
+    """Swap the process-wide cache, e.g. TrackingCache(db, client=...) against the fake in benchmarks."""
+    global _shared_cache
+    _shared_cache = cache